@@ -0,0 +1,34 @@
+import time
+from admission_utils import dispatch, release_stale, queue_counts
+from idempotency_utils import purge_expired
+from metrics_utils import emit_metrics
+from log_utils import get_logger
+
+logger = get_logger('admission_dispatcher')
+
+def handler(event, context):
+    """
+    Scheduled admission pass: release slots held by executions that ended
+    without reaching SaveFinalResults or RefundUser, then start whatever the
+    limits allow and refresh queue positions. Also drops expired idempotency keys.
+    """
+    started_at = time.perf_counter()
+    released = release_stale()
+    started = dispatch(scheduled=True)
+    queued, running = queue_counts()
+    try:
+        purged = purge_expired()
+    except Exception as e:
+        logger.error('IDEMPOTENCY PURGE ERROR', error=str(e))
+        purged = 0
+
+    emit_metrics({
+        'ExecutionsQueued': (queued, 'Count'),
+        'ExecutionsRunning': (running, 'Count'),
+        'ExecutionsAdmitted': (len(started), 'Count'),
+        'StaleSlotsReleased': (released, 'Count'),
+        'IdempotencyKeysPurged': (purged, 'Count'),
+        'DispatchDuration': (round((time.perf_counter() - started_at) * 1000, 2), 'Milliseconds')
+    }, {'stage': 'AdmissionDispatcher'})
+    logger.info('DISPATCH COMPLETE', queued=queued, running=running, admitted=len(started), released=released, purged=purged)
+    return {'queued': queued, 'running': running, 'admitted': len(started), 'released': released}
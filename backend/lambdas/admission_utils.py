@@ -0,0 +1,354 @@
+"""
+Admission control for generation workflows.
+
+generate enqueues every request in generation_queue instead of starting its
+Step Functions execution directly. dispatch() admits queued requests in FIFO
+order while fewer than ADMISSION_GLOBAL_LIMIT executions are running and the
+owner has fewer than ADMISSION_USER_LIMIT; a user at their limit doesn't hold
+up anyone behind them. Capacity is released by SaveFinalResults and
+RefundUser, and by the scheduled admission_dispatcher for executions that
+ended any other way (HandleError, timeout, abort). Request paths dispatch
+only if no one else is (pg_try_advisory_xact_lock) and start at most
+ADMISSION_INLINE_STARTS; the dispatcher does the rest and sends waiting
+requests their queue position over the WebSocket.
+"""
+import json
+import os
+from client_utils import get_stepfunctions_client
+from db_utils import get_db
+from metrics_utils import time_external
+from websocket_simple import send_progress_update
+from idempotency_utils import get_claim
+from log_utils import get_logger
+
+logger = get_logger('admission_utils')
+
+ADMISSION_USER_LIMIT = int(os.environ.get('ADMISSION_USER_LIMIT', 2))
+ADMISSION_GLOBAL_LIMIT = int(os.environ.get('ADMISSION_GLOBAL_LIMIT', 20))
+ADMISSION_MAX_START_ATTEMPTS = int(os.environ.get('ADMISSION_MAX_START_ATTEMPTS', 3))
+ADMISSION_STALE_SECONDS = int(os.environ.get('ADMISSION_STALE_SECONDS', 120))
+ADMISSION_SCAN_LIMIT = 200
+# Start attempts per dispatch() from a request path (generate, SaveFinalResults, RefundUser, cancel)
+ADMISSION_INLINE_STARTS = int(os.environ.get('ADMISSION_INLINE_STARTS', 3))
+QUEUE_NOTIFY_LIMIT = 50
+# Serializes dispatchers so running counts can't change between count and start
+ADMISSION_LOCK_KEY = 0x61646d31
+
+def enqueue_execution(execution_id, cognito_user_id, workflow_input, idempotency_key=None, request_hash=None, ttl_seconds=None):
+    """
+    Queue a workflow start; returns its queue row id. With an idempotency_key the
+    key is claimed in the same statement, and None is returned when it is already
+    held (unexpired, and its execution didn't fail to start).
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        if idempotency_key is None:
+            cur.execute('''
+                INSERT INTO generation_queue (execution_id, cognito_user_id, workflow_input)
+                VALUES (%s, %s, %s::jsonb)
+                RETURNING id
+            ''', (execution_id, cognito_user_id, json.dumps(workflow_input)))
+        else:
+            cur.execute('''
+                WITH claim AS (
+                    INSERT INTO idempotency_keys (idempotency_key, request_hash, execution_id, expires_at)
+                    VALUES (%(key)s, %(hash)s, %(execution_id)s, NOW() + make_interval(secs => %(ttl)s))
+                    ON CONFLICT (idempotency_key) DO UPDATE
+                    SET request_hash = EXCLUDED.request_hash, execution_id = EXCLUDED.execution_id,
+                        created_at = NOW(), expires_at = EXCLUDED.expires_at
+                    WHERE idempotency_keys.expires_at <= NOW() OR EXISTS (
+                        SELECT 1 FROM generation_queue g
+                        WHERE g.execution_id = idempotency_keys.execution_id AND g.status = 'failed'
+                    )
+                    RETURNING execution_id
+                )
+                INSERT INTO generation_queue (execution_id, cognito_user_id, workflow_input)
+                SELECT execution_id, %(user)s, %(input)s::jsonb FROM claim
+                RETURNING id
+            ''', {'key': idempotency_key, 'hash': request_hash, 'execution_id': execution_id, 'ttl': ttl_seconds,
+                  'user': cognito_user_id, 'input': json.dumps(workflow_input)})
+        row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def submit_execution(execution_id, cognito_user_id, workflow_input, idempotency_key=None, request_hash=None, ttl_seconds=None):
+    """
+    Enqueue and try to admit right away. Returns {'execution_id', 'status':
+    'running'|'queued'|'finished'|'failed', 'queue_position', 'duplicate'}; for a
+    duplicate idempotency key it describes the original execution instead, with
+    the original request_hash.
+    """
+    # Twice only in case the held key expires between the claim and the lookup
+    for _ in range(2):
+        if enqueue_execution(execution_id, cognito_user_id, workflow_input,
+                             idempotency_key, request_hash, ttl_seconds) is not None:
+            break
+        claim = get_claim(idempotency_key)
+        if claim:
+            logger.info('DUPLICATE REQUEST', execution_id=claim[0])
+            return {**get_queue_status(claim[0]), 'execution_id': claim[0], 'duplicate': True, 'request_hash': claim[1]}
+    else:
+        raise RuntimeError(f'Could not claim idempotency key for {execution_id}')
+
+    try:
+        dispatch()
+    except Exception as e:
+        # Still queued; the scheduled dispatcher will admit it
+        logger.error('DISPATCH ERROR', execution_id=execution_id, error=str(e))
+    return {**get_queue_status(execution_id), 'execution_id': execution_id, 'duplicate': False}
+
+def get_queue_status(execution_id):
+    """Status of a queued request and its 1-based position among waiting requests"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT q.status,
+               CASE WHEN q.status = 'queued' THEN (
+                   SELECT COUNT(*) FROM generation_queue w WHERE w.status = 'queued' AND w.id <= q.id
+               ) END
+        FROM generation_queue q
+        WHERE q.execution_id = %s
+    ''', (execution_id,))
+    row = cur.fetchone()
+    conn.commit()
+    if not row:
+        return {'status': None, 'queue_position': None}
+    return {'status': row[0], 'queue_position': row[1]}
+
+def dispatch(scheduled=False):
+    """
+    Start as many queued executions as the limits allow; returns the execution ids started.
+    Rows locked elsewhere (e.g. a concurrent cancellation) are skipped. From a
+    request path it gives up if another dispatch holds the lock and makes at
+    most ADMISSION_INLINE_STARTS start attempts; scheduled runs wait for the
+    lock, drain the queue and refresh queue positions.
+    """
+    conn = None
+    started, failed = [], []
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        if scheduled:
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (ADMISSION_LOCK_KEY,))
+        else:
+            cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (ADMISSION_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return started
+        cur.execute('''
+            SELECT cognito_user_id, COUNT(*) FROM generation_queue
+            WHERE status = 'running'
+            GROUP BY cognito_user_id
+        ''')
+        running = dict(cur.fetchall())
+        total = sum(running.values())
+        if total >= ADMISSION_GLOBAL_LIMIT:
+            conn.commit()
+            return started
+
+        cur.execute('''
+            SELECT id, execution_id, cognito_user_id, workflow_input, attempts
+            FROM generation_queue
+            WHERE status = 'queued'
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ''', (ADMISSION_SCAN_LIMIT,))
+        queued = cur.fetchall()
+
+        stepfunctions = get_stepfunctions_client()
+        start_attempts = 0
+        for queue_id, execution_id, cognito_user_id, workflow_input, attempts in queued:
+            if total >= ADMISSION_GLOBAL_LIMIT or (not scheduled and start_attempts >= ADMISSION_INLINE_STARTS):
+                break
+            if running.get(cognito_user_id, 0) >= ADMISSION_USER_LIMIT:
+                continue
+            start_attempts += 1
+            try:
+                execution_arn = start_execution(stepfunctions, execution_id, workflow_input)
+            except Exception as e:
+                status = 'failed' if attempts + 1 >= ADMISSION_MAX_START_ATTEMPTS else 'queued'
+                cur.execute('''
+                    UPDATE generation_queue SET attempts = attempts + 1, status = %s,
+                        finished_at = CASE WHEN %s = 'failed' THEN NOW() END
+                    WHERE id = %s
+                ''', (status, status, queue_id))
+                logger.error('ADMISSION START FAILED', execution_id=execution_id, attempts=attempts + 1, error=str(e))
+                if status == 'failed':
+                    failed.append(execution_id)
+                continue
+            cur.execute('''
+                UPDATE generation_queue SET status = 'running', execution_arn = %s, started_at = NOW()
+                WHERE id = %s
+            ''', (execution_arn, queue_id))
+            running[cognito_user_id] = running.get(cognito_user_id, 0) + 1
+            total += 1
+            started.append(execution_id)
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+    if started:
+        logger.info('EXECUTIONS ADMITTED', count=len(started), running=total)
+    for execution_id in failed:
+        send_progress_update(execution_id, {
+            'execution_id': execution_id,
+            'current_step': 'Queued',
+            'progress': 0,
+            'status': 'failed',
+            'message': 'Could not start image generation. No credits were charged.'
+        })
+    if scheduled:
+        notify_queue_positions()
+    return started
+
+def start_execution(stepfunctions, execution_id, workflow_input):
+    """Start one queued workflow; a name already started (earlier attempt that timed out) counts as started"""
+    state_machine_arn = os.environ.get('STATE_MACHINE_ARN')
+    try:
+        with time_external('stepfunctions'):
+            execution = stepfunctions.start_execution(
+                stateMachineArn=state_machine_arn,
+                name=execution_id,
+                input=json.dumps(workflow_input)
+            )
+        return execution['executionArn']
+    except stepfunctions.exceptions.ExecutionAlreadyExists:
+        logger.warning('EXECUTION ALREADY STARTED', execution_id=execution_id)
+        return execution_arn(execution_id)
+
+def execution_arn(execution_id):
+    """ARN of an execution of STATE_MACHINE_ARN started under execution_id"""
+    return os.environ.get('STATE_MACHINE_ARN').replace(':stateMachine:', ':execution:') + ':' + execution_id
+
+def get_queue_entry(execution_id):
+    """Queue row of an execution as a dict, or None"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT cognito_user_id, status, execution_arn FROM generation_queue WHERE execution_id = %s
+    ''', (execution_id,))
+    row = cur.fetchone()
+    conn.commit()
+    if not row:
+        return None
+    return {'cognito_user_id': row[0], 'status': row[1], 'execution_arn': row[2]}
+
+def cancel_queued(execution_id):
+    """Drop a request that hasn't started; False if it was admitted (or finished) first"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE generation_queue SET status = 'cancelled', finished_at = NOW()
+            WHERE execution_id = %s AND status = 'queued'
+        ''', (execution_id,))
+        cancelled = cur.rowcount
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    return bool(cancelled)
+
+def release_execution(execution_id, admit=True, status='finished'):
+    """
+    Free the slot held by a finished (or, with status='cancelled', cancelled)
+    execution and (with admit) admit whatever can run now. Either status
+    stops credit_utils.reserve_batch from reserving for the execution.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE generation_queue SET status = %s, finished_at = NOW()
+            WHERE execution_id = %s AND status = 'running'
+        ''', (status, execution_id))
+        released = cur.rowcount
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    if released and admit:
+        dispatch()
+    return bool(released)
+
+def release_stale():
+    """
+    Release running rows whose execution has ended without SaveFinalResults or
+    RefundUser (HandleError, timeout, abort). Returns the number released;
+    the caller dispatches afterwards.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT execution_id, execution_arn FROM generation_queue
+        WHERE status = 'running' AND started_at < NOW() - make_interval(secs => %s)
+        ORDER BY started_at
+    ''', (ADMISSION_STALE_SECONDS,))
+    rows = cur.fetchall()
+    conn.commit()
+
+    stepfunctions = get_stepfunctions_client()
+    released = 0
+    for execution_id, execution_arn in rows:
+        try:
+            with time_external('stepfunctions'):
+                status = stepfunctions.describe_execution(executionArn=execution_arn)['status']
+        except Exception as e:
+            logger.warning('DESCRIBE EXECUTION FAILED', execution_id=execution_id, error=str(e))
+            continue
+        if status != 'RUNNING' and release_execution(execution_id, admit=False):
+            logger.info('STALE EXECUTION RELEASED', execution_id=execution_id, sfn_status=status)
+            released += 1
+    return released
+
+def queue_counts():
+    """(queued, running) totals for metrics"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT COUNT(*) FILTER (WHERE status = 'queued'), COUNT(*) FILTER (WHERE status = 'running')
+        FROM generation_queue
+        WHERE status IN ('queued', 'running')
+    ''')
+    row = cur.fetchone()
+    conn.commit()
+    return row[0], row[1]
+
+def notify_queue_positions():
+    """Send the head of the queue its current positions; failures are logged only"""
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT execution_id, ROW_NUMBER() OVER (ORDER BY id)
+            FROM generation_queue
+            WHERE status = 'queued'
+            ORDER BY id
+            LIMIT %s
+        ''', (QUEUE_NOTIFY_LIMIT,))
+        rows = cur.fetchall()
+        conn.commit()
+        for execution_id, position in rows:
+            send_progress_update(execution_id, {
+                'execution_id': execution_id,
+                'current_step': 'Queued',
+                'progress': 0,
+                'status': 'queued',
+                'queue_position': position,
+                'message': f'Waiting to start ({position - 1} ahead in queue)' if position > 1 else 'Starting soon'
+            })
+    except Exception as e:
+        logger.warning('QUEUE NOTIFY FAILED', error=str(e))
@@ -0,0 +1,55 @@
+import json
+from cors_utils import get_cors_headers
+from stage_timing_utils import get_stage_percentiles, GRANULARITIES
+from log_utils import get_logger
+
+logger = get_logger('analytics')
+
+MAX_DAYS = 365
+
+def handler(event, context):
+    """
+    Pipeline analytics
+    GET /analytics/stages?days=30&granularity=day&stage=ProcessImages
+        p50/p95/p99 stage durations by stage, image_count bucket and period
+    """
+    if event.get('httpMethod') == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': ''
+        }
+
+    try:
+        params = event.get('queryStringParameters') or {}
+        days = int(params.get('days', 30))
+        granularity = params.get('granularity')
+        stage = params.get('stage')
+
+        if days < 1 or days > MAX_DAYS:
+            return error_response(400, f'days must be between 1 and {MAX_DAYS}')
+        if granularity and granularity not in GRANULARITIES:
+            return error_response(400, f'granularity must be one of {", ".join(sorted(GRANULARITIES))}')
+
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'days': days,
+                'granularity': granularity,
+                'stages': get_stage_percentiles(days, granularity, stage)
+            })
+        }
+
+    except ValueError:
+        return error_response(400, 'days must be an integer')
+    except Exception as e:
+        logger.error('ANALYTICS ERROR', error=str(e))
+        return error_response(500, str(e))
+
+def error_response(status_code, message):
+    return {
+        'statusCode': status_code,
+        'headers': get_cors_headers(),
+        'body': json.dumps({'error': message})
+    }
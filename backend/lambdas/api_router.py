@@ -0,0 +1,54 @@
+import importlib
+import json
+from cors_utils import get_cors_headers
+from profiling_utils import profile_handler
+
+# resource -> (handler module, allowed methods). Each handler already
+# dispatches on httpMethod itself, so the router only picks the module.
+ROUTES = {
+    '/user': ('user', {'GET', 'OPTIONS'}),
+    '/user/credits': ('user', {'POST'}),
+    '/batches': ('batch', {'GET', 'POST', 'OPTIONS'}),
+    '/images': ('image', {'GET'}),
+    '/images/{id}': ('image', {'PUT'}),
+    '/generate': ('generate', {'POST', 'OPTIONS'}),
+    '/cancel': ('cancel', {'POST', 'OPTIONS'}),
+    '/payment': ('payment', {'POST', 'OPTIONS'}),
+    '/upload': ('upload', {'POST'}),
+    '/export': ('export', {'POST'}),
+    '/analytics/stages': ('analytics', {'GET'}),
+}
+
+@profile_handler('ApiRouter')
+def handler(event, context):
+    """
+    Single entry point for the REST API: routes on httpMethod and resource to
+    the existing per-endpoint handlers so they share one warm process, one
+    database connection (db_utils) and one client set (client_utils).
+    """
+    method = event.get('httpMethod', '')
+    resource = event.get('resource') or event.get('path', '')
+    route = ROUTES.get(resource)
+
+    if not route:
+        return route_error(404, f'No route for {resource}')
+
+    module_name, methods = route
+    if method not in methods:
+        # Preflight for resources whose handler has no OPTIONS branch
+        if method == 'OPTIONS':
+            return {'statusCode': 200, 'headers': get_cors_headers(), 'body': ''}
+        return route_error(405, f'Method {method} not allowed on {resource}')
+
+    return resolve_handler(module_name)(event, context)
+
+def resolve_handler(module_name):
+    """Import handler modules on first use so a request only loads what it needs"""
+    return importlib.import_module(module_name).handler
+
+def route_error(status_code, message):
+    return {
+        'statusCode': status_code,
+        'body': json.dumps({'error': message}),
+        'headers': get_cors_headers()
+    }
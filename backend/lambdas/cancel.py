@@ -0,0 +1,254 @@
+"""
+POST /cancel: stop a generation by execution_id (or batch_id).
+
+A queued request is dropped before it starts and nothing was charged. A
+running one has its batch marked cancelled, its Step Functions execution
+stopped, its Gemini job cancelled (unless coalesced with other live
+batches), its partial S3 objects deleted and its unused credits refunded
+under the same ledger key RefundUser uses. Batches already saving their
+results can't be cancelled.
+"""
+import json
+import os
+from db_utils import get_db, get_cognito_user_id
+from cors_utils import get_cors_headers
+from client_utils import get_stepfunctions_client, get_gemini_client, get_s3_client
+from admission_utils import get_queue_entry, cancel_queued, release_execution, execution_arn
+from credit_utils import credit_user, refund_key
+from coalesce_utils import drop_pending
+from metrics_utils import time_external
+from websocket_simple import send_progress_update
+from log_utils import get_logger, set_log_context, update_log_context
+
+logger = get_logger('cancel')
+
+S3_DELETE_BATCH = 1000  # delete_objects limit
+
+def cors_response(status_code, body):
+    """Helper function to create response with CORS headers"""
+    return {
+        'statusCode': status_code,
+        'headers': get_cors_headers(),
+        'body': json.dumps(body)
+    }
+
+def handler(event, context):
+    if event.get('httpMethod') == 'OPTIONS':
+        return cors_response(200, {})
+
+    set_log_context(request_id=getattr(context, 'aws_request_id', None))
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        execution_id = body.get('execution_id')
+        batch_id = body.get('batch_id')
+        if not execution_id and not batch_id:
+            return cors_response(400, {'error': 'execution_id or batch_id is required'})
+
+        result = cancel_generation(get_cognito_user_id(event), execution_id, batch_id)
+        if result['status'] == 'not_found':
+            return cors_response(404, {'error': 'Generation not found'})
+        if result['status'] == 'finished':
+            return cors_response(409, {'error': 'Generation already finished', **result})
+        return cors_response(200, result)
+
+    except Exception as e:
+        logger.error('CANCEL ERROR', error=str(e))
+        return cors_response(500, {'error': str(e)})
+
+def cancel_generation(cognito_user_id, execution_id=None, batch_id=None):
+    """
+    Cancel one of the user's generations. Returns a dict with status
+    'cancelled' (plus refunded amount), 'finished' or 'not_found'.
+    """
+    batch = find_batch(cognito_user_id, execution_id, batch_id)
+    if batch_id and not batch:
+        return {'status': 'not_found'}
+    execution_id = execution_id or batch['execution_id']
+    entry = get_queue_entry(execution_id) if execution_id else None
+    if entry and entry['cognito_user_id'] != cognito_user_id:
+        entry = None
+    if not batch and not entry:
+        return {'status': 'not_found'}
+
+    update_log_context(execution_id=execution_id, batch_id=batch and batch['id'])
+
+    if entry and entry['status'] == 'queued' and cancel_queued(execution_id):
+        logger.info('QUEUED GENERATION CANCELLED')
+        return notify_cancelled(execution_id, None, 0)
+
+    if batch and batch['status'] == 'cancelled':
+        # Repeated cancel: finish an earlier attempt that failed before its refund (keyed, so applied once)
+        return notify_cancelled(execution_id, batch['id'], refund_unused(cognito_user_id, batch))
+
+    if batch and not mark_cancelled(batch['id']):
+        return {'status': 'finished', 'execution_id': execution_id, 'batch_id': batch['id']}
+
+    if execution_id:
+        stop_execution(execution_id, entry)
+        try:
+            # Also makes a ValidateAndSetup still running refuse to reserve credits from now on
+            release_execution(execution_id, status='cancelled')
+        except Exception as e:
+            logger.warning('ADMISSION RELEASE FAILED', error=str(e))
+
+    if not batch:
+        # ValidateAndSetup may have reserved credits before the queue row was cancelled
+        batch = find_batch(cognito_user_id, execution_id)
+        if not batch or not mark_cancelled(batch['id']):
+            return notify_cancelled(execution_id, None, 0)
+
+    try:
+        cancel_gemini_work(batch['id'])
+    except Exception as e:
+        logger.error('GEMINI CLEANUP ERROR', error=str(e))
+    try:
+        delete_partial_objects(batch['id'])
+    except Exception as e:
+        logger.error('S3 CLEANUP ERROR', error=str(e))
+    refunded = refund_unused(cognito_user_id, batch)
+
+    logger.info('GENERATION CANCELLED', refunded=refunded)
+    return notify_cancelled(execution_id, batch['id'], refunded)
+
+def find_batch(cognito_user_id, execution_id=None, batch_id=None):
+    """The user's batch by id or execution_id, or None"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT b.id, b.user_id, b.status, b.cost, b.image_count, b.execution_id
+        FROM batches b
+        JOIN users u ON u.id = b.user_id
+        WHERE u.cognito_id = %s AND (b.id = %s OR b.execution_id = %s)
+        ORDER BY b.id DESC
+        LIMIT 1
+    ''', (cognito_user_id, batch_id, execution_id))
+    row = cur.fetchone()
+    conn.commit()
+    if not row:
+        return None
+    return {'id': row[0], 'user_id': row[1], 'status': row[2], 'cost': row[3], 'image_count': row[4],
+            'execution_id': row[5]}
+
+def mark_cancelled(batch_id):
+    """Move a processing batch to cancelled; False once it's finished or saving its results"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE batches
+            SET status = 'cancelled', current_step = 'Cancelled', error_message = 'Cancelled by user',
+                completed_at = NOW(), updated_at = NOW()
+            WHERE id = %s AND status = 'processing' AND current_step IS DISTINCT FROM 'SaveFinalResults'
+        ''', (batch_id,))
+        cancelled = cur.rowcount
+        conn.commit()
+        return bool(cancelled)
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def stop_execution(execution_id, entry):
+    """Stop the workflow; an execution that already ended is fine"""
+    arn = (entry and entry['execution_arn']) or execution_arn(execution_id)
+    try:
+        with time_external('stepfunctions'):
+            get_stepfunctions_client().stop_execution(executionArn=arn, error='Cancelled', cause='Cancelled by user')
+    except Exception as e:
+        logger.warning('STOP EXECUTION FAILED', error=str(e))
+
+def cancel_gemini_work(batch_id):
+    """
+    Drop the batch's prompt sets still waiting to be coalesced, and cancel its
+    Gemini job unless another processing batch shares it.
+    """
+    drop_pending(batch_id)
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT b.gemini_batch_id, (
+                SELECT COUNT(*) FROM batches o
+                WHERE o.gemini_batch_id = b.gemini_batch_id AND o.status = 'processing' AND o.id <> b.id
+            )
+            FROM batches b WHERE b.id = %s
+        ''', (batch_id,))
+        gemini_batch_id, sharing = cur.fetchone()
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+    if not gemini_batch_id:
+        return
+    if sharing:
+        logger.info('GEMINI JOB SHARED, NOT CANCELLED', gemini_batch_id=gemini_batch_id, sharing=sharing)
+        return
+    try:
+        with time_external('gemini'):
+            get_gemini_client().batches.cancel(name=gemini_batch_id)
+        logger.info('GEMINI JOB CANCELLED', gemini_batch_id=gemini_batch_id)
+    except Exception as e:
+        # Usually the job has already finished
+        logger.warning('GEMINI CANCEL FAILED', gemini_batch_id=gemini_batch_id, error=str(e))
+
+def delete_partial_objects(batch_id):
+    """
+    Delete the images ProcessImages stored for this batch (their keys
+    include the batch id, so no other batch uses them). Returns the number
+    of objects deleted.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT s3_key FROM image_checkpoints WHERE batch_id = %s', (batch_id,))
+    keys = [row[0] for row in cur.fetchall()]
+    conn.commit()
+
+    s3 = get_s3_client()
+    bucket = os.environ.get('S3_BUCKET')
+    for start in range(0, len(keys), S3_DELETE_BATCH):
+        chunk = keys[start:start + S3_DELETE_BATCH]
+        with time_external('s3'):
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True})
+
+    cur.execute('DELETE FROM image_checkpoints WHERE batch_id = %s', (batch_id,))
+    conn.commit()
+    logger.info('PARTIAL OBJECTS DELETED', objects=len(keys))
+    return len(keys)
+
+def refund_unused(cognito_user_id, batch):
+    """Refund the images the user doesn't get; returns the amount credited"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) FROM images WHERE batch_id = %s', (batch['id'],))
+    delivered = cur.fetchone()[0]
+    conn.commit()
+
+    unused = max(batch['image_count'] - delivered, 0)
+    amount = round(float(batch['cost']) * unused / batch['image_count'], 2) if batch['image_count'] else 0
+    if amount <= 0:
+        return 0
+    balance = credit_user(cognito_user_id, amount, 'refund', refund_key(batch['id']), batch['id'], 'cancelled')
+    # None: RefundUser (or an earlier cancel) already refunded this batch
+    return amount if balance is not None else 0
+
+def notify_cancelled(execution_id, batch_id, refunded):
+    """Final WebSocket update; returns the API result"""
+    message = f'Generation cancelled. ${refunded:.2f} has been refunded to your account.' if refunded \
+        else 'Generation cancelled.'
+    result = {
+        'batch_id': batch_id,
+        'execution_id': execution_id,
+        'current_step': 'Cancelled',
+        'progress': 0,
+        'status': 'cancelled',
+        'refunded': refunded,
+        'message': message
+    }
+    if execution_id:
+        send_progress_update(execution_id, result)
+    return result
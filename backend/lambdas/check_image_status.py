@@ -1,54 +1,56 @@
-import json
-import os
-from google import genai
+import time
+from db_utils import get_db
 from progress_utils import update_batch_progress
+from metrics_utils import track_stage
+from log_utils import get_logger, set_log_context
 
-# Configure Gemini
-gemini_client = genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
+logger = get_logger('check_image_status')
 
+SUCCEEDED_STATES = {'STATE_SUCCEEDED', 'JOB_STATE_SUCCEEDED'}
+FAILED_STATES = {'STATE_FAILED', 'STATE_CANCELLED', 'STATE_EXPIRED',
+                 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+@track_stage('CheckImageStatus')
 def handler(event, context):
     """
-    Step 4: Check status of Gemini batch job
+    Step 4: Park the execution until its Gemini job finishes.
+    Invoked with a task token (waitForTaskToken); gemini_sweeper polls all
+    in-flight jobs in one pass and resumes the execution with the result.
     """
+    batch_id = event['batch_id']
+    execution_id = event.get('execution_id', 'unknown')
+    set_log_context(execution_id=execution_id, batch_id=batch_id)
+
+    conn = None
     try:
-        gemini_batch_id = event['gemini_batch_id']
-        retry_count = event.get('retryCount', 0)
-        batch_id = event['batch_id']
-        execution_id = event.get('execution_id', 'unknown')
-        
-        print(f'🔍 STATUS CHECK: execution_id={execution_id} batch_id={batch_id} retry={retry_count}')
-        
-        # Update progress - show waiting progress based on retry count
-        progress = min(50 + (retry_count * 2), 65)  # Progress from 50% to 65% while waiting
-        update_batch_progress(batch_id, 'CheckImageStatus', progress, execution_id)
-        
-        # Check real batch status
-        print(f'🔄 GEMINI CHECK: job_id={gemini_batch_id} attempt={retry_count + 1}')
-        batch_status = gemini_client.batches.get(name=gemini_batch_id)
-        print(f'📊 STATUS RESULT: {batch_status.state} | execution_id={execution_id}')
-        
-        # Map Gemini states to our states
-        if batch_status.state in ['STATE_SUCCEEDED', 'JOB_STATE_SUCCEEDED']:
-            status = 'completed'
-        elif batch_status.state in ['STATE_FAILED', 'STATE_CANCELLED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED']:
-            status = 'failed'
-        else:
-            status = 'processing'
-        
-        return {
-            **event,
-            'status': status,
-            'retryCount': retry_count,
-            'gemini_state': batch_status.state
-        }
-        
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE gemini_job_requests
+            SET task_token = %s
+            WHERE id = %s
+        ''', (event['task_token'], event['coalesce_request_id']))
+        if cur.rowcount != 1:
+            raise Exception(f"Unknown Gemini job request {event['coalesce_request_id']}")
+        conn.commit()
     except Exception as e:
-        print(f'⚠️ STATUS ERROR: {str(e)} | execution_id={execution_id} batch_id={batch_id} retry={retry_count}')
-        # Don't fail the whole workflow for status check errors
-        # Instead, increment retry and continue
-        return {
-            **event,
-            'status': 'processing',
-            'retryCount': event.get('retryCount', 0) + 1,
-            'error': str(e)
-        }
\ No newline at end of file
+        logger.error('WAIT REGISTER ERROR', error=str(e))
+        if conn:
+            conn.rollback()
+        raise
+
+    wait_elapsed = time.time() - event['gemini_started_at'] if event.get('gemini_started_at') else 0
+    update_batch_progress(batch_id, 'CheckImageStatus', 50, execution_id,
+                          event.get('image_count'), wait_elapsed, event.get('image_model'))
+    logger.info('WAITING FOR GEMINI', coalesce_request_id=event['coalesce_request_id'],
+                gemini_batch_id=event.get('gemini_batch_id'))
+    return {'registered': True}
+
+def map_gemini_state(state):
+    """Our status for a Gemini job state: completed, failed or processing"""
+    state = getattr(state, 'name', state)
+    if state in SUCCEEDED_STATES:
+        return 'completed'
+    if state in FAILED_STATES:
+        return 'failed'
+    return 'processing'
@@ -0,0 +1,64 @@
+"""
+Lazy, memoized SDK clients shared by all lambdas.
+
+SDKs are imported and clients built on first use, so cold starts only pay
+for the clients a code path actually needs. Clients are reused while the
+container stays warm, same as the database connection in db_utils.
+Clients may first be requested from worker threads, so building one is
+serialized (boto3's default session is not thread-safe).
+"""
+import os
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _memoized(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+def set_client(name, client, endpoint_url=None):
+    """Install a client (e.g. a local fake) for anthropic, gemini, connections_table or a boto3 service"""
+    key = name if name in ('anthropic', 'gemini', 'connections_table') else ('boto3', name, endpoint_url)
+    _clients[key] = client
+
+def get_anthropic_client():
+    def factory():
+        from anthropic import Anthropic
+        return Anthropic(api_key=os.environ.get('ANTHROPIC_API_KEY'))
+    return _memoized('anthropic', factory)
+
+def get_gemini_client():
+    def factory():
+        from google import genai
+        return genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
+    return _memoized('gemini', factory)
+
+def get_boto3_client(service_name, endpoint_url=None):
+    def factory():
+        import boto3
+        if endpoint_url:
+            return boto3.client(service_name, endpoint_url=endpoint_url)
+        return boto3.client(service_name)
+    return _memoized(('boto3', service_name, endpoint_url), factory)
+
+def get_s3_client():
+    return get_boto3_client('s3')
+
+def get_rekognition_client():
+    return get_boto3_client('rekognition')
+
+def get_stepfunctions_client():
+    return get_boto3_client('stepfunctions')
+
+def get_connections_table():
+    """DynamoDB table storing WebSocket connections"""
+    def factory():
+        import boto3
+        return boto3.resource('dynamodb').Table(os.environ.get('CONNECTIONS_TABLE', 'websocket-connections'))
+    return _memoized('connections_table', factory)
@@ -0,0 +1,254 @@
+"""
+Cross-execution coalescing of Gemini batch jobs.
+
+StartImageGeneration enqueues each execution's prompt set in
+gemini_job_requests. Once the oldest pending set has waited
+COALESCE_WINDOW_SECONDS (or COALESCE_MAX_PROMPTS are pending), whichever
+execution gets there first packs every pending set into one Gemini job.
+Requests are keyed "<batch_id>:<index>" so ProcessImages can pick its own
+responses back out. A window of 0 submits each prompt set on its own; sets
+still pending are submitted by the scheduled gemini_sweeper.
+
+Prompt sets are claimed under a submission name (the job's display_name)
+and committed before the job is created, so a flush that dies after Gemini
+accepted the job never resubmits it: the sweeper finds the job by name.
+"""
+import json
+import os
+from uuid import uuid4
+from client_utils import get_gemini_client
+from db_utils import get_db
+from metrics_utils import add_metric, time_external
+from log_utils import get_logger
+
+logger = get_logger('coalesce_utils')
+
+IMAGE_MODEL = "gemini-2.5-flash-image"
+COALESCE_WINDOW_SECONDS = int(os.environ.get('COALESCE_WINDOW_SECONDS', 0))
+COALESCE_MAX_PROMPTS = int(os.environ.get('COALESCE_MAX_PROMPTS', 500))
+# Claims older than this (the Lambda maximum) are reconciled against Gemini's job list
+SUBMISSION_STALE_SECONDS = int(os.environ.get('SUBMISSION_STALE_SECONDS', 900))
+SUBMISSION_SCAN_LIMIT = 1000
+
+def build_image_contents(variation):
+    """Gemini request contents for one prompt (shared with the synchronous fast path)"""
+    return [{
+        'parts': [{'text': f'Generate a high-quality image based on this prompt: {variation}'}],
+        'role': 'user'
+    }]
+
+def request_key(batch_id, index):
+    return f"{batch_id}:{index}"
+
+def parse_request_key(key):
+    """(batch_id, index) from a request key; None for anything else"""
+    try:
+        batch_id, index = str(key).split(':')
+        return int(batch_id), int(index)
+    except (TypeError, ValueError):
+        return None
+
+def enqueue_prompts(batch_id, execution_id, prompts, prompt_indices=None):
+    """
+    Queue one execution's prompts for the next Gemini job; returns the request id.
+    prompt_indices gives each prompt's index in the batch when only some are sent.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO gemini_job_requests (batch_id, execution_id, prompt_count, prompts, prompt_indices)
+            VALUES (%s, %s, %s, %s::jsonb, %s::jsonb)
+            RETURNING id
+        ''', (batch_id, execution_id, len(prompts), json.dumps(prompts),
+              json.dumps(prompt_indices) if prompt_indices is not None else None))
+        request_id = cur.fetchone()[0]
+        conn.commit()
+        return request_id
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def flush_pending(force=False):
+    """
+    Submit pending prompt sets as one Gemini job when the window has elapsed,
+    the prompt cap is reached, or force is set. Rows locked or claimed by a
+    concurrent flush are skipped. Returns the new job name, or None if nothing was sent.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT id, batch_id, prompt_count, prompts, EXTRACT(EPOCH FROM NOW() - created_at), prompt_indices
+            FROM gemini_job_requests r
+            WHERE gemini_batch_id IS NULL AND submission_name IS NULL
+              AND EXISTS (SELECT 1 FROM batches b WHERE b.id = r.batch_id AND b.status = 'processing')
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ''', (COALESCE_MAX_PROMPTS,))
+        pending = cur.fetchall()
+
+        # Pack whole prompt sets up to the cap (a single oversized set still goes alone)
+        selected, prompt_total = [], 0
+        for row in pending:
+            if selected and prompt_total + row[2] > COALESCE_MAX_PROMPTS:
+                break
+            selected.append(row)
+            prompt_total += row[2]
+
+        oldest_age = max((float(row[4]) for row in selected), default=0)
+        if not selected or not (force or oldest_age >= COALESCE_WINDOW_SECONDS or prompt_total >= COALESCE_MAX_PROMPTS):
+            conn.rollback()
+            return None
+
+        inline_requests, offsets = [], {}
+        for request_id, batch_id, _, prompts, _, prompt_indices in selected:
+            offsets[request_id] = len(inline_requests)
+            for index, prompt in zip(prompt_indices or range(len(prompts)), prompts):
+                inline_requests.append({
+                    'contents': build_image_contents(prompt),
+                    'metadata': {'key': request_key(batch_id, index)}
+                })
+
+        # Claim before creating the job; from here on only reconcile_submissions releases the rows
+        submission_name = f"image-generation-{selected[0][0]}-{len(selected)}-{uuid4().hex[:8]}"
+        for request_id, _, _, _, _, _ in selected:
+            cur.execute('''
+                UPDATE gemini_job_requests
+                SET submission_name = %s, submitting_at = NOW(), request_offset = %s
+                WHERE id = %s
+            ''', (submission_name, offsets[request_id], request_id))
+        conn.commit()
+
+        try:
+            with time_external('gemini'):
+                batch_job = get_gemini_client().batches.create(
+                    model=IMAGE_MODEL,
+                    src=inline_requests,
+                    config={
+                        'display_name': submission_name,
+                    }
+                )
+        except Exception:
+            # A timed-out create may still have made the job: let the next sweep look it up
+            cur.execute('''
+                UPDATE gemini_job_requests SET submitting_at = NOW() - make_interval(secs => %s)
+                WHERE submission_name = %s
+            ''', (SUBMISSION_STALE_SECONDS, submission_name))
+            conn.commit()
+            raise
+
+        assign_submission(cur, submission_name, batch_job.name)
+        conn.commit()
+
+        add_metric('PromptsSubmitted', len(inline_requests))
+        add_metric('CoalescedRequests', len(selected))
+        logger.info('GEMINI BATCH CREATED', gemini_batch_id=batch_job.name,
+                    requests=len(inline_requests), prompt_sets=len(selected), oldest_wait=round(oldest_age, 1))
+        return batch_job.name
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def try_flush_pending():
+    """
+    flush_pending() from a workflow stage: a failure may belong to other
+    executions' prompt sets too, so it is logged and the sweeper retries
+    """
+    try:
+        flush_pending()
+    except Exception as e:
+        logger.error('FLUSH ERROR', error=str(e))
+
+def drop_pending(batch_id):
+    """Delete a batch's prompt sets not yet in a Gemini job (it was cancelled or refunded)"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('DELETE FROM gemini_job_requests WHERE batch_id = %s AND gemini_batch_id IS NULL', (batch_id,))
+        dropped = cur.rowcount
+        conn.commit()
+        return dropped
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def reconcile_submissions():
+    """
+    Resolve claims whose flush died between claiming and assigning: attach
+    the Gemini job created under the claim's name, or release the prompt
+    sets for the next flush if no such job exists. Returns claims resolved.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT DISTINCT submission_name FROM gemini_job_requests
+            WHERE gemini_batch_id IS NULL AND submission_name IS NOT NULL
+              AND submitting_at < NOW() - make_interval(secs => %s)
+        ''', (SUBMISSION_STALE_SECONDS,))
+        stale = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        if not stale:
+            return 0
+
+        jobs = {}
+        with time_external('gemini'):
+            for scanned, job in enumerate(get_gemini_client().batches.list(config={'page_size': 100})):
+                if scanned >= SUBMISSION_SCAN_LIMIT:
+                    break
+                if job.display_name in stale:
+                    jobs[job.display_name] = job.name
+
+        for submission_name in stale:
+            if submission_name in jobs:
+                assign_submission(cur, submission_name, jobs[submission_name])
+                logger.warning('SUBMISSION RECOVERED', submission_name=submission_name,
+                               gemini_batch_id=jobs[submission_name])
+            else:
+                release_submission(cur, submission_name)
+                logger.warning('SUBMISSION RELEASED', submission_name=submission_name)
+        conn.commit()
+        return len(stale)
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def assign_submission(cur, submission_name, gemini_batch_id):
+    """Point a claim's prompt sets and their batches at the created job (caller commits)"""
+    cur.execute('''
+        UPDATE gemini_job_requests SET gemini_batch_id = %s, submitted_at = NOW()
+        WHERE submission_name = %s AND gemini_batch_id IS NULL
+    ''', (gemini_batch_id, submission_name))
+    cur.execute('''
+        UPDATE batches b SET gemini_batch_id = %s
+        FROM gemini_job_requests r
+        WHERE r.batch_id = b.id AND r.submission_name = %s
+    ''', (gemini_batch_id, submission_name))
+
+def release_submission(cur, submission_name):
+    """Return a claim's prompt sets to pending (caller commits)"""
+    cur.execute('''
+        UPDATE gemini_job_requests SET submission_name = NULL, submitting_at = NULL, request_offset = NULL
+        WHERE submission_name = %s AND gemini_batch_id IS NULL
+    ''', (submission_name,))
+
+def get_assignment(request_id):
+    """(gemini_batch_id, request_offset) for a queued prompt set; (None, None) while pending"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT gemini_batch_id, request_offset FROM gemini_job_requests WHERE id = %s', (request_id,))
+    row = cur.fetchone()
+    conn.commit()
+    if not row:
+        raise Exception(f'Unknown Gemini job request {request_id}')
+    return row[0], row[1]
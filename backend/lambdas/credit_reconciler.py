@@ -0,0 +1,36 @@
+import os
+from credit_utils import find_drift, repair_balance
+from metrics_utils import emit_metrics
+from log_utils import get_logger
+
+logger = get_logger('credit_reconciler')
+
+# report: log and count drift only; repair: also reset balances to the ledger sum
+CREDIT_RECONCILE_MODE = os.environ.get('CREDIT_RECONCILE_MODE', 'report').lower()
+
+def handler(event, context):
+    """
+    Scheduled check that every users.credits equals the sum of its
+    credit_transactions. Drift means a balance was changed outside the ledger.
+    """
+    drifted = find_drift()
+    repaired = 0
+    total_drift = 0.0
+
+    for user_db_id, balance, ledger_sum in drifted:
+        total_drift += abs(float(balance) - float(ledger_sum))
+        logger.warning('CREDIT DRIFT', user_db_id=user_db_id, balance=float(balance), ledger=float(ledger_sum))
+        if CREDIT_RECONCILE_MODE == 'repair':
+            try:
+                if repair_balance(user_db_id):
+                    repaired += 1
+            except Exception as e:
+                logger.error('CREDIT REPAIR ERROR', user_db_id=user_db_id, error=str(e))
+
+    emit_metrics({
+        'CreditDriftUsers': (len(drifted), 'Count'),
+        'CreditDriftAmount': (round(total_drift, 2), 'None'),
+        'CreditBalancesRepaired': (repaired, 'Count')
+    }, {'stage': 'CreditReconciler'})
+    logger.info('RECONCILE COMPLETE', drifted=len(drifted), repaired=repaired, mode=CREDIT_RECONCILE_MODE)
+    return {'drifted': len(drifted), 'repaired': repaired}
@@ -0,0 +1,141 @@
+"""
+Credit ledger: every balance change is a row in the append-only
+credit_transactions table, and users.credits is its materialized sum.
+
+Each operation is a single statement (one round trip, one short lock on the
+users row): the reservation only debits when the balance covers the cost,
+and refunds and top-ups are keyed so a retried refund or a redelivered Stripe
+event is applied once. credit_reconciler checks the balances against the ledger.
+"""
+from db_utils import get_db
+from log_utils import get_logger
+
+logger = get_logger('credit_utils')
+
+def get_balance(cognito_user_id):
+    """Current balance, 0 for users without a row yet"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT credits FROM users WHERE cognito_id = %s', (cognito_user_id,))
+    row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else 0
+
+def refund_key(batch_id, execution_id=None):
+    """Ledger key shared by every refund path, so a batch is refunded at most once"""
+    return f"refund:batch:{batch_id}" if batch_id else f"refund:execution:{execution_id}"
+
+def reserve_batch(cognito_user_id, cost, context_text, exclude_tags, image_count, execution_id=None):
+    """
+    Debit cost and create the processing batch in one statement.
+    Returns (batch_id, user_db_id, balance) or None when credits don't cover the
+    cost or the execution's generation_queue row is already cancelled or finished.
+    The queue row is locked so a concurrent cancel either sees this batch or
+    makes this reservation fail.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            WITH queue AS (
+                SELECT status FROM generation_queue WHERE execution_id = %(execution_id)s FOR SHARE
+            ), debit AS (
+                UPDATE users SET credits = credits - %(cost)s
+                WHERE cognito_id = %(cognito_id)s AND credits >= %(cost)s
+                  AND NOT EXISTS (SELECT 1 FROM queue WHERE status IN ('cancelled', 'finished'))
+                RETURNING id, credits
+            ), batch AS (
+                INSERT INTO batches (user_id, context, exclude_tags, image_count, cost, status, current_step, progress,
+                                     execution_id, created_at, updated_at)
+                SELECT id, %(context)s, %(exclude_tags)s, %(image_count)s, %(cost)s, 'processing', 'ValidateAndSetup', 10,
+                       %(execution_id)s, NOW(), NOW()
+                FROM debit
+                RETURNING id, user_id
+            ), entry AS (
+                INSERT INTO credit_transactions (user_id, batch_id, kind, amount, idempotency_key)
+                SELECT user_id, id, 'reserve', %(debit)s, 'reserve:batch:' || id FROM batch
+            )
+            SELECT batch.id, batch.user_id, debit.credits FROM batch, debit
+        ''', {'cognito_id': cognito_user_id, 'cost': cost, 'debit': -cost, 'context': context_text,
+              'exclude_tags': exclude_tags, 'image_count': image_count, 'execution_id': execution_id})
+        row = cur.fetchone()
+        conn.commit()
+        return row
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def credit_user(cognito_user_id, amount, kind, idempotency_key, batch_id=None, reference=None):
+    """
+    Add amount to the balance exactly once per idempotency_key (refund, topup, adjustment).
+    Returns the new balance, or None if the key was already applied or the user is unknown.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            WITH entry AS (
+                INSERT INTO credit_transactions (user_id, batch_id, kind, amount, idempotency_key, reference)
+                SELECT id, %s, %s, %s, %s, %s FROM users WHERE cognito_id = %s
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING user_id, amount
+            )
+            UPDATE users SET credits = users.credits + entry.amount
+            FROM entry WHERE users.id = entry.user_id
+            RETURNING users.credits
+        ''', (batch_id, kind, amount, idempotency_key, reference, cognito_user_id))
+        row = cur.fetchone()
+        conn.commit()
+        if row is None:
+            logger.info('CREDIT SKIPPED', kind=kind, idempotency_key=idempotency_key)
+            return None
+        return row[0]
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+
+def find_drift(limit=1000):
+    """Users whose balance differs from their ledger sum: (user_id, balance, ledger_sum)"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT u.id, u.credits, COALESCE(t.total, 0)
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, SUM(amount) AS total FROM credit_transactions GROUP BY user_id
+        ) t ON t.user_id = u.id
+        WHERE u.credits <> COALESCE(t.total, 0)
+        ORDER BY u.id
+        LIMIT %s
+    ''', (limit,))
+    rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+def repair_balance(user_db_id):
+    """
+    Reset the materialized balance to the ledger sum; returns (old, new) or None if it already matched.
+    The users row is locked first, so no ledger entry for the user can land between sum and update.
+    """
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('SELECT credits FROM users WHERE id = %s FOR UPDATE', (user_db_id,))
+        balance = cur.fetchone()[0]
+        cur.execute('SELECT COALESCE(SUM(amount), 0) FROM credit_transactions WHERE user_id = %s', (user_db_id,))
+        ledger_sum = cur.fetchone()[0]
+        if balance == ledger_sum:
+            conn.rollback()
+            return None
+        cur.execute('UPDATE users SET credits = %s WHERE id = %s', (ledger_sum, user_db_id))
+        conn.commit()
+        return balance, ledger_sum
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
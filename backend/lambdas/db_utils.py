@@ -1,6 +1,9 @@
 import os
 import psycopg2
 from typing import Optional
+from log_utils import get_logger
+
+logger = get_logger('db_utils')
 
 # Reuse connection for cold start optimization
 _connection = None
@@ -13,7 +16,7 @@ def get_db():
             database=os.environ['DB_NAME'],
             user=os.environ['DB_USER'],
             password=os.environ['DB_PASSWORD'],
-            sslmode='require'
+            sslmode=os.environ.get('DB_SSLMODE', 'require')
         )
     return _connection
 
@@ -31,7 +34,7 @@ def get_user_db_id(cognito_id: str, email: str = '') -> Optional[int]:
                     (cognito_id, email, 0))
         user_db_id = cur.fetchone()[0]
         conn.commit()
-        print(f"Created new user with email: {email}")
+        logger.info('USER CREATED', user_db_id=user_db_id)
         return user_db_id
     else:
         user_db_id, current_email = user
@@ -39,7 +42,7 @@ def get_user_db_id(cognito_id: str, email: str = '') -> Optional[int]:
         if not current_email and email:
             cur.execute('UPDATE users SET email = %s WHERE id = %s', (email, user_db_id))
             conn.commit()
-            print(f"Updated existing user email to: {email}")
+            logger.info('USER EMAIL UPDATED', user_db_id=user_db_id)
         return user_db_id
 
 def get_cognito_user_id(event) -> str:
@@ -69,9 +72,7 @@ def get_cognito_email(event) -> str:
     """Extract email from Cognito claims"""
     # Try authorizer claims first
     try:
-        email = event['requestContext']['authorizer']['claims'].get('email', '')
-        print(f"Extracted email from authorizer claims: {email}")
-        return email
+        return event['requestContext']['authorizer']['claims'].get('email', '')
     except KeyError:
         # Fallback: decode JWT from Authorization header
         import base64
@@ -84,8 +85,6 @@ def get_cognito_email(event) -> str:
             payload += '=' * (4 - len(payload) % 4)
             decoded = base64.b64decode(payload)
             claims = json.loads(decoded)
-            email = claims.get('email', '')
-            print(f"Extracted email from JWT: {email}")
-            return email
+            return claims.get('email', '')
         
         return ''
\ No newline at end of file
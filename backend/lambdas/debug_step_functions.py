@@ -1,6 +1,9 @@
 import json
 import os
-import boto3
+from client_utils import get_stepfunctions_client
+from log_utils import get_logger
+
+logger = get_logger('debug_step_functions')
 from datetime import datetime, timedelta
 from cors_utils import get_cors_headers
 
@@ -11,7 +14,7 @@ def handler(event, context):
     GET /debug/executions/{execution_id} - Get execution details
     """
     try:
-        stepfunctions = boto3.client('stepfunctions')
+        stepfunctions = get_stepfunctions_client()
         
         # Get path and method
         path = event.get('pathParameters', {})
@@ -91,7 +94,7 @@ def handler(event, context):
             }
             
     except Exception as e:
-        print(f'Debug error: {str(e)}')
+        logger.error('DEBUG ERROR', error=str(e))
         return {
             'statusCode': 500,
             'headers': get_cors_headers(),
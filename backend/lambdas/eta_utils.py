@@ -0,0 +1,137 @@
+"""
+Completion-time estimates fitted from batch_stage_timings.
+
+Each stage is modelled as duration_ms = intercept + slope * image_count,
+fitted with PostgreSQL's regr_* aggregates per stage and time-of-day block
+(and per model where it is recorded). Fits are cached in-process for a few
+minutes; stages without enough history fall back to built-in priors.
+"""
+import time
+from datetime import datetime, timezone
+from db_utils import get_db
+from log_utils import get_logger
+
+logger = get_logger('eta_utils')
+
+# Pipeline order; CheckImageStatus progress is reported against GeminiWait
+STAGE_ORDER = [
+    'ValidateAndSetup',
+    'GeneratePrompts',
+    'StartImageGeneration',
+    'GeminiWait',
+    'ProcessImages',
+    'LabelImages',
+    'SaveFinalResults'
+]
+# Small requests skip the batch job and wait loop (generate_images_sync)
+FAST_PATH_STAGE_ORDER = [
+    'ValidateAndSetup',
+    'GeneratePrompts',
+    'GenerateImagesSync',
+    'LabelImages',
+    'SaveFinalResults'
+]
+STEP_TO_STAGE = {'CheckImageStatus': 'GeminiWait'}
+
+# (intercept_ms, ms_per_image) used until enough history exists
+PRIOR_STAGE_MS = {
+    'ValidateAndSetup': (1000, 0),
+    'GeneratePrompts': (4000, 150),
+    'StartImageGeneration': (2000, 20),
+    'GeminiWait': (120000, 3000),
+    'GenerateImagesSync': (10000, 1000),
+    'ProcessImages': (2000, 400),
+    'LabelImages': (1000, 300),
+    'SaveFinalResults': (500, 20)
+}
+
+HOUR_BLOCK_SIZE = 6  # Time-of-day blocks of 6 hours (UTC)
+FIT_WINDOW_DAYS = 30
+MIN_SAMPLES = 20
+FIT_TTL_SECONDS = 600
+
+_fits = {}
+_fitted_at = 0
+
+def load_fits():
+    """
+    Fits keyed (stage,), (stage, model) and (stage, model, hour_block) ->
+    (intercept_ms, slope_ms_per_image)
+    """
+    global _fits, _fitted_at
+    if _fitted_at and time.time() - _fitted_at < FIT_TTL_SECONDS:
+        return _fits
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(f'''
+            SELECT stage, model, hour_block, GROUPING(model, hour_block), COUNT(*),
+                   regr_intercept(duration_ms, image_count),
+                   regr_slope(duration_ms, image_count),
+                   avg(duration_ms)
+            FROM (
+                SELECT stage, model, image_count, duration_ms,
+                       EXTRACT(HOUR FROM started_at)::int / {HOUR_BLOCK_SIZE} AS hour_block
+                FROM batch_stage_timings
+                WHERE started_at >= NOW() - make_interval(days => %s)
+                  AND succeeded = true AND image_count IS NOT NULL
+            ) recent
+            GROUP BY GROUPING SETS ((stage), (stage, model), (stage, model, hour_block))
+        ''', (FIT_WINDOW_DAYS,))
+        fits = {}
+        for stage, model, hour_block, level, count, intercept, slope, mean in cur.fetchall():
+            if count < MIN_SAMPLES:
+                continue
+            if intercept is None or slope is None:
+                # All samples share one image_count: use the mean as a flat estimate
+                intercept, slope = mean, 0
+            key = {0: (stage, model, hour_block), 1: (stage, model)}.get(level, (stage,))
+            fits[key] = (max(float(intercept), 0), max(float(slope), 0))
+        conn.commit()
+        _fits, _fitted_at = fits, time.time()
+    except Exception as e:
+        logger.error('ETA FIT ERROR', error=str(e))
+        if conn:
+            conn.rollback()
+        _fitted_at = time.time()  # Don't hammer the DB while it is failing
+    return _fits
+
+def predict_stage_ms(stage, image_count, model=None, hour=None):
+    """Predicted duration of one stage, most specific fit first"""
+    fits = load_fits()
+    hour = datetime.now(timezone.utc).hour if hour is None else hour
+    hour_block = hour // HOUR_BLOCK_SIZE
+    for key in ((stage, model, hour_block), (stage, model), (stage,)):
+        if key in fits:
+            intercept, slope = fits[key]
+            return intercept + slope * (image_count or 0)
+    intercept, slope = PRIOR_STAGE_MS.get(stage, (0, 0))
+    return intercept + slope * (image_count or 0)
+
+def estimate_progress(current_step, image_count, stage_elapsed_seconds=0, model=None, fast_path=False):
+    """
+    Calibrated progress for a pipeline step: percentage of predicted total
+    work done, seconds remaining and the estimated completion time (UTC ISO).
+    """
+    stage_order = FAST_PATH_STAGE_ORDER if fast_path else STAGE_ORDER
+    stage = STEP_TO_STAGE.get(current_step, current_step)
+    if stage not in stage_order:
+        return None
+
+    predictions = [predict_stage_ms(s, image_count, model) for s in stage_order]
+    index = stage_order.index(stage)
+    stage_done_ms = min(stage_elapsed_seconds * 1000, predictions[index])
+    done_ms = sum(predictions[:index]) + stage_done_ms
+
+    # An overrunning stage still has a little left, so the ETA never hits zero early
+    stage_remaining_ms = max(predictions[index] - stage_elapsed_seconds * 1000, predictions[index] * 0.1)
+    remaining_ms = stage_remaining_ms + sum(predictions[index + 1:])
+    total_ms = done_ms + remaining_ms
+
+    return {
+        'progress': max(1, min(99, int(100 * done_ms / total_ms))) if total_ms else 0,
+        'eta_seconds': int(remaining_ms / 1000),
+        'estimated_completion': datetime.fromtimestamp(time.time() + remaining_ms / 1000, timezone.utc).isoformat(),
+        'stage_remaining_seconds': int(stage_remaining_ms / 1000)
+    }
@@ -1,6 +1,5 @@
 import json
 import os
-import boto3
 import zipfile
 import tempfile
 from datetime import datetime
@@ -8,8 +7,11 @@ from uuid import uuid4
 import requests
 from db_utils import get_db, get_cognito_user_id, get_user_db_id
 from cors_utils import get_cors_headers
+from client_utils import get_s3_client
+from image_metadata_utils import image_metadata, file_extension
+from log_utils import get_logger
 
-s3 = boto3.client('s3')
+logger = get_logger('export')
 
 def handler(event, context):
     try:
@@ -54,10 +56,10 @@ def get_selected_images(cognito_user_id):
     cur = conn.cursor()
     
     cur.execute('''
-        SELECT i.id, i.prompt, i.url, i.tags
+        SELECT i.id, i.prompt, i.url, i.tags, i.width, i.height, i.mime_type
         FROM images i
         JOIN batches b ON i.batch_id = b.id
-        WHERE b.user_id = %s AND i.selected = true
+        WHERE b.user_id = %s AND i.validated = true AND NOT i.near_duplicate
         ORDER BY i.created_at
     ''', (user_db_id,))
     
@@ -66,48 +68,45 @@ def get_selected_images(cognito_user_id):
             'id': row[0],
             'prompt': row[1],
             'url': row[2],
-            'tags': json.loads(row[3]) if row[3] else []
+            'tags': json.loads(row[3]) if row[3] else [],
+            'width': row[4],
+            'height': row[5],
+            'mime_type': row[6]
         }
         for row in cur.fetchall()
     ]
 
 def create_export_zip(images, export_format, cognito_user_id):
     bucket = os.environ['S3_BUCKET']
+    s3 = get_s3_client()
     export_key = f"exports/{cognito_user_id}/{uuid4().hex}_{export_format}.zip"
     
     with tempfile.TemporaryDirectory() as temp_dir:
         zip_path = os.path.join(temp_dir, 'export.zip')
         
         with zipfile.ZipFile(zip_path, 'w') as zip_file:
-            # Create annotations based on format
-            if export_format == 'coco':
-                annotations = create_coco_annotations(images)
-                zip_file.writestr('annotations.json', json.dumps(annotations, indent=2))
-            elif export_format == 'yolo':
-                create_yolo_annotations(images, zip_file)
-            
             # Download and add images to zip
             for i, image in enumerate(images):
                 try:
                     # Download image from URL
                     response = requests.get(image['url'], timeout=30)
                     if response.status_code == 200:
-                        # Determine file extension
-                        ext = 'jpg'
-                        if 'image/png' in response.headers.get('content-type', ''):
-                            ext = 'png'
-                        
-                        filename = f"image_{i+1:04d}.{ext}"
-                        zip_file.writestr(f"images/{filename}", response.content)
-                        
-                        # Update image reference in annotations
-                        if export_format == 'yolo':
-                            # YOLO annotations already created with correct filenames
-                            pass
+                        if not image.get('mime_type'):
+                            # Saved before metadata was recorded at ingest: read the downloaded header
+                            image.update({key: value for key, value in image_metadata(response.content).items()
+                                          if key in ('width', 'height', 'mime_type')})
+                        zip_file.writestr(f"images/{image_filename(i, image)}", response.content)
                         
                 except Exception as e:
-                    print(f"Failed to download image {image['url']}: {str(e)}")
+                    logger.warning('IMAGE DOWNLOAD FAILED', image_id=image['id'], error=str(e))
                     continue
+            
+            # Create annotations based on format
+            if export_format == 'coco':
+                annotations = create_coco_annotations(images)
+                zip_file.writestr('annotations.json', json.dumps(annotations, indent=2))
+            elif export_format == 'yolo':
+                create_yolo_annotations(images, zip_file)
         
         # Upload zip to S3
         with open(zip_path, 'rb') as zip_data:
@@ -125,6 +124,10 @@ def create_export_zip(images, export_format, cognito_user_id):
         ExpiresIn=3600  # 1 hour
     )
 
+def image_filename(i, image):
+    """Name of the i-th exported image, with the extension of its stored format"""
+    return f"image_{i+1:04d}.{file_extension(image.get('mime_type'))}"
+
 def create_coco_annotations(images):
     """Create COCO format annotations"""
     coco_format = {
@@ -161,12 +164,13 @@ def create_coco_annotations(images):
     # Create image and annotation entries
     annotation_id = 1
     for i, image in enumerate(images):
+        width, height = image.get('width') or 0, image.get('height') or 0
         # Image entry
         image_entry = {
             "id": i + 1,
-            "width": 400,  # Default size, could be dynamic
-            "height": 300,
-            "file_name": f"image_{i+1:04d}.jpg",
+            "width": width,
+            "height": height,
+            "file_name": image_filename(i, image),
             "license": 1,
             "date_captured": datetime.now().isoformat()
         }
@@ -180,8 +184,8 @@ def create_coco_annotations(images):
                     "id": annotation_id,
                     "image_id": i + 1,
                     "category_id": category_id,
-                    "bbox": [0, 0, 400, 300],  # Full image bbox clem
-                    "area": 400 * 300,
+                    "bbox": [0, 0, width, height],  # Full image bbox
+                    "area": width * height,
                     "iscrowd": 0
                 }
                 coco_format["annotations"].append(annotation)
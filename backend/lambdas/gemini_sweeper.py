@@ -0,0 +1,138 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from client_utils import get_gemini_client, get_stepfunctions_client
+from db_utils import get_db
+from coalesce_utils import IMAGE_MODEL, flush_pending, reconcile_submissions
+from check_image_status import map_gemini_state
+from progress_utils import update_batch_progress
+from stage_timing_utils import record_stage_timing
+from metrics_utils import emit_metrics
+from profiling_utils import profile_handler
+from log_utils import get_logger
+
+logger = get_logger('gemini_sweeper')
+
+SWEEP_MAX_WORKERS = int(os.environ.get('SWEEP_MAX_WORKERS', 8))
+
+@profile_handler('GeminiSweeper')
+def handler(event, context):
+    """
+    Scheduled sweep of every in-flight Gemini job. Submits the coalescing
+    queue if it is due, polls each distinct gemini_batch_id once and resumes
+    the executions waiting on finished jobs through their task tokens, so
+    poll traffic scales with time rather than with executions.
+    """
+    started = time.perf_counter()
+    try:
+        reconcile_submissions()
+    except Exception as e:
+        logger.error('RECONCILE ERROR', error=str(e))
+    try:
+        while flush_pending():
+            pass
+    except Exception as e:
+        logger.error('FLUSH ERROR', error=str(e))
+
+    waiting = load_waiting_requests()
+    jobs = sorted({row['gemini_batch_id'] for row in waiting if row['gemini_batch_id']})
+    states = poll_jobs(jobs)
+
+    resumed = 0
+    for row in waiting:
+        state = states.get(row['gemini_batch_id'])
+        status = map_gemini_state(state) if state else 'processing'
+        if status == 'processing':
+            update_batch_progress(row['batch_id'], 'CheckImageStatus', 50, row['execution_id'],
+                                  row['image_count'], time.time() - row['queued_at'], IMAGE_MODEL)
+            continue
+        if resume_execution(row, status, getattr(state, 'name', state)):
+            resumed += 1
+
+    emit_metrics({
+        'JobsPolled': (len(jobs), 'Count'),
+        'ExecutionsWaiting': (len(waiting), 'Count'),
+        'ExecutionsResumed': (resumed, 'Count'),
+        'SweepDuration': (round((time.perf_counter() - started) * 1000, 2), 'Milliseconds')
+    }, {'stage': 'GeminiSweeper'})
+    logger.info('SWEEP COMPLETE', jobs=len(jobs), waiting=len(waiting), resumed=resumed)
+    return {'jobs': len(jobs), 'waiting': len(waiting), 'resumed': resumed}
+
+def load_waiting_requests():
+    """Parked executions of in-flight batches, with their (possibly shared) Gemini job"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT r.id, r.batch_id, r.execution_id, r.task_token, r.gemini_batch_id, r.request_offset,
+               b.image_count, EXTRACT(EPOCH FROM r.created_at)
+        FROM batches b
+        JOIN gemini_job_requests r ON r.batch_id = b.id
+        WHERE b.status = 'processing'
+          AND r.gemini_batch_id IS NOT NULL
+          AND r.task_token IS NOT NULL
+          AND r.resumed_at IS NULL
+    ''')
+    rows = cur.fetchall()
+    conn.commit()
+    return [
+        {
+            'id': row[0], 'batch_id': row[1], 'execution_id': row[2], 'task_token': row[3],
+            'gemini_batch_id': row[4], 'request_offset': row[5], 'image_count': row[6],
+            'queued_at': float(row[7])
+        }
+        for row in rows
+    ]
+
+def poll_jobs(job_names):
+    """gemini_batch_id -> job state; jobs whose status call fails are left out"""
+    def get_state(name):
+        try:
+            return name, get_gemini_client().batches.get(name=name).state
+        except Exception as e:
+            logger.warning('STATUS ERROR', gemini_batch_id=name, error=str(e))
+            return name, None
+
+    if not job_names:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(SWEEP_MAX_WORKERS, len(job_names))) as executor:
+        return {name: state for name, state in executor.map(get_state, job_names) if state is not None}
+
+def resume_execution(row, status, gemini_state):
+    """Send the job result to a parked execution; the token is cleared so it is only sent once"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE gemini_job_requests SET resumed_at = NOW()
+            WHERE id = %s AND resumed_at IS NULL
+        ''', (row['id'],))
+        if cur.rowcount != 1:
+            conn.rollback()
+            return False
+
+        output = {
+            'status': status,
+            'gemini_state': str(gemini_state),
+            'gemini_batch_id': row['gemini_batch_id'],
+            'request_offset': row['request_offset']
+        }
+        stepfunctions = get_stepfunctions_client()
+        try:
+            stepfunctions.send_task_success(taskToken=row['task_token'], output=json.dumps(output))
+        except (stepfunctions.exceptions.TaskDoesNotExist, stepfunctions.exceptions.TaskTimedOut,
+                stepfunctions.exceptions.InvalidToken) as e:
+            # The execution already gave up; other errors roll back so the next sweep retries
+            logger.warning('RESUME FAILED', batch_id=row['batch_id'], error=str(e))
+        conn.commit()
+
+        record_stage_timing(row['batch_id'], row['execution_id'], 'GeminiWait', row['image_count'],
+                            row['queued_at'], time.time(), status == 'completed', IMAGE_MODEL)
+        logger.info('EXECUTION RESUMED', batch_id=row['batch_id'], status=status)
+        return True
+    except Exception as e:
+        logger.error('RESUME ERROR', batch_id=row['batch_id'], error=str(e))
+        if conn:
+            conn.rollback()
+        return False
@@ -1,9 +1,14 @@
 import json
-import os
 import time
-import boto3
-from db_utils import get_cognito_user_id, get_db, get_user_db_id, get_cognito_email
+import uuid
+from db_utils import get_cognito_user_id
+from credit_utils import get_balance
 from cors_utils import get_cors_headers
+from admission_utils import submit_execution, get_queue_status
+from idempotency_utils import request_hash, resolve_key, get_claim
+from log_utils import get_logger, set_log_context
+
+logger = get_logger('generate')
 
 def cors_response(status_code, body):
     """Helper function to create response with CORS headers"""
@@ -13,6 +18,17 @@ def cors_response(status_code, body):
         'body': json.dumps(body)
     }
 
+def duplicate_response(execution_id, status, queue_position, cost):
+    """Response for a retried request: the original execution, nothing new started or charged"""
+    return cors_response(200, {
+        'execution_id': execution_id,
+        'status': {'running': 'processing', 'finished': 'completed'}.get(status, status),
+        'queue_position': queue_position,
+        'duplicate': True,
+        'message': 'Request already received',
+        'estimated_cost': cost
+    })
+
 def handler(event, context):
     """
     Main handler: Start Step Functions workflow for image generation
@@ -21,71 +37,90 @@ def handler(event, context):
     if event.get('httpMethod') == 'OPTIONS':
         return cors_response(200, {})
     
+    set_log_context(request_id=getattr(context, 'aws_request_id', None))
+    
     try:
-        print(f'Event: {event}')
         body = event['body'] if isinstance(event['body'], dict) else json.loads(event['body'])
         context_text = body['context']
         exclude_tags = body.get('exclude_tags', '')
         image_count = body.get('image_count', 10)
+        fresh_prompts = bool(body.get('fresh_prompts', False))
         cognito_user_id = get_cognito_user_id(event)
-        print(f'🚀 GENERATE START: context="{context_text[:50]}..." images={image_count} user={cognito_user_id}')
+        logger.info('GENERATE START', context=context_text[:50], images=image_count, user=cognito_user_id)
         
         # Basic validation
         if not isinstance(image_count, int) or image_count < 1 or image_count > 100:
-            print(f'❌ VALIDATION ERROR: Invalid image count {image_count}')
+            logger.warning('VALIDATION ERROR', reason='invalid image count', images=image_count)
             return cors_response(400, {'error': 'Image count must be between 10 and 100'})
         
-        # Calculate cost and check user credits before starting workflow
-        cost = image_count * 0.05
-        print(f'💰 COST CHECK: ${cost:.2f} required for {image_count} images')
-        
-        email = get_cognito_email(event)
-        user_db_id = get_user_db_id(cognito_user_id, email)
-        print(f'👤 USER LOOKUP: email={email} db_id={user_db_id}')
+        # A retry of an earlier request gets the original execution back, before the
+        # credit check (the original may already have spent the balance)
+        payload_hash = request_hash({'context': context_text, 'exclude_tags': exclude_tags,
+                                     'image_count': image_count, 'fresh_prompts': fresh_prompts})
+        try:
+            idempotency_key, ttl_seconds = resolve_key(event, cognito_user_id, payload_hash)
+        except ValueError as e:
+            return cors_response(400, {'error': str(e)})
         
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT credits FROM users WHERE id = %s', (user_db_id,))
-        user_result = cur.fetchone()
+        cost = image_count * 0.05
+        claim = get_claim(idempotency_key)
+        if claim and claim[1] != payload_hash:
+            return cors_response(422, {'error': 'Idempotency-Key was already used for a different request'})
+        if claim:
+            queue_status = get_queue_status(claim[0])
+            if queue_status['status'] != 'failed':
+                logger.info('DUPLICATE REQUEST', execution_id=claim[0])
+                return duplicate_response(claim[0], queue_status['status'], queue_status['queue_position'], cost)
         
-        if not user_result:
-            print(f'❌ USER ERROR: User not found in database db_id={user_db_id}')
-            return cors_response(404, {'error': 'User not found'})
-            
-        user_credits = user_result[0]
-        print(f'💳 CREDITS: user has ${user_credits:.2f}, needs ${cost:.2f}')
+        # Check user credits before starting workflow. This is only a
+        # fast rejection: ValidateAndSetup reserves the credits atomically (credit_utils)
+        user_credits = get_balance(cognito_user_id)
         
         if user_credits < cost:
-            print(f'❌ INSUFFICIENT CREDITS: need ${cost:.2f} but have ${user_credits:.2f}')
+            logger.info('INSUFFICIENT CREDITS', cost=cost, credits=float(user_credits))
             return cors_response(402, {
                 'error': f'Insufficient credits. Need ${cost:.2f} but you have ${user_credits:.2f}',
                 'required': cost,
                 'available': float(user_credits)
             })
         
-        # Start Step Functions workflow
-        stepfunctions = boto3.client('stepfunctions')
-        state_machine_arn = os.environ.get('STATE_MACHINE_ARN')
-        
         workflow_input = {
             'context': context_text,
             'exclude_tags': exclude_tags,
             'image_count': image_count,
+            'fresh_prompts': fresh_prompts,
             'cognito_user_id': cognito_user_id
         }
         
-        execution_name = f"image-generation-{cognito_user_id}-{int(time.time())}"
+        # Suffix keeps names unique when one user submits several requests within a second
+        execution_name = f"image-generation-{cognito_user_id}-{int(time.time())}-{uuid.uuid4().hex[:8]}"
         
         # Add execution_id to workflow input
         workflow_input['execution_id'] = execution_name
         
-        execution = stepfunctions.start_execution(
-            stateMachineArn=state_machine_arn,
-            name=execution_name,
-            input=json.dumps(workflow_input)
-        )
+        # Start the Step Functions workflow now, or queue it behind the admission limits
+        admission = submit_execution(execution_name, cognito_user_id, workflow_input,
+                                     idempotency_key, payload_hash, ttl_seconds)
+        
+        if admission['duplicate']:
+            if admission['request_hash'] != payload_hash:
+                return cors_response(422, {'error': 'Idempotency-Key was already used for a different request'})
+            return duplicate_response(admission['execution_id'], admission['status'], admission['queue_position'], cost)
+        
+        if admission['status'] == 'failed':
+            return cors_response(503, {'error': 'Could not start image generation, please try again'})
+        
+        if admission['status'] == 'queued':
+            logger.info('GENERATION QUEUED', execution_id=execution_name, position=admission['queue_position'])
+            return cors_response(202, {
+                'execution_id': execution_name,
+                'status': 'queued',
+                'queue_position': admission['queue_position'],
+                'message': f"Image generation queued at position {admission['queue_position']}",
+                'estimated_cost': cost
+            })
         
-        print(f'✅ STEP FUNCTIONS STARTED: execution_id={execution_name}')
+        logger.info('STEP FUNCTIONS STARTED', execution_id=execution_name, images=image_count, cost=cost)
         
         return cors_response(202, {
             'execution_id': execution_name,
@@ -95,6 +130,6 @@ def handler(event, context):
         })
         
     except Exception as e:
-        print(f'❌ GENERATE ERROR: {str(e)} | user={cognito_user_id} images={image_count}')
+        logger.error('GENERATE ERROR', error=str(e))
         return cors_response(500, {'error': str(e)})
 
@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from client_utils import get_gemini_client, get_s3_client
+from progress_utils import update_batch_progress
+from coalesce_utils import IMAGE_MODEL, build_image_contents
+from process_images import store_generated_image, checkpoint_images, load_checkpoint, save_checkpoint, repair_fields
+from metrics_utils import track_stage, add_metric, time_external
+from log_utils import get_logger, set_log_context
+
+logger = get_logger('generate_images_sync')
+
+SYNC_MAX_WORKERS = int(os.environ.get('SYNC_MAX_WORKERS', 5))
+SYNC_ATTEMPTS = 2
+
+@track_stage('GenerateImagesSync')
+def handler(event, context):
+    """
+    Fast path for small requests: generate images with concurrent synchronous
+    Gemini calls instead of a batch job, then hand the same image list
+    ProcessImages produces to LabelImages (via RepairImages if some are missing)
+    """
+    try:
+        variations = event['variations']
+        batch_id = event['batch_id']
+        cognito_user_id = event['cognito_user_id']
+        bucket = os.environ.get('S3_BUCKET')
+        execution_id = event.get('execution_id', 'unknown')
+        s3_client = get_s3_client()
+
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('SYNC GENERATION START', prompts=len(variations))
+
+        update_batch_progress(batch_id, 'GenerateImagesSync', 30, execution_id, len(variations),
+                              model=IMAGE_MODEL, fast_path=True)
+
+        generated = generate_and_store_images(range(len(variations)), variations, batch_id,
+                                              cognito_user_id, bucket, s3_client)
+        stored = load_checkpoint(batch_id)
+        repair = repair_fields(stored, len(variations), event.get('repair_attempt', 0))
+
+        logger.info('SYNC GENERATION COMPLETE', images=generated, prompts=len(variations))
+        add_metric('PromptsSubmitted', len(variations))
+        add_metric('ImagesProcessed', generated)
+
+        images, images_labeled = checkpoint_images(batch_id, variations, s3_client, bucket, cognito_user_id)
+        return {
+            **event,
+            **repair,
+            'image_model': IMAGE_MODEL,
+            'status': 'completed',
+            'images_labeled': images_labeled,
+            'images': images
+        }
+
+    except Exception as e:
+        logger.error('SYNC GENERATION ERROR', error=str(e))
+        raise Exception(f'Failed to generate images: {str(e)}')
+
+def generate_and_store_images(indices, variations, batch_id, cognito_user_id, bucket, s3_client):
+    """Generate, upload and checkpoint the given prompt indices concurrently; returns how many were stored"""
+    indices = list(indices)
+
+    def generate_and_store(index):
+        response = generate_image(variations[index])
+        return store_generated_image(response, index, variations[index], cognito_user_id, batch_id, bucket, s3_client)
+
+    stored = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(SYNC_MAX_WORKERS, len(indices)))) as executor:
+        futures = {i: executor.submit(generate_and_store, i) for i in indices}
+        for i, future in futures.items():
+            try:
+                image = future.result()
+                if image:
+                    # Checkpoint on this thread: the DB connection is shared
+                    save_checkpoint(batch_id, i, image['s3_key'], image_hash=image['phash'], metadata=image)
+                    stored += 1
+                else:
+                    logger.warning('NO IMAGE DATA', index=i, prompt=variations[i][:30])
+                    add_metric('MissingImages', 1)
+            except Exception as e:
+                logger.error('IMAGE ERROR', index=i, error=str(e))
+                add_metric('ImageErrors', 1)
+    return stored
+
+def generate_image(variation):
+    """One synchronous Gemini image request, retried once on API errors"""
+    for attempt in range(SYNC_ATTEMPTS):
+        try:
+            with time_external('gemini'):
+                return get_gemini_client().models.generate_content(
+                    model=IMAGE_MODEL,
+                    contents=build_image_contents(variation)
+                )
+        except Exception as e:
+            add_metric('ExternalApiErrors', 1)
+            if attempt == SYNC_ATTEMPTS - 1:
+                raise
+            logger.warning('SYNC REQUEST RETRY', attempt=attempt + 1, error=str(e))
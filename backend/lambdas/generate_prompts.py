@@ -1,11 +1,45 @@
 import json
 import os
-from anthropic import Anthropic
+import random
+from concurrent.futures import ThreadPoolExecutor
+from client_utils import get_anthropic_client
+from db_utils import get_db
 from progress_utils import update_batch_progress
+from metrics_utils import track_stage, add_metric, time_external
+from log_utils import get_logger, set_log_context
+from prompt_cache import prompt_cache_key, load_prompt_pool, store_prompt_pool
+from similarity_utils import find_near_duplicates, diversity_score
 
-# Initialize Anthropic client
-anthropic_client = Anthropic(api_key=os.environ.get('ANTHROPIC_API_KEY'))
+logger = get_logger('generate_prompts')
 
+PROMPT_MODEL = "claude-3-5-haiku-20241022"
+PROMPT_TEMPLATE_VERSION = 1  # Bump when build_prompt_request changes to invalidate cached pools
+PROMPT_CHUNK_SIZE = int(os.environ.get('PROMPT_CHUNK_SIZE', '25'))
+PROMPT_MAX_WORKERS = int(os.environ.get('PROMPT_MAX_WORKERS', '8'))
+MAX_PROMPT_ROUNDS = 3  # Initial request plus top-ups for missing prompts
+MAX_PROMPT_WORDS = 50
+PROMPT_AVOID_LIMIT = 50  # Existing prompts shown to Claude when topping up
+PROMPT_SIMILARITY_THRESHOLD = float(os.environ.get('PROMPT_SIMILARITY_THRESHOLD', '0.5'))
+MAX_DIVERSITY_ROUNDS = 2  # Re-generation passes for near-duplicate prompts
+
+# Structured output: Claude must return prompts through this tool's schema
+PROMPT_TOOL = {
+    'name': 'submit_prompts',
+    'description': 'Submit the generated image prompts',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'prompts': {
+                'type': 'array',
+                'items': {'type': 'string'},
+                'description': 'One complete image prompt per item'
+            }
+        },
+        'required': ['prompts']
+    }
+}
+
+@track_stage('GeneratePrompts')
 def handler(event, context):
     """
     Step 2: Generate image prompts using Claude
@@ -17,67 +51,198 @@ def handler(event, context):
         batch_id = event['batch_id']
         execution_id = event.get('execution_id', 'unknown')
         
-        print(f'🎯 PROMPTS START: execution_id={execution_id} batch_id={batch_id} count={image_count}')
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('PROMPTS START', count=image_count)
         
         # Update progress in database
-        update_batch_progress(batch_id, 'GeneratePrompts', 20, execution_id)
+        update_batch_progress(batch_id, 'GeneratePrompts', 20, execution_id, image_count,
+                              fast_path=event.get('generation_mode') == 'sync')
         
-        # Generate variations
-        print(f'🤖 CALLING CLAUDE: context="{context_text[:30]}..." exclude="{exclude_tags}" count={image_count}')
-        variations = generate_variations(context_text, exclude_tags, image_count)
+        # Generate variations, reusing a cached prompt pool for repeated contexts
+        variations = get_or_generate_variations(context_text, exclude_tags, image_count, event.get('fresh_prompts', False))
+        prompt_diversity = diversity_score(variations)
+        save_prompt_diversity(batch_id, prompt_diversity)
         
-        print(f'✅ PROMPTS GENERATED: {len(variations)} variations created')
+        logger.info('PROMPTS GENERATED', count=len(variations), diversity=prompt_diversity)
         
         # Return updated event with variations
         return {
             **event,  # Pass through all previous data
-            'variations': variations
+            'variations': variations,
+            'prompt_diversity': prompt_diversity
         }
         
     except Exception as e:
-        print(f'❌ PROMPTS ERROR: {str(e)} | execution_id={execution_id} batch_id={batch_id}')
+        logger.error('PROMPTS ERROR', error=str(e))
         raise Exception(f'Prompt generation failed: {str(e)}')
 
-def generate_variations(context, exclude_tags, count):
-    """Generate image prompt variations using Claude"""
+def get_or_generate_variations(context, exclude_tags, count, fresh=False):
+    """
+    Serve prompts from the cached pool for this context, topping it up with
+    Claude when it holds fewer than count prompts. fresh=True ignores the pool.
+    """
+    cache_key = prompt_cache_key(context, exclude_tags, PROMPT_MODEL, PROMPT_TEMPLATE_VERSION)
+    pool = [] if fresh else load_prompt_pool(cache_key)
+    
+    if len(pool) >= count:
+        logger.info('PROMPT CACHE HIT', cache_key=cache_key[:12], pool=len(pool), count=count)
+        add_metric('PromptCacheHits', 1)
+        return random.sample(pool, count)
+    
+    logger.info('PROMPT CACHE MISS', cache_key=cache_key[:12], pool=len(pool), count=count)
+    add_metric('PromptCacheMisses', 1)
+    new_variations = generate_variations(context, exclude_tags, count - len(pool), existing=pool)
+    
+    # Replace near-duplicate prompts so we don't pay for near-identical images
+    variations = diversify_variations(context, exclude_tags, pool + new_variations)
+    
+    fallback_prefix = f"{context} - variation "
+    store_prompt_pool(cache_key, context, exclude_tags, PROMPT_MODEL, PROMPT_TEMPLATE_VERSION,
+                      [p for p in variations if not p.startswith(fallback_prefix)])
+    
+    # Serve the newly generated prompts first so a top-up still yields fresh scenes
+    return (variations[len(pool):] + variations[:len(pool)])[:count]
+
+def generate_variations(context, exclude_tags, count, existing=None):
+    """
+    Generate image prompt variations using Claude.
+
+    Large counts are split into chunks requested concurrently, so latency is
+    bounded by a single chunk. Each round only asks for the prompts still
+    missing after validation and merging. Prompts in existing are avoided.
+    """
+    existing = existing or []
+    variations = []
+    
+    for round_number in range(MAX_PROMPT_ROUNDS):
+        missing = count - len(variations)
+        if missing <= 0:
+            break
+        
+        chunk_sizes = split_into_chunks(missing, PROMPT_CHUNK_SIZE)
+        logger.info('PROMPT ROUND', round=round_number + 1, missing=missing, chunks=len(chunk_sizes))
+        
+        with ThreadPoolExecutor(max_workers=min(PROMPT_MAX_WORKERS, len(chunk_sizes))) as executor:
+            futures = [
+                executor.submit(request_prompt_chunk, context, exclude_tags, size, index, len(chunk_sizes), existing + variations)
+                for index, size in enumerate(chunk_sizes)
+            ]
+            for future in futures:
+                try:
+                    variations = merge_prompts(existing + variations, future.result())[len(existing):]
+                except Exception as e:
+                    logger.error('CLAUDE API ERROR', error=str(e))
+                    add_metric('ExternalApiErrors', 1)
+    
+    if len(variations) < count:
+        logger.warning('PROMPT SHORTFALL', padded=count - len(variations))
+    
+    # Ensure we have the right count
+    while len(variations) < count:
+        variations.append(f"{context} - variation {len(variations) + 1}")
+    
+    return variations[:count]
+
+def diversify_variations(context, exclude_tags, variations):
+    """Ask Claude to replace only the prompts flagged as near-duplicates"""
+    variations = list(variations)
+    
+    for round_number in range(MAX_DIVERSITY_ROUNDS):
+        duplicates = find_near_duplicates(variations, PROMPT_SIMILARITY_THRESHOLD)
+        if not duplicates:
+            break
+        
+        logger.info('DIVERSITY ROUND', round=round_number + 1, duplicates=len(duplicates))
+        duplicate_set = set(duplicates)
+        kept = [p for i, p in enumerate(variations) if i not in duplicate_set]
+        try:
+            replacements = request_prompt_chunk(context, exclude_tags, len(duplicates), avoid=kept)
+        except Exception as e:
+            logger.error('CLAUDE API ERROR', error=str(e))
+            break
+        
+        for index, replacement in zip(duplicates, replacements):
+            variations[index] = replacement
+    
+    return variations
+
+def save_prompt_diversity(batch_id, prompt_diversity):
+    """Store the prompt diversity score with the batch"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('UPDATE batches SET prompt_diversity = %s WHERE id = %s', (prompt_diversity, batch_id))
+        conn.commit()
+    except Exception as e:
+        logger.error('SAVE DIVERSITY ERROR', error=str(e))
+        if conn:
+            conn.rollback()
+
+def split_into_chunks(count, chunk_size):
+    """Split a prompt count into chunk sizes of at most chunk_size"""
+    return [min(chunk_size, count - start) for start in range(0, count, chunk_size)]
+
+def build_prompt_request(context, exclude_tags, count, chunk_index=0, chunk_total=1, avoid=None):
+    """Build the Claude instruction for one chunk of prompts"""
     prompt = f"""Generate exactly {count} diverse, realistic image prompts based on: "{context}"
 
 Rules:
 - Each prompt should be a complete, detailed scene description
 - Exclude these elements: {exclude_tags}
-- Keep each prompt under 50 words
+- Keep each prompt under {MAX_PROMPT_WORDS} words
 - Make them diverse but thematically related to the original context
 - They should be suitable for generating high-quality images
 - Scene is always photo realistic with natural lighting
 - Include a variety of perspectives and compositions
 - Use dynamic angles and framing, realistic motion to enhance visual interest
 - Situations can be indoors or outdoors, day or night, urban or nature
-- Separate each prompt with a semicolon (;)
-- Do not number them or add extra formatting
-- Return only the prompts separated by semicolons
-
-Example format: "prompt 1; prompt 2; prompt 3"
+- Return the prompts with the {PROMPT_TOOL['name']} tool
 """
-    
-    try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-haiku-20241022",
-            max_tokens=2000,
-            messages=[{"role": "user", "content": prompt}]
+    if chunk_total > 1:
+        prompt += f"\nThis is set {chunk_index + 1} of {chunk_total} requested in parallel, so favour scenes other sets are unlikely to pick.\n"
+    if avoid:
+        listed = '\n'.join(f'- {p}' for p in avoid[-PROMPT_AVOID_LIMIT:])
+        prompt += f"\nDo not repeat or closely paraphrase these existing prompts:\n{listed}\n"
+    return prompt
+
+def request_prompt_chunk(context, exclude_tags, count, chunk_index=0, chunk_total=1, avoid=None):
+    """Request one chunk of prompts from Claude as structured tool output"""
+    with time_external('anthropic'):
+        response = get_anthropic_client().messages.create(
+            model=PROMPT_MODEL,
+            max_tokens=min(4096, 200 + count * 120),
+            tools=[PROMPT_TOOL],
+            tool_choice={'type': 'tool', 'name': PROMPT_TOOL['name']},
+            messages=[{"role": "user", "content": build_prompt_request(context, exclude_tags, count, chunk_index, chunk_total, avoid)}]
         )
-        
-        print(f"Claude response: {response}")
-        variations_text = response.content[0].text.strip()
-        variations = [v.strip() for v in variations_text.split(';') if v.strip()]
-        
-        # Ensure we have the right count
-        while len(variations) < count:
-            variations.append(f"{context} - variation {len(variations) + 1}")
-            
-        return variations[:count]
-        
-    except Exception as e:
-        print(f"Claude API error: {e}")
-        # Fallback variations
-        return [f"{context} - variation {i+1}" for i in range(count)]
+    
+    for block in response.content:
+        if getattr(block, 'type', None) == 'tool_use' and block.name == PROMPT_TOOL['name']:
+            prompts = block.input.get('prompts', []) if isinstance(block.input, dict) else []
+            logger.debug('PROMPT CHUNK', chunk=chunk_index + 1, chunks=chunk_total, received=len(prompts), requested=count, stop_reason=response.stop_reason)
+            return validate_prompts(prompts)[:count]
+    
+    logger.warning('PROMPT CHUNK EMPTY', chunk=chunk_index + 1, chunks=chunk_total, stop_reason=response.stop_reason)
+    return []
+
+def validate_prompts(prompts):
+    """Keep only non-empty string prompts within the word budget"""
+    valid = []
+    for prompt in prompts:
+        if not isinstance(prompt, str):
+            continue
+        prompt = ' '.join(prompt.split())
+        if prompt and len(prompt.split()) <= MAX_PROMPT_WORDS * 2:
+            valid.append(prompt)
+    return valid
 
+def merge_prompts(existing, new_prompts):
+    """Append new prompts, dropping exact (case-insensitive) duplicates"""
+    seen = {p.lower() for p in existing}
+    merged = list(existing)
+    for prompt in new_prompts:
+        if prompt.lower() not in seen:
+            seen.add(prompt.lower())
+            merged.append(prompt)
+    return merged
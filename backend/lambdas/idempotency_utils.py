@@ -0,0 +1,76 @@
+"""
+Idempotency keys for POST /generate.
+
+A client sends an Idempotency-Key header (kept for IDEMPOTENCY_TTL_SECONDS);
+without one the key is derived from the request itself and kept for
+IDEMPOTENCY_AUTO_TTL_SECONDS, which catches double clicks and quick retries.
+Keys are scoped per user. The key is claimed in the same statement that
+queues the execution (admission_utils.enqueue_execution), so a retry either
+finds the original execution or starts nothing.
+"""
+import hashlib
+import json
+import os
+from db_utils import get_db
+from log_utils import get_logger
+
+logger = get_logger('idempotency_utils')
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))
+IDEMPOTENCY_AUTO_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_AUTO_TTL_SECONDS', 60))
+IDEMPOTENCY_HEADER = 'idempotency-key'
+MAX_CLIENT_KEY_LENGTH = 200
+
+def request_hash(payload):
+    """Stable hash of the request fields that affect the generation"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def resolve_key(event, cognito_user_id, payload_hash):
+    """
+    (key, ttl_seconds) for a request: the client's Idempotency-Key if present,
+    otherwise the request hash. Raises ValueError for an unusable client key.
+    """
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    client_key = headers.get(IDEMPOTENCY_HEADER)
+    if client_key is None:
+        return f"{cognito_user_id}:auto:{payload_hash}", IDEMPOTENCY_AUTO_TTL_SECONDS
+
+    client_key = client_key.strip()
+    if not client_key or len(client_key) > MAX_CLIENT_KEY_LENGTH or not client_key.isprintable():
+        raise ValueError(f'Idempotency-Key must be 1-{MAX_CLIENT_KEY_LENGTH} printable characters')
+    return f"{cognito_user_id}:{client_key}", IDEMPOTENCY_TTL_SECONDS
+
+def get_claim(key):
+    """(execution_id, request_hash) of an unexpired key, or None"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT execution_id, request_hash FROM idempotency_keys
+        WHERE idempotency_key = %s AND expires_at > NOW()
+    ''', (key,))
+    row = cur.fetchone()
+    conn.commit()
+    return row
+
+def purge_expired(limit=1000):
+    """Delete expired keys; returns the number removed"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            DELETE FROM idempotency_keys
+            WHERE idempotency_key IN (
+                SELECT idempotency_key FROM idempotency_keys
+                WHERE expires_at <= NOW()
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        ''', (limit,))
+        removed = cur.rowcount
+        conn.commit()
+        return removed
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
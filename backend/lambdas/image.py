@@ -31,13 +31,14 @@ def get_images(event):
         batch_id = batch_id.get('batch_id')
     
     if batch_id:
-        cur.execute('''SELECT id, prompt, url, tags, validated, rejected 
+        cur.execute('''SELECT id, prompt, url, tags, width, height, mime_type, byte_size,
+                              validated, rejected, near_duplicate 
                        FROM images 
                        WHERE batch_id = %s 
                        ORDER BY created_at
                        LIMIT 100''', (batch_id,))
     else:
-        cur.execute('''SELECT id, prompt, url, tags 
+        cur.execute('''SELECT id, prompt, url, tags, width, height, mime_type, byte_size 
                        FROM images 
                        WHERE public = true 
                        ORDER BY created_at DESC 
@@ -49,8 +50,13 @@ def get_images(event):
             'prompt': row[1],
             'url': row[2],
             'tags': json.loads(row[3]) if row[3] else [],
-            'selected': row[4] if len(row) > 4 else None,  # validated mapped to 'selected' for frontend
-            'rejected': row[5] if len(row) > 5 else None
+            'width': row[4],
+            'height': row[5],
+            'mime_type': row[6],
+            'byte_size': row[7],
+            'selected': row[8] if len(row) > 8 else None,  # validated mapped to 'selected' for frontend
+            'rejected': row[9] if len(row) > 9 else None,
+            'near_duplicate': row[10] if len(row) > 10 else None
         }
         for row in cur.fetchall()
     ]
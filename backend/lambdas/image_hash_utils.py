@@ -0,0 +1,149 @@
+"""
+Perceptual hashes for near-duplicate image detection (CPU only).
+
+phash() is the 64-bit DCT hash: the image is reduced to 32x32 grayscale, the
+lowest 8x8 DCT coefficients are kept and each becomes one bit (above or below
+their median). Near-identical images differ in a few bits, so an image is a
+near-duplicate when an earlier one lies within PHASH_DUPLICATE_DISTANCE
+(Hamming); a BK-tree answers that without comparing against every hash.
+Byte-identical images are matched by sha256 first, which also covers images
+whose hash couldn't be computed.
+"""
+import io
+import math
+import os
+import threading
+from PIL import Image
+from db_utils import get_db
+
+# Max differing bits for a near-duplicate (0 disables detection)
+PHASH_DUPLICATE_DISTANCE = int(os.environ.get('PHASH_DUPLICATE_DISTANCE', 8))
+# Most recent images of the user compared against
+PHASH_HISTORY_LIMIT = int(os.environ.get('PHASH_HISTORY_LIMIT', 20000))
+HASH_SIZE = 8
+SAMPLE_SIZE = 32
+MASK_64 = (1 << 64) - 1
+
+# DCT-II basis for the low frequencies only
+_DCT_BASIS = [
+    [math.cos(math.pi * (2 * x + 1) * u / (2 * SAMPLE_SIZE)) for x in range(SAMPLE_SIZE)]
+    for u in range(HASH_SIZE)
+]
+
+def phash(image_bytes):
+    """64-bit perceptual hash as a signed integer, so it fits a Postgres BIGINT"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('L', (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4))  # JPEG decodes at reduced size; no-op for PNG
+        pixels = list(image.convert('L').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS).getdata())
+    return hash_pixels(pixels)
+
+def hash_pixels(pixels):
+    """phash of SAMPLE_SIZE x SAMPLE_SIZE grayscale values in row order"""
+    rows = [pixels[y * SAMPLE_SIZE:(y + 1) * SAMPLE_SIZE] for y in range(SAMPLE_SIZE)]
+    # Separable transform: rows first, then the columns of the kept coefficients
+    row_coefficients = [[sum(b * p for b, p in zip(basis, row)) for basis in _DCT_BASIS] for row in rows]
+    coefficients = [
+        sum(basis[y] * row_coefficients[y][u] for y in range(SAMPLE_SIZE))
+        for basis in _DCT_BASIS for u in range(HASH_SIZE)
+    ]
+
+    ordered = sorted(coefficients)
+    median = (ordered[31] + ordered[32]) / 2
+    value = 0
+    for coefficient in coefficients:
+        value = (value << 1) | (coefficient > median)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def hamming(a, b):
+    return ((a ^ b) & MASK_64).bit_count()
+
+class BKTree:
+    """Metric tree over hashes; children are keyed by their distance to the parent"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item=None):
+        node = (value, item, {})
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def find(self, value, max_distance):
+        """(distance, item) of every entry within max_distance, nearest first"""
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                results.append((distance, item))
+            # Triangle inequality: only subtrees at |distance - d| <= max_distance can match
+            stack.extend(child for d, child in children.items() if abs(distance - d) <= max_distance)
+        return sorted(results, key=lambda result: result[0])
+
+class DuplicateIndex:
+    """Thread-safe BK-tree and sha256 set of kept images; duplicates are never added themselves"""
+
+    def __init__(self, max_distance=PHASH_DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.digests = {}
+        self._lock = threading.Lock()
+
+    def add(self, value, item=None, digest=None):
+        with self._lock:
+            self._add(value, item, digest)
+
+    def check_and_add(self, value, item=None, digest=None):
+        """
+        Item of an identical (same sha256) or nearest earlier image within
+        range, or None after adding value as a new original. Either key may be None.
+        """
+        with self._lock:
+            if self.max_distance > 0:
+                if digest is not None and digest in self.digests:
+                    return self.digests[digest]
+                matches = self.tree.find(value, self.max_distance) if value is not None else []
+                if matches:
+                    return matches[0][1]
+            self._add(value, item, digest)
+            return None
+
+    def _add(self, value, item, digest):
+        if value is not None:
+            self.tree.add(value, item)
+        if digest is not None:
+            self.digests.setdefault(digest, item)
+
+def load_user_index(cognito_user_id, max_distance=PHASH_DUPLICATE_DISTANCE):
+    """DuplicateIndex over the user's saved (non-duplicate) images; items are ('image', id)"""
+    index = DuplicateIndex(max_distance)
+    if max_distance <= 0:
+        return index
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT i.id, i.phash, i.sha256
+        FROM images i
+        JOIN batches b ON b.id = i.batch_id
+        JOIN users u ON u.id = b.user_id
+        WHERE u.cognito_id = %s AND (i.phash IS NOT NULL OR i.sha256 IS NOT NULL) AND NOT i.near_duplicate
+        ORDER BY i.id DESC
+        LIMIT %s
+    ''', (cognito_user_id, PHASH_HISTORY_LIMIT))
+    rows = cur.fetchall()
+    conn.commit()
+    for image_id, value, digest in rows:
+        index.add(value, ('image', image_id), digest)
+    return index
@@ -0,0 +1,40 @@
+"""
+Image metadata recorded at ingest, so exports and the gallery never have to
+download an image to learn its shape or format.
+
+Pillow's Image.open only parses the header; pixels are decoded lazily and
+never touched here.
+"""
+import hashlib
+import io
+from PIL import Image
+from log_utils import get_logger
+
+logger = get_logger('image_metadata_utils')
+
+DEFAULT_MIME_TYPE = 'image/png'
+# Keys of image_metadata(), also the column names in images and image_checkpoints
+METADATA_FIELDS = ('width', 'height', 'mime_type', 'byte_size', 'sha256')
+METADATA_COLUMNS = ', '.join(METADATA_FIELDS)
+EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp', 'image/gif': 'gif'}
+
+def image_metadata(image_bytes):
+    """width, height, mime_type, byte_size and sha256 of an encoded image (dimensions None if unreadable)"""
+    metadata = {
+        'width': None,
+        'height': None,
+        'mime_type': None,
+        'byte_size': len(image_bytes),
+        'sha256': hashlib.sha256(image_bytes).hexdigest()
+    }
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            metadata['width'], metadata['height'] = image.size
+            metadata['mime_type'] = image.get_format_mimetype()
+    except Exception as e:
+        logger.warning('IMAGE HEADER UNREADABLE', byte_size=len(image_bytes), error=str(e))
+    return metadata
+
+def file_extension(mime_type):
+    """File extension for a stored mime type; png when unknown"""
+    return EXTENSIONS.get(mime_type, 'png')
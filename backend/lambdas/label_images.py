@@ -1,11 +1,15 @@
 import json
 import os
-import boto3
+from client_utils import get_rekognition_client
 from progress_utils import update_batch_progress
+from metrics_utils import track_stage, add_metric, time_external
+from log_utils import get_logger, set_log_context
 
-# Initialize Rekognition client
-rekognition = boto3.client('rekognition')
+logger = get_logger('label_images')
 
+REKOGNITION_MAX_BYTES = 5 * 1024 * 1024  # Larger images must be passed as S3Object
+
+@track_stage('LabelImages')
 def handler(event, context):
     """
     Step 6: Use AWS Rekognition to label and detect objects in images
@@ -16,34 +20,34 @@ def handler(event, context):
         bucket = os.environ.get('S3_BUCKET')
         execution_id = event.get('execution_id', 'unknown')
         
-        print(f'🏷️ LABEL START: execution_id={execution_id} batch_id={batch_id} images={len(images)}')
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('LABEL START', images=len(images))
         
         # Update progress
-        update_batch_progress(batch_id, 'LabelImages', 80, execution_id)
+        update_batch_progress(batch_id, 'LabelImages', 80, execution_id, event.get('image_count'),
+                              fast_path=event.get('generation_mode') == 'sync')
         
         labeled_images = []
+        already_labeled = 0
         
         for image in images:
+            # Labeled upstream by ProcessImages with FUSED_LABELING
+            if 'rekognition_labels' in image:
+                labeled_images.append(image)
+                already_labeled += 1
+                continue
             try:
-                print(f'🔍 REKOGNITION: Analyzing image {image["id"]} s3_key={image["s3_key"]}')
                 # Analyze image with Rekognition
                 labels, bounding_boxes = analyze_image_with_rekognition(
                     bucket, image['s3_key']
                 )
                 
-                # Add labels and bounding boxes to image data
-                labeled_image = {
-                    **image,
-                    'rekognition_labels': labels,
-                    'bounding_boxes': bounding_boxes,
-                    'tags': image['tags'] + [label.lower() for label in labels[:5]]  # Add top 5 labels as tags
-                }
-                
-                labeled_images.append(labeled_image)
-                print(f'✅ LABELED: image={image["id"]} labels={len(labels)} boxes={len(bounding_boxes)}')
+                labeled_images.append(labeled_record(image, labels, bounding_boxes))
+                logger.debug('LABELED', image=image['id'], labels=len(labels), boxes=len(bounding_boxes), sample=0.2)
                 
             except Exception as e:
-                print(f'❌ LABEL ERROR: image={image["id"]} error={str(e)} | execution_id={execution_id}')
+                logger.error('LABEL ERROR', image=image['id'], error=str(e))
+                add_metric('ImageErrors', 1)
                 # Keep image without labels rather than failing the whole batch
                 labeled_images.append({
                     **image,
@@ -52,32 +56,48 @@ def handler(event, context):
                     'error': str(e)
                 })
         
+        add_metric('ImagesLabeled', len(labeled_images) - already_labeled)
+        
         return {
             **event,
+            'images_labeled': True,
             'images': labeled_images
         }
         
     except Exception as e:
-        print(f'❌ LABELING ERROR: {str(e)} | execution_id={execution_id} batch_id={batch_id}')
+        logger.error('LABELING ERROR', error=str(e))
         raise Exception(f'Failed to label images: {str(e)}')
 
-def analyze_image_with_rekognition(bucket, s3_key):
+def labeled_record(image, labels, bounding_boxes):
+    """Add labels and bounding boxes to image data"""
+    return {
+        **image,
+        'rekognition_labels': labels,
+        'bounding_boxes': bounding_boxes,
+        'tags': image['tags'] + [label.lower() for label in labels[:5]]  # Add top 5 labels as tags
+    }
+
+def analyze_image_with_rekognition(bucket, s3_key, image_bytes=None):
     """
-    Analyze image using AWS Rekognition for labels and object detection
+    Analyze image using AWS Rekognition for labels and object detection.
+    In-memory image_bytes are sent directly so Rekognition doesn't re-read S3.
     """
     try:
-        print(f'🤖 REKOGNITION API: bucket={bucket} key={s3_key}')
+        if image_bytes and len(image_bytes) <= REKOGNITION_MAX_BYTES:
+            image = {'Bytes': image_bytes}
+        else:
+            image = {'S3Object': {'Bucket': bucket, 'Name': s3_key}}
         
         # Single detect_labels call gets both labels AND bounding boxes
-        response = rekognition.detect_labels(
-            Image={'S3Object': {'Bucket': bucket, 'Name': s3_key}},
-            MaxLabels=20,
-            MinConfidence=70
-        )
+        with time_external('rekognition'):
+            response = get_rekognition_client().detect_labels(
+                Image=image,
+                MaxLabels=20,
+                MinConfidence=70
+            )
         
         # Extract labels
         labels = [label['Name'] for label in response['Labels']]
-        print(f'🏷️ LABELS FOUND: {len(labels)} labels detected')
         
         # Extract bounding boxes from the same response
         bounding_boxes = []
@@ -95,9 +115,9 @@ def analyze_image_with_rekognition(bucket, s3_key):
                             'height': box['Height']
                         })
         
-        print(f'📊 DETECTION COMPLETE: labels={len(labels)} bounding_boxes={len(bounding_boxes)}')
         return labels, bounding_boxes
         
     except Exception as e:
-        print(f'❌ REKOGNITION ERROR: {str(e)} | bucket={bucket} key={s3_key}')
+        logger.error('REKOGNITION ERROR', error=str(e), s3_key=s3_key)
+        add_metric('ExternalApiErrors', 1)
         return [], []
\ No newline at end of file
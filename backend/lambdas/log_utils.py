@@ -0,0 +1,98 @@
+"""
+Shared structured JSON logging for all lambdas.
+
+One JSON line per record on stdout (picked up by CloudWatch). Level checks
+happen before any serialization, long fields are truncated, binary payloads
+are summarized, and chatty messages can be sampled. Correlation fields set
+with set_log_context (execution_id, batch_id) are added to every record.
+"""
+import json
+import os
+import random
+import time
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_LEVEL = LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), 20)
+LOG_MAX_FIELD_LENGTH = int(os.environ.get('LOG_MAX_FIELD_LENGTH', '300'))
+LOG_MAX_ITEMS = 20  # List/dict entries kept per field
+
+# Correlation fields for the current invocation (one invocation per container at a time)
+_context = {}
+
+def set_log_context(**fields):
+    """Replace the correlation fields added to every record (None values are dropped)"""
+    _context.clear()
+    _context.update({k: v for k, v in fields.items() if v is not None})
+
+def update_log_context(**fields):
+    """Add correlation fields once they become known (e.g. batch_id after setup)"""
+    _context.update({k: v for k, v in fields.items() if v is not None})
+
+def truncate(value, depth=0):
+    """Make a value cheap and safe to serialize: short strings, no raw bytes"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return f'<{len(value)} bytes>'
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_LENGTH:
+            return f'{value[:LOG_MAX_FIELD_LENGTH]}...(+{len(value) - LOG_MAX_FIELD_LENGTH} chars)'
+        return value
+    if depth >= 2:
+        return truncate(str(value), depth)
+    if isinstance(value, dict):
+        items = list(value.items())
+        result = {str(k): truncate(v, depth + 1) for k, v in items[:LOG_MAX_ITEMS]}
+        if len(items) > LOG_MAX_ITEMS:
+            result['_truncated_keys'] = len(items) - LOG_MAX_ITEMS
+        return result
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        result = [truncate(v, depth + 1) for v in items[:LOG_MAX_ITEMS]]
+        if len(items) > LOG_MAX_ITEMS:
+            result.append(f'...(+{len(items) - LOG_MAX_ITEMS} items)')
+        return result
+    return truncate(str(value), depth)
+
+class StructuredLogger:
+    def __init__(self, name):
+        self.name = name
+
+    def log(self, level, message, sample=None, **fields):
+        """
+        Emit one JSON record. sample (0-1) keeps only that fraction of
+        records for this message; errors are never sampled out.
+        """
+        level_no = LEVELS[level]
+        if level_no < LOG_LEVEL:
+            return
+        if sample is not None and level_no < LEVELS['ERROR'] and random.random() >= sample:
+            return
+
+        record = {
+            'ts': round(time.time(), 3),
+            'level': level,
+            'logger': self.name,
+            'msg': message,
+            **_context
+        }
+        for key, value in fields.items():
+            record[key] = truncate(value)
+        if sample is not None:
+            record['sample_rate'] = sample
+        print(json.dumps(record, default=str, ensure_ascii=False))
+
+    def debug(self, message, **fields):
+        self.log('DEBUG', message, **fields)
+
+    def info(self, message, **fields):
+        self.log('INFO', message, **fields)
+
+    def warning(self, message, **fields):
+        self.log('WARNING', message, **fields)
+
+    def error(self, message, **fields):
+        self.log('ERROR', message, **fields)
+
+def get_logger(name):
+    return StructuredLogger(name)
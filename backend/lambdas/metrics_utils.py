@@ -0,0 +1,166 @@
+"""
+Per-stage pipeline metrics in CloudWatch Embedded Metric Format (EMF).
+
+Metrics are written as structured log lines that CloudWatch turns into
+metrics, so there are no PutMetricData calls on the hot path. Records go to
+a pluggable sink (stdout by default); tests can capture them locally with
+set_metrics_sink(records.append).
+"""
+import functools
+import json
+import os
+import time
+from contextlib import contextmanager
+from log_utils import get_logger
+from stage_timing_utils import record_stage_timing
+from profiling_utils import profile_handler
+
+logger = get_logger('metrics_utils')
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DataBanana/Pipeline')
+EMF_MAX_VALUES = 100  # EMF limit for values in one metric array
+
+def _stdout_sink(record):
+    print(json.dumps(record, default=str))
+
+_sink = _stdout_sink
+_current = None
+
+def set_metrics_sink(sink):
+    """Route EMF records to sink(record); None restores stdout"""
+    global _sink
+    _sink = sink or _stdout_sink
+
+def image_count_bucket(image_count):
+    """Coarse image_count dimension so metric cardinality stays low"""
+    if not image_count:
+        return 'unknown'
+    for upper, label in ((5, '1-5'), (20, '6-20'), (50, '21-50'), (100, '51-100')):
+        if image_count <= upper:
+            return label
+    return '100+'
+
+def emit_metrics(metrics, dimensions, properties=None):
+    """
+    Emit one EMF record. metrics maps name -> (value or list of values, unit);
+    every key in dimensions becomes a metric dimension.
+    """
+    if not metrics:
+        return
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+            }]
+        },
+        **dimensions,
+        **(properties or {})
+    }
+    for name, (value, _) in metrics.items():
+        record[name] = value[:EMF_MAX_VALUES] if isinstance(value, list) else value
+    _sink(record)
+
+class StageMetrics:
+    """Collects metrics for one pipeline stage invocation and emits them once"""
+
+    def __init__(self, stage, image_count=None, properties=None):
+        self.stage = stage
+        self.dimensions = {'stage': stage, 'image_count_bucket': image_count_bucket(image_count)}
+        self.properties = properties or {}
+        self.metrics = {}
+        self.external = {}  # service -> list of latencies in ms
+        self.started = time.perf_counter()
+
+    def add(self, name, value, unit='Count'):
+        """Accumulate a stage metric (values with the same name are summed)"""
+        current = self.metrics.get(name, (0, unit))[0]
+        self.metrics[name] = (current + value, unit)
+
+    def set(self, name, value, unit='Count'):
+        self.metrics[name] = (value, unit)
+
+    def record_external(self, service, latency_ms):
+        self.external.setdefault(service, []).append(round(latency_ms, 2))
+
+    def flush(self, error=None):
+        self.set('StageDuration', round((time.perf_counter() - self.started) * 1000, 2), 'Milliseconds')
+        self.set('Errors', 1 if error else 0)
+        emit_metrics(self.metrics, self.dimensions, self.properties)
+        for service, latencies in self.external.items():
+            for start in range(0, len(latencies), EMF_MAX_VALUES):
+                emit_metrics(
+                    {'ExternalApiLatency': (latencies[start:start + EMF_MAX_VALUES], 'Milliseconds')},
+                    {'stage': self.stage, 'service': service},
+                    self.properties
+                )
+
+def current_metrics():
+    """StageMetrics of the running stage handler (None outside track_stage)"""
+    return _current
+
+def add_metric(name, value, unit='Count'):
+    if _current:
+        _current.add(name, value, unit)
+
+@contextmanager
+def time_external(service):
+    """Time an external API call and attribute it to the running stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _current:
+            _current.record_external(service, (time.perf_counter() - started) * 1000)
+
+def track_stage(stage):
+    """
+    Decorator for Step Functions stage handlers: emits StageDuration, Errors
+    and anything added via add_metric/time_external, tagged by stage and
+    image_count bucket, and records the run in batch_stage_timings.
+    A pass returning process_complete=false is recorded together with the pass
+    that completes the stage, as one row with the summed duration.
+    Handlers are also profiled when PROFILE_MODE is set (profiling_utils).
+    """
+    def decorator(handler):
+        handler = profile_handler(stage)(handler)
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _current
+            image_count = event.get('image_count') or len(event.get('images', []) or [])
+            _current = StageMetrics(stage, image_count, {
+                'execution_id': event.get('execution_id'),
+                'batch_id': event.get('batch_id')
+            })
+            started_at = time.time()
+            result = None
+            error = None
+            try:
+                result = handler(event, context)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                stage_metrics, _current = _current, None
+                try:
+                    stage_metrics.flush(error)
+                except Exception as flush_error:
+                    logger.error('METRICS EMIT ERROR', error=str(flush_error))
+                ended_at = time.time()
+                elapsed_ms = event.get('process_elapsed_ms', 0) + (ended_at - started_at) * 1000
+                if isinstance(result, dict) and result.get('process_complete') is False:
+                    # Unfinished pass: the state machine hands the total to the next one
+                    result['process_elapsed_ms'] = round(elapsed_ms)
+                else:
+                    if isinstance(result, dict):
+                        result.pop('process_elapsed_ms', None)
+                    # ValidateAndSetup only learns its batch_id from the result
+                    batch_id = event.get('batch_id') or (result or {}).get('batch_id')
+                    record_stage_timing(batch_id, event.get('execution_id'), stage, image_count,
+                                        ended_at - elapsed_ms / 1000, ended_at, error is None,
+                                        event.get('image_model'))
+            return result
+        return wrapper
+    return decorator
@@ -3,13 +3,16 @@ import os
 import stripe
 from db_utils import get_cognito_user_id
 from cors_utils import get_cors_headers
+from log_utils import get_logger, set_log_context
+
+logger = get_logger('payment')
 
 # Use test or live Stripe key based on TEST_MODE
 test_mode = os.environ.get('TEST_MODE', 'false').lower() == 'true'
 stripe.api_key = os.environ.get('STRIPE_SECRET_TEST') if test_mode else os.environ.get('STRIPE_SECRET')
 
 def handler(event, context):
-    print(f"Payment function called")
+    set_log_context(request_id=getattr(context, 'aws_request_id', None))
     
     # Handle OPTIONS preflight requests
     if event['httpMethod'] == 'OPTIONS':
@@ -20,13 +23,10 @@ def handler(event, context):
         }
     
     try:
-        print(f"Parsing request body")
         body = json.loads(event['body'])
         amount = body['amount']
-        print(f"Amount: ${amount}")
-        
         cognito_user_id = get_cognito_user_id(event)
-        print(f"User ID: {cognito_user_id}")
+        logger.info('CHECKOUT START', user=cognito_user_id, amount=amount)
         
         # Create Stripe Checkout Session
         session = stripe.checkout.Session.create(
@@ -58,6 +58,7 @@ def handler(event, context):
         }
         
     except Exception as e:
+        logger.error('PAYMENT ERROR', error=str(e))
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)}),
@@ -1,139 +1,409 @@
+import hashlib
 import json
 import os
-import boto3
-from google import genai
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from client_utils import get_gemini_client, get_s3_client
+from db_utils import get_db
+from coalesce_utils import parse_request_key
+from label_images import analyze_image_with_rekognition, labeled_record
+from image_hash_utils import phash, load_user_index
+from image_metadata_utils import image_metadata, file_extension, EXTENSIONS, DEFAULT_MIME_TYPE, METADATA_FIELDS, METADATA_COLUMNS
 from progress_utils import update_batch_progress
+from metrics_utils import track_stage, add_metric, time_external
+from log_utils import get_logger, set_log_context
 
-# Configure clients
-gemini_client = genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
-s3_client = boto3.client('s3')
+logger = get_logger('process_images')
 
+# Stop storing images this long before the Lambda timeout and continue in a new invocation
+PROCESS_TIME_RESERVE_MS = int(os.environ.get('PROCESS_TIME_RESERVE_MS', 60000))
+MAX_PROCESS_PASSES = 20
+# Follow-up attempts (repair_images) for prompts that came back without an image
+REPAIR_MAX_ATTEMPTS = int(os.environ.get('REPAIR_MAX_ATTEMPTS', 2))
+# Label each image with Rekognition as it is uploaded, so LabelImages can be skipped
+FUSED_LABELING = os.environ.get('FUSED_LABELING', 'false').lower() == 'true'
+PIPELINE_WORKERS = int(os.environ.get('PROCESS_PIPELINE_WORKERS', 4))
+
+class ProcessingAborted(Exception):
+    """Failure a retry can't fix; the state machine goes straight to its Catch"""
+
+@track_stage('ProcessImages')
 def handler(event, context):
     """
-    Step 5: Download and process completed images from Gemini
+    Step 5: Download and process completed images from Gemini.
+    Stored images are checkpointed per index; when the time budget runs out the
+    stage returns process_complete=false and the state machine invokes it again.
     """
     try:
-        gemini_batch_id = event['gemini_batch_id']
+        # Job assignment as reported by gemini_sweeper when it resumed the execution
+        gemini_job = event.get('gemini_job') or {}
+        gemini_batch_id = gemini_job.get('gemini_batch_id') or event['gemini_batch_id']
+        request_offset = gemini_job.get('request_offset', event.get('request_offset')) or 0
         variations = event['variations']
         cognito_user_id = event['cognito_user_id']
         batch_id = event['batch_id']
         bucket = os.environ.get('S3_BUCKET')
         execution_id = event.get('execution_id', 'unknown')
+        gemini_client = get_gemini_client()
+        s3_client = get_s3_client()
+        
+        process_pass = event.get('process_pass', 0) + 1
         
-        print(f'💼 PROCESS START: execution_id={execution_id} batch_id={batch_id} job_id={gemini_batch_id}')
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('PROCESS START', gemini_batch_id=gemini_batch_id, process_pass=process_pass)
+        
+        if process_pass > MAX_PROCESS_PASSES:
+            raise ProcessingAborted(f'Gave up after {MAX_PROCESS_PASSES} passes')
         
         # Update progress
-        update_batch_progress(batch_id, 'ProcessImages', 70, execution_id)
+        update_batch_progress(batch_id, 'ProcessImages', 70, execution_id, event.get('image_count'))
+        
+        # Indices stored by earlier passes (or by an attempt that crashed) are skipped
+        stored = load_checkpoint(batch_id)
         
         # Get batch results from Gemini
-        print(f'📞 GEMINI FETCH: Retrieving results for job_id={gemini_batch_id}')
-        batch_job = gemini_client.batches.get(name=gemini_batch_id)
+        with time_external('gemini'):
+            batch_job = gemini_client.batches.get(name=gemini_batch_id)
         
-        print(f'🔍 BATCH JOB DEBUG: state={batch_job.state.name}')
-        print(f'🔍 BATCH JOB DEST: {batch_job.dest}')
+        # dest can hold inlined base64 image responses, so only its shape is logged
+        logger.info('GEMINI JOB FETCHED', state=batch_job.state.name, dest_type=type(batch_job.dest).__name__)
         
         if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
-            raise Exception(f'Batch job not succeeded: {batch_job.state.name}')
+            raise ProcessingAborted(f'Batch job not succeeded: {batch_job.state.name}')
             
         # Check if responses are inlined in the batch job
         if hasattr(batch_job.dest, 'inlined_responses') and batch_job.dest.inlined_responses:
-            print(f'🔍 USING INLINED RESPONSES: {len(batch_job.dest.inlined_responses)} responses')
-            batch_responses = [resp.response for resp in batch_job.dest.inlined_responses]
+            logger.info('USING INLINED RESPONSES', responses=len(batch_job.dest.inlined_responses))
+            keyed_responses = [(response_key(resp), resp.response) for resp in batch_job.dest.inlined_responses]
         elif hasattr(batch_job.dest, 'output_uri') and batch_job.dest.output_uri:
-            print(f'🔍 USING OUTPUT_URI: {batch_job.dest.output_uri}')
+            logger.info('USING OUTPUT_URI', output_uri=batch_job.dest.output_uri)
             # Extract file name from output_uri
-            import re
             file_match = re.search(r'files/([^/]+)$', batch_job.dest.output_uri)
             if file_match:
                 result_file_name = file_match.group(1)
             else:
-                raise Exception(f'Could not extract file name from output_uri: {batch_job.dest.output_uri}')
-            print(f'📁 DOWNLOADING FILE: {result_file_name}')
-            file_content_bytes = gemini_client.files.download(file=result_file_name)
+                raise ProcessingAborted(f'Could not extract file name from output_uri: {batch_job.dest.output_uri}')
+            logger.info('DOWNLOADING FILE', file_name=result_file_name)
+            with time_external('gemini'):
+                file_content_bytes = gemini_client.files.download(file=result_file_name)
             file_content = file_content_bytes.decode('utf-8')
             
             # Parse JSONL responses
-            batch_responses = []
+            keyed_responses = []
             for line in file_content.splitlines():
                 if line.strip():
-                    import json
                     response_data = json.loads(line)
                     if 'response' in response_data:
-                        batch_responses.append(response_data['response'])
+                        keyed_responses.append((response_data.get('key'), response_data['response']))
         elif hasattr(batch_job.dest, 'file_name') and batch_job.dest.file_name:
             result_file_name = batch_job.dest.file_name
-            print(f'📁 DOWNLOADING FILE: {result_file_name}')
-            file_content_bytes = gemini_client.files.download(file=result_file_name)
+            logger.info('DOWNLOADING FILE', file_name=result_file_name)
+            with time_external('gemini'):
+                file_content_bytes = gemini_client.files.download(file=result_file_name)
             file_content = file_content_bytes.decode('utf-8')
             
             # Parse JSONL responses
-            batch_responses = []
+            keyed_responses = []
             for line in file_content.splitlines():
                 if line.strip():
-                    import json
                     response_data = json.loads(line)
                     if 'response' in response_data:
-                        batch_responses.append(response_data['response'])
+                        keyed_responses.append((response_data.get('key'), response_data['response']))
         else:
-            raise Exception(f'No valid file reference found in batch job dest: {batch_job.dest}')
+            raise ProcessingAborted(f'No valid file reference found in batch job dest: {batch_job.dest}')
         
-        print(f'📄 RESPONSES RECEIVED: {len(batch_responses)} results | execution_id={execution_id}')
+        # The job may be shared with other batches (coalesce_utils): keep only ours
+        batch_responses = select_batch_responses(keyed_responses, batch_id, request_offset,
+                                                 len(variations), event.get('request_indices'))
+        logger.info('RESPONSES RECEIVED', responses=sum(1 for r in batch_responses if r is not None),
+                    job_responses=len(keyed_responses))
         
-        images = []
-        for i, response in enumerate(batch_responses):
-            try:
-                if i >= len(variations):
-                    break
-                    
-                # Extract image data from response (safe handling)
-                image_data = None
-                
-                for part in response.candidates[0].content.parts:
-                    if hasattr(part, 'inline_data') and part.inline_data and hasattr(part.inline_data, 'data'):
-                        image_data = part.inline_data.data
-                        break
-                
-                if image_data:
-                    print(f'🖼️ PROCESSING IMAGE: index={i} prompt="{variations[i][:30]}..."')
-                    
-                    # Upload to S3
-                    key = f"generated/{cognito_user_id}/{i}_{hash(variations[i])}.png"
-                    s3_client.put_object(
-                        Bucket=bucket,
-                        Key=key,
-                        Body=image_data,
-                        ContentType='image/png'
-                    )
-                    
-                    # Generate pre-signed URL (valid for 24 hours)
-                    url = s3_client.generate_presigned_url(
-                        'get_object',
-                        Params={'Bucket': bucket, 'Key': key},
-                        ExpiresIn=86400  # 24 hours
-                    )
-                    
-                    images.append({
-                        'id': i,
-                        'prompt': variations[i],
-                        'url': url,
-                        'tags': ['generated', 'gemini'],
-                        's3_key': key
-                    })
-                    print(f'✅ IMAGE SAVED: index={i} s3_key={key}')
-                else:
-                    print(f'⚠️ NO IMAGE DATA: variation={i} prompt="{variations[i][:30]}..."')
-                    
-            except Exception as e:
-                print(f'❌ IMAGE ERROR: index={i} error={str(e)} | execution_id={execution_id}')
-                # Continue with other images even if one fails
+        stored_this_pass, out_of_time = store_responses(batch_responses, stored, variations, batch_id,
+                                                        cognito_user_id, bucket, s3_client, context)
+        add_metric('ImagesProcessed', stored_this_pass)
         
-        print(f'✅ PROCESS COMPLETE: {len(images)} images processed | execution_id={execution_id} batch_id={batch_id}')
+        if out_of_time:
+            logger.info('PROCESS CONTINUATION', stored=len(stored), prompts=len(variations))
+            return {
+                **event,
+                'process_pass': process_pass,
+                'process_complete': False
+            }
+        
+        images, images_labeled = checkpoint_images(batch_id, variations, s3_client, bucket, cognito_user_id)
+        logger.info('PROCESS COMPLETE', images=len(images), prompts=len(variations), process_pass=process_pass)
         
         return {
             **event,
+            **repair_fields(stored, len(variations), event.get('repair_attempt', 0)),
+            'process_pass': process_pass,
+            'process_complete': True,
+            'images_labeled': images_labeled,
             'images': images
         }
         
+    except ProcessingAborted as e:
+        logger.error('PROCESS ABORTED', error=str(e))
+        raise
+    except Exception as e:
+        logger.error('PROCESS ERROR', error=str(e))
+        raise Exception(f'Failed to process images: {str(e)}')
+
+def response_key(inlined_response):
+    """Request key echoed back on an inlined batch response, if the API returns one"""
+    metadata = getattr(inlined_response, 'metadata', None) or {}
+    return metadata.get('key') if isinstance(metadata, dict) else getattr(metadata, 'key', None)
+
+def select_batch_responses(keyed_responses, batch_id, request_offset, prompt_count, request_indices=None):
+    """
+    This batch's responses, aligned with its prompts (None where missing).
+    Keys "<batch_id>:<index>" are used when present; otherwise responses are
+    positional from the batch's offset in the job, in request_indices order
+    when only some prompts were sent (repair jobs).
+    """
+    by_index = {}
+    for key, response in keyed_responses:
+        parsed = parse_request_key(key)
+        if parsed and parsed[0] == batch_id:
+            by_index[parsed[1]] = response
+    if by_index or any(parse_request_key(key) for key, _ in keyed_responses):
+        return [by_index.get(i) for i in range(prompt_count)]
+    
+    indices = request_indices if request_indices is not None else range(prompt_count)
+    aligned = [None] * prompt_count
+    positional = keyed_responses[request_offset:request_offset + len(indices)]
+    for index, (_, response) in zip(indices, positional):
+        aligned[index] = response
+    return aligned
+
+def store_responses(batch_responses, stored, variations, batch_id, cognito_user_id, bucket, s3_client, context):
+    """
+    Producer/consumer pipeline over the responses not yet stored: this thread
+    decodes each response and queues its image bytes; workers upload them (and
+    with FUSED_LABELING label the same bytes) while the next one is decoded.
+    Probable near-duplicates are left unlabeled; checkpoint_images decides.
+    Results are checkpointed on this thread because the DB connection is shared.
+    Returns (images stored, whether the time budget ran out).
+    """
+    stored_count = 0
+    out_of_time = False
+    in_flight = {}
+    duplicates = duplicate_index(batch_id, cognito_user_id) if FUSED_LABELING else None
+    
+    def upload_and_label(index, image_data):
+        metadata = image_metadata(image_data)
+        key = upload_image(image_data, index, variations[index], cognito_user_id, batch_id, bucket, s3_client,
+                           metadata['mime_type'])
+        image_hash = safe_phash(image_data, index)
+        labels = None
+        if FUSED_LABELING and duplicates.check_and_add(image_hash, index, metadata['sha256']) is None:
+            labels = analyze_image_with_rekognition(bucket, key, image_data)
+        return key, labels, image_hash, metadata
+    
+    def collect(done):
+        nonlocal stored_count
+        for future in done:
+            i = in_flight.pop(future)
+            try:
+                key, labels, image_hash, metadata = future.result()
+                save_checkpoint(batch_id, i, key, labels, image_hash, metadata)
+                stored[i] = key
+                stored_count += 1
+                if labels is not None:
+                    add_metric('ImagesLabeled', 1)
+            except Exception as e:
+                logger.error('IMAGE ERROR', index=i, error=str(e))
+                add_metric('ImageErrors', 1)
+                # Continue with other images even if one fails
+    
+    with ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as executor:
+        for i, response in enumerate(batch_responses):
+            if i in stored:
+                continue
+            if context and context.get_remaining_time_in_millis() < PROCESS_TIME_RESERVE_MS:
+                out_of_time = True
+                break
+            try:
+                image_data = extract_image_data(response) if response is not None else None
+            except Exception as e:
+                logger.error('IMAGE ERROR', index=i, error=str(e))
+                add_metric('ImageErrors', 1)
+                continue
+            if not image_data:
+                logger.warning('NO IMAGE DATA', index=i, prompt=variations[i][:30])
+                add_metric('MissingImages', 1)
+                continue
+            
+            in_flight[executor.submit(upload_and_label, i, image_data)] = i
+            # Bound decoded images held in memory
+            if len(in_flight) >= PIPELINE_WORKERS * 2:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                collect(done)
+        
+        collect(wait(list(in_flight)).done)
+    
+    return stored_count, out_of_time
+
+def extract_image_data(response):
+    """Image bytes from a Gemini response, or None"""
+    # Extract image data from response (safe handling)
+    for part in response.candidates[0].content.parts:
+        if hasattr(part, 'inline_data') and part.inline_data and hasattr(part.inline_data, 'data'):
+            return part.inline_data.data
+    return None
+
+def store_generated_image(response, index, prompt, cognito_user_id, batch_id, bucket, s3_client):
+    """Upload the image in a Gemini response to S3; None if the response has no image"""
+    image_data = extract_image_data(response)
+    if not image_data:
+        return None
+    
+    metadata = image_metadata(image_data)
+    key = upload_image(image_data, index, prompt, cognito_user_id, batch_id, bucket, s3_client, metadata['mime_type'])
+    return {**image_entry(s3_client, bucket, index, prompt, key), **metadata, 'phash': safe_phash(image_data, index)}
+
+def safe_phash(image_data, index):
+    """Perceptual hash, or None if the bytes can't be decoded (the image is kept either way)"""
+    try:
+        return phash(image_data)
     except Exception as e:
-        print(f'❌ PROCESS ERROR: {str(e)} | execution_id={execution_id} batch_id={batch_id}')
-        raise Exception(f'Failed to process images: {str(e)}')
\ No newline at end of file
+        logger.warning('PHASH FAILED', index=index, error=str(e))
+        return None
+
+def upload_image(image_data, index, prompt, cognito_user_id, batch_id, bucket, s3_client, mime_type=None):
+    """Upload one generated image; returns its S3 key"""
+    # Upload to S3 (stable per batch, so a retried pass overwrites instead of duplicating,
+    # while another batch with the same prompt never overwrites this one's image)
+    if mime_type not in EXTENSIONS:
+        # Undetected formats are stored as PNG, what Gemini returns
+        mime_type = DEFAULT_MIME_TYPE
+    prompt_digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:16]
+    key = f"generated/{cognito_user_id}/{batch_id}/{index}_{prompt_digest}.{file_extension(mime_type)}"
+    with time_external('s3'):
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=image_data,
+            ContentType=mime_type
+        )
+    add_metric('BytesUploaded', len(image_data), 'Bytes')
+    logger.debug('IMAGE SAVED', index=index, s3_key=key, sample=0.2)
+    return key
+
+def image_entry(s3_client, bucket, index, prompt, key):
+    """Image record handed to LabelImages"""
+    # Generate pre-signed URL (valid for 24 hours)
+    url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=86400  # 24 hours
+    )
+    
+    return {
+        'id': index,
+        'prompt': prompt,
+        'url': url,
+        'tags': ['generated', 'gemini'],
+        's3_key': key
+    }
+
+def repair_fields(stored, prompt_count, repair_attempt):
+    """Missing prompt indices and whether another repair attempt is allowed"""
+    missing = [i for i in range(prompt_count) if i not in stored]
+    return {
+        'missing_indices': missing,
+        'needs_repair': bool(missing) and repair_attempt < REPAIR_MAX_ATTEMPTS
+    }
+
+def checkpoint_images(batch_id, variations, s3_client, bucket, cognito_user_id=None):
+    """
+    Image records for everything stored so far, with their ingest metadata and
+    labels where the fused pipeline produced them; returns (images, whether all
+    are labeled). Images identical to or within PHASH_DUPLICATE_DISTANCE of one
+    of the user's saved images or an earlier index of this batch are flagged
+    near_duplicate and get empty labels, so LabelImages never sends them to Rekognition.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT image_index, s3_key, rekognition_labels, bounding_boxes, phash, {METADATA_COLUMNS}
+        FROM image_checkpoints WHERE batch_id = %s ORDER BY image_index
+    ''', (batch_id,))
+    rows = cur.fetchall()
+    conn.commit()
+    
+    duplicates = load_user_index(cognito_user_id) if cognito_user_id else None
+    images = []
+    for index, key, labels, bounding_boxes, image_hash, *metadata_values in rows:
+        image = image_entry(s3_client, bucket, index, variations[index], key)
+        metadata = dict(zip(METADATA_FIELDS, metadata_values))
+        near_duplicate = bool(duplicates and duplicates.check_and_add(image_hash, index, metadata['sha256']) is not None)
+        image.update(metadata, phash=image_hash, near_duplicate=near_duplicate)
+        if labels is None and near_duplicate:
+            labels = []
+        images.append(labeled_record(image, labels, bounding_boxes or []) if labels is not None else image)
+    
+    near_duplicates = sum(1 for image in images if image['near_duplicate'])
+    if near_duplicates:
+        logger.info('NEAR DUPLICATES FLAGGED', near_duplicates=near_duplicates, images=len(images))
+    add_metric('NearDuplicates', near_duplicates)
+    return images, bool(images) and all('rekognition_labels' in image for image in images)
+
+def duplicate_index(batch_id, cognito_user_id):
+    """DuplicateIndex of the user's saved images plus this batch's checkpointed hashes"""
+    index = load_user_index(cognito_user_id)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT image_index, phash, sha256 FROM image_checkpoints
+        WHERE batch_id = %s ORDER BY image_index
+    ''', (batch_id,))
+    rows = cur.fetchall()
+    conn.commit()
+    for image_index, image_hash, digest in rows:
+        index.check_and_add(image_hash, image_index, digest)
+    return index
+
+def load_checkpoint(batch_id):
+    """index -> s3_key of images already stored for this batch"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT image_index, s3_key FROM image_checkpoints WHERE batch_id = %s', (batch_id,))
+    stored = dict(cur.fetchall())
+    conn.commit()
+    return stored
+
+def save_checkpoint(batch_id, index, s3_key, labels=None, image_hash=None, metadata=None):
+    """
+    Record a stored image; labels is (labels, bounding_boxes) from the fused
+    pipeline and metadata the image_metadata() of its bytes
+    """
+    rekognition_labels, bounding_boxes = labels or (None, None)
+    metadata = metadata or {}
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO image_checkpoints (batch_id, image_index, s3_key, rekognition_labels, bounding_boxes, phash,
+                                           width, height, mime_type, byte_size, sha256)
+            VALUES (%s, %s, %s, %s::jsonb, %s::jsonb, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (batch_id, image_index) DO UPDATE
+            SET s3_key = EXCLUDED.s3_key,
+                rekognition_labels = EXCLUDED.rekognition_labels,
+                bounding_boxes = EXCLUDED.bounding_boxes,
+                phash = EXCLUDED.phash,
+                width = EXCLUDED.width,
+                height = EXCLUDED.height,
+                mime_type = EXCLUDED.mime_type,
+                byte_size = EXCLUDED.byte_size,
+                sha256 = EXCLUDED.sha256
+        ''', (batch_id, index, s3_key,
+              json.dumps(rekognition_labels) if rekognition_labels is not None else None,
+              json.dumps(bounding_boxes) if bounding_boxes is not None else None,
+              image_hash, *(metadata.get(field) for field in METADATA_FIELDS)))
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
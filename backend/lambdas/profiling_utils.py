@@ -0,0 +1,143 @@
+"""
+Opt-in profiling for Lambda handlers.
+
+Switched on per function with PROFILE_MODE (cprofile or sampling); off by
+default, in which case handlers are returned undecorated. A fraction
+PROFILE_SAMPLE_RATE of invocations is profiled and the gzipped result is
+written to S3 under profiles/{execution_id}/, optionally with a tracemalloc
+report (PROFILE_MEMORY=true). Profiling never fails the invocation.
+"""
+import functools
+import gzip
+import json
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from client_utils import get_s3_client
+from log_utils import get_logger
+
+logger = get_logger('profiling_utils')
+
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'off').lower()
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.05))
+PROFILE_MEMORY = os.environ.get('PROFILE_MEMORY', 'false').lower() == 'true'
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))
+PROFILE_PREFIX = 'profiles'
+MEMORY_TOP_LINES = 50
+
+class StackSampler:
+    """Samples every thread's stack on a timer; output is folded stacks for flamegraph tools"""
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    # Same switch names as cProfile.Profile
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                self.samples[';'.join([names.get(thread_id, 'thread')] + stack[::-1])] += 1
+
+    def dump(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common()).encode()
+
+def memory_report(snapshot):
+    """Peak traced memory and the allocation sites holding the most memory"""
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)])
+    return json.dumps({
+        'current_bytes': current,
+        'peak_bytes': peak,
+        'top': [
+            {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:MEMORY_TOP_LINES]
+        ]
+    }).encode()
+
+def write_profile(name, event, context, suffix, data):
+    """Upload one gzipped profile artifact; failures are logged only"""
+    try:
+        execution_id = event.get('execution_id') or event.get('requestContext', {}).get('requestId') or 'no-execution'
+        request_id = getattr(context, 'aws_request_id', None) or 'local'
+        key = f"{PROFILE_PREFIX}/{execution_id}/{name}-{int(time.time())}-{request_id}.{suffix}.gz"
+        get_s3_client().put_object(
+            Bucket=os.environ.get('PROFILE_BUCKET') or os.environ.get('S3_BUCKET'),
+            Key=key,
+            Body=gzip.compress(data),
+            ContentType='application/octet-stream',
+            ContentEncoding='gzip'
+        )
+        logger.info('PROFILE WRITTEN', key=key, bytes=len(data))
+    except Exception as e:
+        logger.warning('PROFILE WRITE FAILED', handler=name, error=str(e))
+
+def profile_handler(name):
+    """
+    Decorator profiling a sample of invocations when PROFILE_MODE is set.
+    cprofile writes pstats data (.prof.gz, load with pstats/snakeviz after
+    gunzip); sampling writes folded stacks (.folded.gz) for flamegraph tools.
+    """
+    def decorator(handler):
+        if PROFILE_MODE not in ('cprofile', 'sampling'):
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if random.random() >= PROFILE_SAMPLE_RATE:
+                return handler(event, context)
+
+            if PROFILE_MODE == 'cprofile':
+                import cProfile
+                profiler = cProfile.Profile()
+            else:
+                profiler = StackSampler()
+            trace_memory = PROFILE_MEMORY and not tracemalloc.is_tracing()
+            if trace_memory:
+                tracemalloc.start()
+            profiler.enable()
+            try:
+                return handler(event, context)
+            finally:
+                # Never let profiling replace the handler's result or exception
+                try:
+                    profiler.disable()
+                    if trace_memory:
+                        try:
+                            report = memory_report(tracemalloc.take_snapshot())
+                        finally:
+                            tracemalloc.stop()
+                        write_profile(name, event, context, 'memory.json', report)
+                    if PROFILE_MODE == 'cprofile':
+                        profiler.create_stats()
+                        write_profile(name, event, context, 'prof', marshal.dumps(profiler.stats))
+                    else:
+                        write_profile(name, event, context, 'folded', profiler.dump())
+                except Exception as e:
+                    logger.warning('PROFILE FAILED', handler=name, error=str(e))
+        return wrapper
+    return decorator
@@ -2,35 +2,56 @@
 Shared utilities for progress tracking and WebSocket updates
 """
 from db_utils import get_db
+from websocket_simple import send_progress_update
+from eta_utils import estimate_progress
+from log_utils import get_logger
 
-def update_batch_progress(batch_id, current_step, progress, execution_id=None):
-    """Update batch progress in database and send WebSocket update"""
+logger = get_logger('progress_utils')
+
+def update_batch_progress(batch_id, current_step, progress, execution_id=None,
+                          image_count=None, stage_elapsed_seconds=0, model=None, fast_path=False):
+    """
+    Update batch progress in database and send WebSocket update.
+    With image_count, progress and the completion estimate come from the
+    fitted stage durations (eta_utils); `progress` is the fallback.
+    """
     try:
+        estimate = None
+        if image_count:
+            try:
+                estimate = estimate_progress(current_step, image_count, stage_elapsed_seconds, model, fast_path)
+            except Exception as e:
+                logger.warning('ETA ERROR', error=str(e))
+        if estimate:
+            progress = estimate['progress']
+
         conn = get_db()
         cur = conn.cursor()
         cur.execute('''
             UPDATE batches 
-            SET current_step = %s, progress = %s, updated_at = NOW() 
+            SET current_step = %s, progress = %s, updated_at = NOW(),
+                estimated_completion_at = %s
             WHERE id = %s
-        ''', (current_step, progress, batch_id))
+        ''', (current_step, progress, estimate and estimate['estimated_completion'], batch_id))
         conn.commit()
-        print(f'Updated batch {batch_id}: {current_step} ({progress}%)')
+        logger.debug('PROGRESS UPDATED', step=current_step, progress=progress,
+                     eta_seconds=estimate and estimate['eta_seconds'])
         
         # Send WebSocket update using execution_id for frontend tracking
         if execution_id:
-            from websocket_simple import send_progress_update
-            
             send_progress_update(execution_id, {
                 'batch_id': batch_id,
                 'execution_id': execution_id,
                 'current_step': current_step,
                 'progress': progress,
                 'status': 'processing',
-                'message': get_step_message(current_step)
+                'message': get_step_message(current_step),
+                'eta_seconds': estimate and estimate['eta_seconds'],
+                'estimated_completion': estimate and estimate['estimated_completion']
             })
             
     except Exception as e:
-        print(f'Failed to update progress: {str(e)}')
+        logger.error('PROGRESS UPDATE ERROR', error=str(e))
 
 def update_batch_completion(batch_id, status, final_data=None, execution_id=None):
     """Mark batch as completed or failed and send final WebSocket update"""
@@ -43,7 +64,7 @@ def update_batch_completion(batch_id, status, final_data=None, execution_id=None
                 UPDATE batches 
                 SET status = %s, current_step = 'Completed', progress = 100, 
                     completed_at = NOW(), updated_at = NOW()
-                WHERE id = %s
+                WHERE id = %s AND status <> 'cancelled'
             ''', (status, batch_id))
         else:
             error_message = final_data.get('error_message', 'Unknown error') if final_data else 'Processing failed'
@@ -51,16 +72,14 @@ def update_batch_completion(batch_id, status, final_data=None, execution_id=None
                 UPDATE batches 
                 SET status = %s, current_step = 'Failed', 
                     completed_at = NOW(), updated_at = NOW(), error_message = %s
-                WHERE id = %s
+                WHERE id = %s AND status <> 'cancelled'
             ''', (status, error_message, batch_id))
         
         conn.commit()
-        print(f'Batch {batch_id} marked as {status}')
+        logger.info('BATCH FINISHED', status=status)
         
         # Send final WebSocket update using execution_id
         if execution_id:
-            from websocket_simple import send_progress_update
-            
             update_data = {
                 'batch_id': batch_id,
                 'execution_id': execution_id,
@@ -76,7 +95,7 @@ def update_batch_completion(batch_id, status, final_data=None, execution_id=None
             send_progress_update(execution_id, update_data)
             
     except Exception as e:
-        print(f'Failed to update completion status: {str(e)}')
+        logger.error('COMPLETION UPDATE ERROR', error=str(e))
 
 def get_step_message(step):
     """Get user-friendly message for current step"""
@@ -84,8 +103,10 @@ def get_step_message(step):
         'ValidateAndSetup': 'Validating request and setting up...',
         'GeneratePrompts': 'Generating creative prompts with AI...',
         'StartImageGeneration': 'Starting image generation process...',
+        'GenerateImagesSync': 'Creating your images...',
         'CheckImageStatus': 'Waiting for images to be created...',
         'ProcessImages': 'Processing and uploading images...',
+        'RepairImages': 'Regenerating missing images...',
         'LabelImages': 'Analyzing images with computer vision...',
         'SaveFinalResults': 'Saving your beautiful results...'
     }
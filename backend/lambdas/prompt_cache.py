@@ -0,0 +1,91 @@
+"""
+Prompt pool cache for repeated contexts, stored in PostgreSQL
+"""
+import hashlib
+import json
+import os
+import re
+from db_utils import get_db
+from log_utils import get_logger
+
+logger = get_logger('prompt_cache')
+
+# Opt-in freshness: pools older than this are regenerated (0 = never stale)
+PROMPT_CACHE_MAX_AGE_HOURS = float(os.environ.get('PROMPT_CACHE_MAX_AGE_HOURS', '0'))
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', '1000'))
+PROMPT_POOL_MAX_SIZE = 500
+
+def normalize_context(context):
+    """Lowercase and collapse whitespace so trivial edits share a cache entry"""
+    return ' '.join((context or '').lower().split())
+
+def normalize_exclude_tags(exclude_tags):
+    """Order-independent, de-duplicated exclude tag list"""
+    tags = re.split(r'[,;\n]', (exclude_tags or '').lower())
+    return sorted({' '.join(tag.split()) for tag in tags if tag.strip()})
+
+def prompt_cache_key(context, exclude_tags, model, template_version):
+    """Stable key for (context, exclude_tags, model, prompt template version)"""
+    normalized = json.dumps([
+        normalize_context(context),
+        normalize_exclude_tags(exclude_tags),
+        model,
+        template_version
+    ])
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def load_prompt_pool(cache_key):
+    """Return the cached prompt pool (empty if missing or stale) and mark it as used"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        if PROMPT_CACHE_MAX_AGE_HOURS > 0:
+            cur.execute('''
+                UPDATE prompt_cache
+                SET last_used_at = NOW(), hit_count = hit_count + 1
+                WHERE cache_key = %s AND updated_at > NOW() - make_interval(secs => %s)
+                RETURNING prompts
+            ''', (cache_key, PROMPT_CACHE_MAX_AGE_HOURS * 3600))
+        else:
+            cur.execute('''
+                UPDATE prompt_cache
+                SET last_used_at = NOW(), hit_count = hit_count + 1
+                WHERE cache_key = %s
+                RETURNING prompts
+            ''', (cache_key,))
+        row = cur.fetchone()
+        conn.commit()
+        return list(row[0]) if row else []
+    except Exception as e:
+        logger.error('PROMPT CACHE LOAD ERROR', error=str(e))
+        if conn:
+            conn.rollback()
+        return []
+
+def store_prompt_pool(cache_key, context, exclude_tags, model, template_version, prompts):
+    """Insert or replace a prompt pool, then evict least recently used entries"""
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO prompt_cache (cache_key, context, exclude_tags, model, template_version, prompts)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE
+            SET prompts = EXCLUDED.prompts, updated_at = NOW(), last_used_at = NOW()
+        ''', (cache_key, context, exclude_tags, model, template_version, json.dumps(prompts[:PROMPT_POOL_MAX_SIZE])))
+        cur.execute('''
+            DELETE FROM prompt_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM prompt_cache
+                ORDER BY last_used_at DESC
+                OFFSET %s
+            )
+        ''', (PROMPT_CACHE_MAX_ENTRIES,))
+        conn.commit()
+        logger.info('PROMPT CACHE STORED', cache_key=cache_key[:12], pool=min(len(prompts), PROMPT_POOL_MAX_SIZE), evicted=cur.rowcount)
+    except Exception as e:
+        logger.error('PROMPT CACHE STORE ERROR', error=str(e))
+        if conn:
+            conn.rollback()
@@ -1,29 +1,30 @@
 import json
-from db_utils import get_db, get_user_db_id
+from credit_utils import credit_user, refund_key
+from coalesce_utils import drop_pending
 from progress_utils import update_batch_completion
+from admission_utils import release_execution
+from metrics_utils import track_stage
+from log_utils import get_logger, set_log_context
 
+logger = get_logger('refund_user')
+
+@track_stage('RefundUser')
 def handler(event, context):
     """
     Error handling: Refund user credits when processing fails
     """
     try:
-        print(f'Event: {event}')
+        set_log_context(execution_id=event.get('execution_id'), batch_id=event.get('batch_id'))
+        logger.info('REFUND START', error=event.get('error'))
         
         batch_id = event.get('batch_id')
         cognito_user_id = event['cognito_user_id']
         cost = event['cost']
         
-        user_db_id = get_user_db_id(cognito_user_id)
-        
-        conn = get_db()
-        cur = conn.cursor()
-        
-        # Refund user credits
-        cur.execute('UPDATE users SET credits = credits + %s WHERE id = %s', (cost, user_db_id))
-        
-        conn.commit()
+        # Keyed by batch, so a retried or repeated refund (or a cancellation) credits the user once
+        balance = credit_user(cognito_user_id, cost, 'refund', refund_key(batch_id, event.get('execution_id')), batch_id)
         
-        print(f"Refunded ${cost} to user {cognito_user_id}")
+        logger.info('REFUNDED' if balance is not None else 'REFUND ALREADY APPLIED', cost=cost, user=cognito_user_id)
         
         # Send failure notification via WebSocket if batch exists
         if batch_id:
@@ -34,6 +35,19 @@ def handler(event, context):
                 'message': f'Processing failed. ${cost:.2f} has been refunded to your account.'
             }, execution_id)
         
+        # Prompt sets still waiting for a Gemini job must not be submitted for a refunded batch
+        if batch_id:
+            try:
+                drop_pending(batch_id)
+            except Exception as e:
+                logger.warning('PENDING PROMPTS NOT DROPPED', error=str(e))
+        
+        # Free the admission slot; the dispatcher reclaims it later if this fails
+        try:
+            release_execution(event.get('execution_id'))
+        except Exception as e:
+            logger.warning('ADMISSION RELEASE FAILED', error=str(e))
+        
         return {
             'batch_id': batch_id,
             'status': 'failed',
@@ -42,7 +56,7 @@ def handler(event, context):
         }
         
     except Exception as e:
-        print(f'❌ REFUND ERROR: {str(e)} | execution_id={execution_id} user={cognito_user_id}')
+        logger.error('REFUND ERROR', error=str(e))
         # Don't raise here - we don't want refund failures to cause more errors
         return {
             'batch_id': event.get('batch_id'),
@@ -0,0 +1,78 @@
+import os
+import time
+from client_utils import get_s3_client
+from progress_utils import update_batch_progress
+from coalesce_utils import IMAGE_MODEL, enqueue_prompts, try_flush_pending, get_assignment
+from process_images import checkpoint_images, load_checkpoint, repair_fields
+from generate_images_sync import generate_and_store_images
+from metrics_utils import track_stage, add_metric
+from log_utils import get_logger, set_log_context
+
+logger = get_logger('repair_images')
+
+# Up to this many missing images are regenerated synchronously; more go in a follow-up batch job
+REPAIR_SYNC_MAX_IMAGES = int(os.environ.get('REPAIR_SYNC_MAX_IMAGES', os.environ.get('FAST_PATH_MAX_IMAGES', 5)))
+
+@track_stage('RepairImages')
+def handler(event, context):
+    """
+    Step 5b: Regenerate prompts that came back without an image.
+    Small repairs run synchronously and return the merged image list; larger
+    ones queue a follow-up Gemini job for just those prompts and return to
+    CheckImageStatus, after which ProcessImages merges them via the checkpoint.
+    """
+    try:
+        variations = event['variations']
+        missing = event['missing_indices']
+        batch_id = event['batch_id']
+        cognito_user_id = event['cognito_user_id']
+        execution_id = event.get('execution_id', 'unknown')
+        repair_attempt = event.get('repair_attempt', 0) + 1
+
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('REPAIR START', missing=len(missing), attempt=repair_attempt)
+        add_metric('ImagesRepairRequested', len(missing))
+
+        update_batch_progress(batch_id, 'RepairImages', 75, execution_id)
+
+        if len(missing) <= REPAIR_SYNC_MAX_IMAGES:
+            bucket = os.environ.get('S3_BUCKET')
+            s3_client = get_s3_client()
+            repaired = generate_and_store_images(missing, variations, batch_id, cognito_user_id, bucket, s3_client)
+            add_metric('ImagesRepaired', repaired)
+
+            stored = load_checkpoint(batch_id)
+            images, images_labeled = checkpoint_images(batch_id, variations, s3_client, bucket, cognito_user_id)
+            logger.info('REPAIR COMPLETE', repaired=repaired, still_missing=len(variations) - len(stored))
+            return {
+                **event,
+                **repair_fields(stored, len(variations), repair_attempt),
+                'repair_attempt': repair_attempt,
+                'repair_mode': 'sync',
+                'images_labeled': images_labeled,
+                'images': images
+            }
+
+        queued_at = time.time()
+        coalesce_request_id = enqueue_prompts(batch_id, execution_id, [variations[i] for i in missing], missing)
+        try_flush_pending()
+        gemini_batch_id, request_offset = get_assignment(coalesce_request_id)
+        logger.info('REPAIR QUEUED', coalesce_request_id=coalesce_request_id, gemini_batch_id=gemini_batch_id)
+
+        return {
+            **event,
+            'repair_attempt': repair_attempt,
+            'repair_mode': 'batch',
+            'needs_repair': False,  # Re-evaluated by ProcessImages once the job is merged
+            'coalesce_request_id': coalesce_request_id,
+            'gemini_batch_id': gemini_batch_id,
+            'request_offset': request_offset,
+            'request_indices': missing,
+            'gemini_started_at': queued_at,
+            'image_model': IMAGE_MODEL,
+            'process_pass': 0
+        }
+
+    except Exception as e:
+        logger.error('REPAIR ERROR', error=str(e))
+        raise Exception(f'Failed to repair images: {str(e)}')
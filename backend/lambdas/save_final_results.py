@@ -1,7 +1,13 @@
 import json
 from db_utils import get_db
 from progress_utils import update_batch_completion
+from admission_utils import release_execution
+from metrics_utils import track_stage, add_metric
+from log_utils import get_logger, set_log_context
 
+logger = get_logger('save_final_results')
+
+@track_stage('SaveFinalResults')
 def handler(event, context):
     """
     Step 7: Save final results to database and mark batch as completed
@@ -11,45 +17,63 @@ def handler(event, context):
         images = event['images']
         execution_id = event.get('execution_id', 'unknown')
         
-        print(f'💾 SAVE START: execution_id={execution_id} batch_id={batch_id} images={len(images)}')
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('SAVE START', images=len(images))
         
         conn = get_db()
         cur = conn.cursor()
         
+        # Claim the batch row first: a cancelled batch gets no images, and a cancel
+        # arriving after this sees current_step SaveFinalResults and is refused
+        cur.execute('''
+            UPDATE batches 
+            SET image_count = %s, current_step = 'SaveFinalResults'
+            WHERE id = %s AND status = 'processing'
+        ''', (len(images), batch_id))
+        if cur.rowcount == 0:
+            conn.rollback()
+            logger.info('BATCH NOT PROCESSING, NOT SAVED')
+            return {**event, 'batch_id': batch_id, 'status': 'cancelled'}
+        
         # Save each image to database
-        print(f'📝 DATABASE: Saving {len(images)} images to batch_id={batch_id}')
         for image in images:
             cur.execute('''
-                INSERT INTO images (batch_id, prompt, url, tags, rekognition_labels, bounding_boxes) 
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT INTO images (batch_id, prompt, url, tags, rekognition_labels, bounding_boxes,
+                                    phash, near_duplicate, width, height, mime_type, byte_size, sha256)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             ''', (
                 batch_id,
                 image['prompt'],
                 image['url'],
                 json.dumps(image.get('tags', [])),
                 json.dumps(image.get('rekognition_labels', [])),
-                json.dumps(image.get('bounding_boxes', []))
+                json.dumps(image.get('bounding_boxes', [])),
+                image.get('phash'),
+                image.get('near_duplicate', False),
+                image.get('width'),
+                image.get('height'),
+                image.get('mime_type'),
+                image.get('byte_size'),
+                image.get('sha256')
             ))
         
-        # Update batch status to completed with WebSocket notification
-        cur.execute('''
-            UPDATE batches 
-            SET image_count = %s 
-            WHERE id = %s
-        ''', (len(images), batch_id))
-        
         conn.commit()
-        print(f'✅ DB SAVED: {len(images)} images committed to database | execution_id={execution_id}')
+        add_metric('ImagesSaved', len(images))
         
         # Send completion notification via WebSocket
-        print(f'📡 WEBSOCKET: Sending completion notification execution_id={execution_id}')
         update_batch_completion(batch_id, 'completed', {
             'image_count': len(images),
             'images': images[:5],  # Send first 5 images for preview
             'message': f'Successfully generated {len(images)} images!'
         }, execution_id)
         
-        print(f'✅ WORKFLOW COMPLETE: execution_id={execution_id} batch_id={batch_id} images={len(images)}')
+        logger.info('WORKFLOW COMPLETE', images=len(images))
+        
+        # Free the admission slot; the dispatcher reclaims it later if this fails
+        try:
+            release_execution(execution_id)
+        except Exception as e:
+            logger.warning('ADMISSION RELEASE FAILED', error=str(e))
         
         return {
             **event,
@@ -60,5 +84,5 @@ def handler(event, context):
         }
         
     except Exception as e:
-        print(f'❌ SAVE ERROR: {str(e)} | execution_id={execution_id} batch_id={batch_id}')
+        logger.error('SAVE ERROR', error=str(e))
         raise Exception(f'Failed to save final results: {str(e)}')
\ No newline at end of file
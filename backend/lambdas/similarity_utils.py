@@ -0,0 +1,54 @@
+"""
+Shared utilities for local (CPU-only) prompt similarity checks
+"""
+import re
+
+SHINGLE_SIZE = 2  # Word n-grams compared between prompts
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Normalized word shingles for a prompt"""
+    words = re.findall(r'[a-z0-9]+', text.lower())
+    if len(words) < size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def jaccard(a, b):
+    """Jaccard similarity of two shingle sets"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def nearest_similarities(prompts):
+    """Highest similarity of each prompt to any other prompt in the list"""
+    sets = [shingles(p) for p in prompts]
+    nearest = [0.0] * len(sets)
+    for i in range(len(sets)):
+        for j in range(i + 1, len(sets)):
+            score = jaccard(sets[i], sets[j])
+            if score > nearest[i]:
+                nearest[i] = score
+            if score > nearest[j]:
+                nearest[j] = score
+    return nearest
+
+def find_near_duplicates(prompts, threshold):
+    """
+    Indices of prompts that are near-duplicates of an earlier, kept prompt.
+    The first prompt of each similar group is kept so only repeats get replaced.
+    """
+    sets = [shingles(p) for p in prompts]
+    kept = []
+    duplicates = []
+    for i, current in enumerate(sets):
+        if any(jaccard(current, sets[k]) >= threshold for k in kept):
+            duplicates.append(i)
+        else:
+            kept.append(i)
+    return duplicates
+
+def diversity_score(prompts):
+    """1 minus the mean nearest-neighbour similarity (1.0 = fully distinct)"""
+    if len(prompts) < 2:
+        return 1.0
+    nearest = nearest_similarities(prompts)
+    return round(1 - sum(nearest) / len(nearest), 3)
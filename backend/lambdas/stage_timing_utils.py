@@ -0,0 +1,85 @@
+"""
+Shared utilities for recording and querying pipeline stage timings
+"""
+from db_utils import get_db
+from log_utils import get_logger
+
+logger = get_logger('stage_timing_utils')
+
+# SQL twin of metrics_utils.image_count_bucket so DB and EMF breakdowns match
+IMAGE_COUNT_BUCKET_SQL = '''
+    CASE
+        WHEN image_count IS NULL THEN 'unknown'
+        WHEN image_count <= 5 THEN '1-5'
+        WHEN image_count <= 20 THEN '6-20'
+        WHEN image_count <= 50 THEN '21-50'
+        WHEN image_count <= 100 THEN '51-100'
+        ELSE '100+'
+    END
+'''
+
+GRANULARITIES = {'hour', 'day', 'week', 'month'}
+
+def record_stage_timing(batch_id, execution_id, stage, image_count, started_at, ended_at, succeeded=True, model=None):
+    """Insert one stage timing row (timestamps are epoch seconds)"""
+    if not isinstance(batch_id, int):
+        return
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO batch_stage_timings
+                (batch_id, execution_id, stage, model, image_count, started_at, ended_at, duration_ms, succeeded)
+            VALUES (%s, %s, %s, %s, %s, to_timestamp(%s), to_timestamp(%s), %s, %s)
+        ''', (batch_id, execution_id, stage, model, image_count, started_at, ended_at,
+              int(round((ended_at - started_at) * 1000)), succeeded))
+        conn.commit()
+    except Exception as e:
+        logger.error('STAGE TIMING ERROR', stage=stage, error=str(e))
+        if conn:
+            conn.rollback()
+
+def get_stage_percentiles(days=30, granularity=None, stage=None):
+    """
+    p50/p95/p99 stage durations over the last `days`, grouped by stage and
+    image_count bucket, optionally split into `granularity` periods.
+    Only successful runs are included.
+    """
+    period_sql = f"date_trunc('{granularity}', started_at)" if granularity in GRANULARITIES else 'NULL::timestamp'
+    params = [days]
+    stage_filter = ''
+    if stage:
+        stage_filter = 'AND stage = %s'
+        params.append(stage)
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT stage,
+               {IMAGE_COUNT_BUCKET_SQL} AS image_count_bucket,
+               {period_sql} AS period,
+               COUNT(*),
+               percentile_cont(0.50) WITHIN GROUP (ORDER BY duration_ms),
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY duration_ms),
+               percentile_cont(0.99) WITHIN GROUP (ORDER BY duration_ms)
+        FROM batch_stage_timings
+        WHERE started_at >= NOW() - make_interval(days => %s)
+          AND succeeded = true
+          {stage_filter}
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+    ''', params)
+
+    return [
+        {
+            'stage': row[0],
+            'image_count_bucket': row[1],
+            'period': row[2].isoformat() if row[2] else None,
+            'count': row[3],
+            'p50_ms': round(row[4]),
+            'p95_ms': round(row[5]),
+            'p99_ms': round(row[6])
+        }
+        for row in cur.fetchall()
+    ]
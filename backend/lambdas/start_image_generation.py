@@ -1,65 +1,48 @@
 import json
-import os
-from google import genai
-from db_utils import get_db
+import time
 from progress_utils import update_batch_progress
+from coalesce_utils import IMAGE_MODEL, enqueue_prompts, try_flush_pending, get_assignment
+from metrics_utils import track_stage
+from log_utils import get_logger, set_log_context
 
-# Configure Gemini
-gemini_client = genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
+logger = get_logger('start_image_generation')
 
+@track_stage('StartImageGeneration')
 def handler(event, context):
     """
-    Step 3: Start Gemini batch job for image generation
+    Step 3: Queue prompts for a (possibly shared) Gemini batch job
     """
     try:
         variations = event['variations']
         batch_id = event['batch_id']
-        cognito_user_id = event['cognito_user_id']
         execution_id = event.get('execution_id', 'unknown')
         
-        print(f'🖼️ START IMAGE GEN: execution_id={execution_id} batch_id={batch_id} prompts={len(variations)}')
+        set_log_context(execution_id=execution_id, batch_id=batch_id)
+        logger.info('START IMAGE GEN', prompts=len(variations))
         
         # Update progress in database
-        update_batch_progress(batch_id, 'StartImageGeneration', 30, execution_id)
+        update_batch_progress(batch_id, 'StartImageGeneration', 30, execution_id, len(variations), model=IMAGE_MODEL)
         
-        # Create batch job with Gemini
-        inline_requests = []
-        for variation in variations:
-            inline_requests.append({
-                'contents': [{
-                    'parts': [{'text': f'Generate a high-quality image based on this prompt: {variation}'}],
-                    'role': 'user'
-                }]
-            })
-        
-        print(f'🚀 GEMINI BATCH: Creating job with {len(inline_requests)} requests')
-        
-        # Create batch job
-        batch_job = gemini_client.batches.create(
-            model="gemini-2.5-flash-image",
-            src=inline_requests,
-            config={
-                'display_name': f"image-generation-{cognito_user_id}-{batch_id}",
-            }
-        )
-        
-        print(f'✅ BATCH CREATED: job_id={batch_job.name} execution_id={execution_id}')
-        
-        # Update database with batch job ID
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('UPDATE batches SET gemini_batch_id = %s WHERE id = %s', 
-                   (batch_job.name, batch_id))
-        conn.commit()
-        print(f'💾 DB UPDATED: batch_id={batch_id} gemini_job={batch_job.name}')
+        # Queue the prompts and submit the pending queue if its window has closed;
+        # otherwise (or if submitting fails) the next gemini_sweeper run submits it
+        queued_at = time.time()
+        coalesce_request_id = enqueue_prompts(batch_id, execution_id, variations)
+        try_flush_pending()
+        gemini_batch_id, request_offset = get_assignment(coalesce_request_id)
+        logger.info('PROMPTS QUEUED', coalesce_request_id=coalesce_request_id,
+                    gemini_batch_id=gemini_batch_id, request_offset=request_offset)
         
         return {
             **event,
-            'gemini_batch_id': batch_job.name,
+            'coalesce_request_id': coalesce_request_id,
+            'gemini_batch_id': gemini_batch_id,
+            'request_offset': request_offset,
+            'gemini_started_at': queued_at,
+            'image_model': IMAGE_MODEL,
             'status': 'processing'
         }
         
     except Exception as e:
-        print(f'❌ IMAGE GEN ERROR: {str(e)} | execution_id={execution_id} batch_id={batch_id}')
+        logger.error('IMAGE GEN ERROR', error=str(e))
         raise Exception(f'Failed to start image generation: {str(e)}')
 
@@ -1,12 +1,15 @@
 import json
 import os
 import stripe
-from db_utils import get_db
+from credit_utils import credit_user
+from log_utils import get_logger, set_log_context
+
+logger = get_logger('stripe_webhook')
 
 stripe.api_key = os.environ['STRIPE_SECRET']
 
 def handler(event, context):
-    print(f"Webhook received: {event}")
+    set_log_context(request_id=getattr(context, 'aws_request_id', None))
     
     try:
         # Verify webhook signature (optional but recommended)
@@ -19,7 +22,7 @@ def handler(event, context):
         else:
             event_data = payload
             
-        print(f"Event type: {event_data.get('type')}")
+        logger.info('WEBHOOK RECEIVED', event_type=event_data.get('type'), stripe_event_id=event_data.get('id'))
         
         # Handle checkout session completed
         if event_data['type'] == 'checkout.session.completed':
@@ -29,24 +32,15 @@ def handler(event, context):
             cognito_user_id = session['metadata']['cognito_user_id']
             amount = float(session['metadata']['amount'])
             
-            print(f"Payment completed for user {cognito_user_id}, amount: ${amount}")
-            
-            # Update user credits in existing users table
-            conn = get_db()
-            cursor = conn.cursor()
-            
-            # Add credits to user account
-            cursor.execute("""
-                UPDATE users 
-                SET credits = credits + %s 
-                WHERE cognito_id = %s
-            """, (amount, cognito_user_id))
             
-            conn.commit()
-            cursor.close()
-            conn.close()
+            # Stripe redelivers events; the event id makes the top-up apply once
+            balance = credit_user(cognito_user_id, amount, 'topup', f"stripe:{event_data['id']}",
+                                  reference=session.get('id'))
             
-            print(f"Added ${amount} credits to user {cognito_user_id}")
+            if balance is None:
+                logger.info('CREDITS ALREADY ADDED', user=cognito_user_id, stripe_event_id=event_data['id'])
+            else:
+                logger.info('CREDITS ADDED', user=cognito_user_id, amount=amount)
         
         return {
             'statusCode': 200,
@@ -57,7 +51,7 @@ def handler(event, context):
         }
         
     except Exception as e:
-        print(f"Webhook error: {e}")
+        logger.error('WEBHOOK ERROR', error=str(e))
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)}),
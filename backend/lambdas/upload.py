@@ -1,10 +1,8 @@
 import json
 import os
-import boto3
 from uuid import uuid4
 from cors_utils import get_cors_headers
-
-s3 = boto3.client('s3')
+from client_utils import get_s3_client
 
 def handler(event, context):
     try:
@@ -16,7 +14,7 @@ def handler(event, context):
         file_ext = filename.split('.')[-1] if '.' in filename else 'jpg'
         key = f"uploads/{uuid4().hex}.{file_ext}"
         
-        url = s3.generate_presigned_url(
+        url = get_s3_client().generate_presigned_url(
             'put_object',
             Params={
                 'Bucket': os.environ['S3_BUCKET'],
@@ -1,16 +1,19 @@
 import json
+from uuid import uuid4
 from db_utils import get_db, get_cognito_user_id, get_cognito_email, get_user_db_id
 from cors_utils import get_cors_headers
+from credit_utils import credit_user, get_balance
+from log_utils import get_logger, set_log_context
+
+logger = get_logger('user')
 
 def handler(event, context):
-    print(f"User function called with method: {event.get('httpMethod')}")
-    print(f"Event: {json.dumps(event)}")
+    set_log_context(request_id=getattr(context, 'aws_request_id', None))
     
     method = event['httpMethod']
     
     # Handle OPTIONS preflight requests without auth
     if method == 'OPTIONS':
-        print("Handling OPTIONS preflight request")
         return {
             'statusCode': 200,
             'headers': get_cors_headers(),
@@ -19,20 +22,15 @@ def handler(event, context):
     
     try:
         cognito_user_id = get_cognito_user_id(event)
-        print(f"Cognito User ID: {cognito_user_id}")
-        
-        # Debug: Print all available claims
-        claims = event['requestContext']['authorizer']['claims']
-        print(f"All Cognito claims: {claims}")
+        logger.debug('USER REQUEST', method=method, user=cognito_user_id)
         
         if method == 'GET':
-            print("Handling GET request for user data")
             return get_user(cognito_user_id, event)
         elif method == 'POST':
             raise Exception("Credit updates not allowed via API")
             
     except Exception as e:
-        print(f"Error in user handler: {e}")
+        logger.error('USER ERROR', error=str(e))
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)}),
@@ -40,44 +38,29 @@ def handler(event, context):
         }
 
 def get_user(cognito_user_id, event):
-    print(f"Getting user data for cognito_user_id: {cognito_user_id}")
-    
     try:
         email = get_cognito_email(event)
-        print(f"User email: {email}")
-        
         user_db_id = get_user_db_id(cognito_user_id, email)
-        print(f"User DB ID: {user_db_id}")
-        
         conn = get_db()
         cur = conn.cursor()
         cur.execute('SELECT email, credits FROM users WHERE id = %s', (user_db_id,))
         user = cur.fetchone()
         cur.close()
-        conn.close()
-        print(f"User data from DB: {user}")
         
         response_data = {
             'id': user_db_id,
             'email': user[0] or '',
             'credits': float(user[1])
         }
-        print(f"Returning response dataaa: {response_data}")
-        
-        response_body = json.dumps(response_data)
-        print(f"JSON response body: {response_body}")
         
-        final_response = {
+        return {
             'statusCode': 200,
-            'body': response_body,
+            'body': json.dumps(response_data),
             'headers': get_cors_headers()
         }
-        print(f"Final Lambda response: {final_response}")
-        
-        return final_response
         
     except Exception as e:
-        print(f"Error getting user: {e}")
+        logger.error('GET USER ERROR', error=str(e), user=cognito_user_id)
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)}),
@@ -87,14 +70,13 @@ def get_user(cognito_user_id, event):
 def update_credits(cognito_user_id, event):
     body = json.loads(event['body'])
     amount = body['amount']
-    user_db_id = get_user_db_id(cognito_user_id)
+    get_user_db_id(cognito_user_id)
     
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('UPDATE users SET credits = credits + %s WHERE id = %s RETURNING credits', 
-                (amount, user_db_id))
-    new_credits = cur.fetchone()[0]
-    conn.commit()
+    # A retried API Gateway request carries the same request id and is applied once
+    request_id = event.get('requestContext', {}).get('requestId') or uuid4().hex
+    new_credits = credit_user(cognito_user_id, amount, 'adjustment', f'api:{request_id}')
+    if new_credits is None:
+        new_credits = get_balance(cognito_user_id)
     
     return {
         'statusCode': 200,
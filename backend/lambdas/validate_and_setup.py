@@ -1,8 +1,16 @@
 import json
 import os
-from db_utils import get_db, get_cognito_user_id, get_user_db_id
+from credit_utils import get_balance, reserve_batch
 from progress_utils import update_batch_progress
+from metrics_utils import track_stage
+from log_utils import get_logger, set_log_context, update_log_context
 
+logger = get_logger('validate_and_setup')
+
+# Requests up to this size use the synchronous fast path instead of a Gemini batch job
+FAST_PATH_MAX_IMAGES = int(os.environ.get('FAST_PATH_MAX_IMAGES', 5))
+
+@track_stage('ValidateAndSetup')
 def handler(event, context):
     """
     Step 1: Validate request and setup batch record
@@ -15,52 +23,39 @@ def handler(event, context):
         cognito_user_id = event['cognito_user_id']
         execution_id = event.get('execution_id', 'unknown')
         
-        print(f'📋 VALIDATE START: execution_id={execution_id} user={cognito_user_id} images={image_count}')
+        set_log_context(execution_id=execution_id)
+        logger.info('VALIDATE START', user=cognito_user_id, images=image_count)
         
         # Validate image count
         if not isinstance(image_count, int) or image_count < 1 or image_count > 100:
-            print(f'❌ VALIDATION ERROR: Invalid image count {image_count}')
+            logger.warning('VALIDATION ERROR', reason='invalid image count', images=image_count)
             raise ValueError('Image count must be between 10 and 100')
         
         # Check user credits
         cost = image_count * 0.05  # $0.05 per image
-        print(f'💰 COST VALIDATION: ${cost:.2f} for {image_count} images')
-        
-        user_db_id = get_user_db_id(cognito_user_id)
-        print(f'👤 USER DB LOOKUP: user_id={user_db_id}')
         
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT credits FROM users WHERE id = %s', (user_db_id,))
-        user_result = cur.fetchone()
+        # Deduct credits (only if they cover the cost) and create the batch record in one statement
+        reservation = reserve_batch(cognito_user_id, cost, context_text, exclude_tags, image_count, execution_id)
         
-        if not user_result:
-            print(f'❌ USER NOT FOUND: user_id={user_db_id}')
-            raise ValueError('User not found')
-            
-        user_credits = user_result[0]
-        print(f'💳 CREDITS CHECK: user has ${user_credits:.2f}, needs ${cost:.2f}')
-        
-        if user_credits < cost:
-            print(f'❌ INSUFFICIENT CREDITS: need ${cost:.2f} but have ${user_credits:.2f}')
+        if not reservation:
+            user_credits = get_balance(cognito_user_id)
+            if user_credits >= cost:
+                # Credits cover it, so the request was cancelled while this stage ran
+                logger.info('GENERATION CANCELLED BEFORE RESERVATION')
+                raise ValueError('Generation was cancelled')
+            logger.info('INSUFFICIENT CREDITS', cost=cost, credits=float(user_credits))
             raise ValueError(f'Insufficient credits. Need ${cost:.2f} but you have ${user_credits:.2f}')
         
-        print(f'💰 DEDUCTING CREDITS: ${cost:.2f} from user_id={user_db_id}')
-        # Deduct credits and create batch record
-        cur.execute('UPDATE users SET credits = credits - %s WHERE id = %s', (cost, user_db_id))
-        
-        # Create batch record with processing status
-        cur.execute('''INSERT INTO batches (user_id, context, exclude_tags, image_count, cost, status, current_step, progress, created_at, updated_at) 
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW()) RETURNING id''',
-                    (user_db_id, context_text, exclude_tags, image_count, cost, 'processing', 'ValidateAndSetup', 10))
-        batch_id = cur.fetchone()[0]
+        batch_id, user_db_id, user_credits = reservation
+        update_log_context(batch_id=batch_id)
+        logger.info('BATCH CREATED', user_db_id=user_db_id, cost=cost)
         
-        conn.commit()
-        print(f'✅ BATCH CREATED: batch_id={batch_id} execution_id={execution_id}')
+        generation_mode = 'sync' if image_count <= FAST_PATH_MAX_IMAGES else 'batch'
         
         # Send progress update
         execution_id = event.get('execution_id')
-        update_batch_progress(batch_id, 'ValidateAndSetup', 10, execution_id)
+        update_batch_progress(batch_id, 'ValidateAndSetup', 10, execution_id, image_count,
+                              fast_path=generation_mode == 'sync')
         
         # Return data for next step
         return {
@@ -69,12 +64,13 @@ def handler(event, context):
             'context': context_text,
             'exclude_tags': exclude_tags,
             'image_count': image_count,
+            'fresh_prompts': event.get('fresh_prompts', False),
+            'generation_mode': generation_mode,
             'cognito_user_id': cognito_user_id,
             'cost': cost,
-            'user_credits': user_credits,
-            'retryCount': 0
+            'user_credits': float(user_credits)
         }
         
     except Exception as e:
-        print(f'Validation error: {str(e)}')
+        logger.error('VALIDATION FAILED', error=str(e))
         raise Exception(f'Validation failed: {str(e)}')
\ No newline at end of file
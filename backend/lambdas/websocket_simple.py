@@ -1,12 +1,10 @@
 import json
 import os
 import time
-import boto3
-from db_utils import get_db
+from client_utils import get_boto3_client, get_connections_table
+from log_utils import get_logger
 
-# DynamoDB for storing connections
-dynamodb = boto3.resource('dynamodb')
-connections_table = dynamodb.Table(os.environ.get('CONNECTIONS_TABLE', 'websocket-connections'))
+logger = get_logger('websocket')
 
 def handler(event, context):
     """
@@ -14,6 +12,7 @@ def handler(event, context):
     """
     try:
         route_key = event.get('requestContext', {}).get('routeKey')
+        connections_table = get_connections_table()
         connection_id = event.get('requestContext', {}).get('connectionId')
         
         if route_key == '$connect':
@@ -45,27 +44,32 @@ def handler(event, context):
         return {'statusCode': 400, 'body': 'Unknown route'}
         
     except Exception as e:
-        print(f'WebSocket error: {str(e)}')
+        logger.error('WEBSOCKET ERROR', error=str(e))
         return {'statusCode': 500}
 
+def management_api_endpoint():
+    """Callback URL of the WebSocket API, used to post to connections"""
+    api_id = os.environ.get('WEBSOCKET_API_ID')
+    stage = os.environ.get('WEBSOCKET_STAGE', 'prod')
+    return f"https://{api_id}.execute-api.{os.environ.get('AWS_REGION', 'eu-west-1')}.amazonaws.com/{stage}"
+
 def send_progress_update(execution_id, progress_data):
     """
     Send progress update to all connections subscribed to this execution
     Called from Step Functions Lambda functions
     """
     try:
+        connections_table = get_connections_table()
+        
         # Get all connections subscribed to this execution
         response = connections_table.scan(
             FilterExpression='execution_id = :eid',
             ExpressionAttributeValues={':eid': execution_id}
         )
+        if not response['Items']:
+            return
         
-        # Get WebSocket API endpoint
-        api_id = os.environ.get('WEBSOCKET_API_ID')
-        stage = os.environ.get('WEBSOCKET_STAGE', 'prod')
-        endpoint_url = f"https://{api_id}.execute-api.{os.environ.get('AWS_REGION', 'eu-west-1')}.amazonaws.com/{stage}"
-        
-        apigateway = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+        apigateway = get_boto3_client('apigatewaymanagementapi', endpoint_url=management_api_endpoint())
         
         message = json.dumps({
             'type': 'progress_update',
@@ -81,13 +85,13 @@ def send_progress_update(execution_id, progress_data):
                     ConnectionId=connection_id,
                     Data=message
                 )
-                print(f'Sent update to {connection_id}')
+                logger.debug('UPDATE SENT', connection_id=connection_id, sample=0.1)
             except apigateway.exceptions.GoneException:
                 # Connection is stale, remove it
                 connections_table.delete_item(Key={'connectionId': connection_id})
-                print(f'Removed stale connection {connection_id}')
+                logger.info('STALE CONNECTION REMOVED', connection_id=connection_id)
             except Exception as e:
-                print(f'Failed to send to {connection_id}: {str(e)}')
+                logger.warning('SEND FAILED', connection_id=connection_id, error=str(e))
                 
     except Exception as e:
-        print(f'Send progress error: {str(e)}')
\ No newline at end of file
+        logger.error('SEND PROGRESS ERROR', error=str(e))
\ No newline at end of file
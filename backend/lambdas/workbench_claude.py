@@ -1,6 +1,5 @@
 import json
-import os
-from anthropic import Anthropic
+from client_utils import get_anthropic_client
 def get_workbench_cors_headers():
     return {
         'Access-Control-Allow-Origin': '*',
@@ -9,9 +8,6 @@ def get_workbench_cors_headers():
         'Content-Type': 'application/json'
     }
 
-# Initialize Anthropic client
-anthropic_client = Anthropic(api_key=os.environ.get('ANTHROPIC_API_KEY'))
-
 def lambda_handler(event, context):
     """
     Workbench endpoint for testing Claude API directly
@@ -53,7 +49,7 @@ def lambda_handler(event, context):
         print(f'Prompt length: {len(prompt)} characters')
         
         # Call Claude API
-        response = anthropic_client.messages.create(
+        response = get_anthropic_client().messages.create(
             model=model,
             max_tokens=max_tokens,
             messages=[{
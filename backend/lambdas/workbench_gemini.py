@@ -1,7 +1,6 @@
 import json
-import os
 import time
-from google import genai
+from client_utils import get_gemini_client
 def get_workbench_cors_headers():
     return {
         'Access-Control-Allow-Origin': '*',
@@ -10,9 +9,6 @@ def get_workbench_cors_headers():
         'Content-Type': 'application/json'
     }
 
-# Configure Gemini client
-gemini_client = genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
-
 def lambda_handler(event, context):
     """
     Workbench: Start Gemini batch job and return job ID immediately
@@ -78,7 +74,7 @@ def lambda_handler(event, context):
                 }]
             })
         
-        batch_job = gemini_client.batches.create(
+        batch_job = get_gemini_client().batches.create(
             model="models/gemini-2.5-flash-image",
             src=inline_requests,
             config={'display_name': f"workbench-{int(time.time())}"}
@@ -1,6 +1,6 @@
 import json
 import os
-import boto3
+from client_utils import get_rekognition_client
 
 def get_workbench_cors_headers():
     return {
@@ -10,9 +10,6 @@ def get_workbench_cors_headers():
         'Content-Type': 'application/json'
     }
 
-# Initialize Rekognition client
-rekognition = boto3.client('rekognition')
-
 def lambda_handler(event, context):
     """
     Workbench endpoint for testing AWS Rekognition on generated images
@@ -149,7 +146,7 @@ def analyze_image_with_rekognition(bucket, s3_key):
         print(f'🤖 REKOGNITION API: bucket={bucket} key={s3_key}')
         
         # Single detect_labels call gets both labels AND bounding boxes
-        response = rekognition.detect_labels(
+        response = get_rekognition_client().detect_labels(
             Image={'S3Object': {'Bucket': bucket, 'Name': s3_key}},
             MaxLabels=20,
             MinConfidence=70
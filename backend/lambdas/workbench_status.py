@@ -1,6 +1,5 @@
 import json
-import os
-from google import genai
+from client_utils import get_gemini_client
 def get_workbench_cors_headers():
     return {
         'Access-Control-Allow-Origin': '*',
@@ -9,9 +8,6 @@ def get_workbench_cors_headers():
         'Content-Type': 'application/json'
     }
 
-# Configure clients
-gemini_client = genai.Client(api_key=os.environ.get('GEMINI_API_KEY'))
-
 def lambda_handler(event, context):
     """
     Workbench: Check job status and return results when ready
@@ -43,7 +39,7 @@ def lambda_handler(event, context):
         # Check batch status (add batches/ prefix for Gemini API)
         full_job_id = f"batches/{job_id}"
         try:
-            batch_status = gemini_client.batches.get(name=full_job_id)
+            batch_status = get_gemini_client().batches.get(name=full_job_id)
         except Exception as e:
             return {
                 'statusCode': 404,
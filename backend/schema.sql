@@ -33,6 +33,9 @@ CREATE TABLE batches (
     error_message TEXT,
     current_step VARCHAR(50),
     progress INTEGER DEFAULT 0,
+    estimated_completion_at TIMESTAMPTZ,
+    prompt_diversity DECIMAL(4,3),
+    execution_id VARCHAR(255),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     completed_at TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -52,9 +55,118 @@ CREATE TABLE images (
     validated BOOLEAN DEFAULT false,
     rejected BOOLEAN DEFAULT false,
     public BOOLEAN DEFAULT false,
+    phash BIGINT,  -- 64-bit perceptual hash (image_hash_utils)
+    near_duplicate BOOLEAN DEFAULT false,
+    width INTEGER,  -- read from the image header at ingest (image_metadata_utils)
+    height INTEGER,
+    mime_type VARCHAR(50),
+    byte_size INTEGER,
+    sha256 CHAR(64),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Cached prompt pools for repeated (context, exclude_tags, model, template) runs
+CREATE TABLE IF NOT EXISTS prompt_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    context TEXT NOT NULL,
+    exclude_tags TEXT,
+    model VARCHAR(100) NOT NULL,
+    template_version INTEGER NOT NULL,
+    prompts JSONB NOT NULL,
+    hit_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Start/end of every pipeline stage run, for fleet-wide latency analytics
+CREATE TABLE IF NOT EXISTS batch_stage_timings (
+    id BIGSERIAL PRIMARY KEY,
+    batch_id INTEGER REFERENCES batches(id) ON DELETE CASCADE,
+    execution_id VARCHAR(255),
+    stage VARCHAR(50) NOT NULL,
+    model VARCHAR(100),
+    image_count INTEGER,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    succeeded BOOLEAN DEFAULT true
+);
+
+-- Prompt sets waiting for / packed into a shared Gemini batch job (coalesce_utils)
+CREATE TABLE IF NOT EXISTS gemini_job_requests (
+    id BIGSERIAL PRIMARY KEY,
+    batch_id INTEGER REFERENCES batches(id) ON DELETE CASCADE,
+    execution_id VARCHAR(255),
+    prompt_count INTEGER NOT NULL,
+    prompts JSONB NOT NULL,
+    prompt_indices JSONB,
+    gemini_batch_id VARCHAR(255),
+    request_offset INTEGER,
+    task_token TEXT,
+    submission_name VARCHAR(255),  -- claim (and Gemini display_name) held while the job is created
+    submitting_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT NOW(),
+    submitted_at TIMESTAMP,
+    resumed_at TIMESTAMP
+);
+
+-- Images ProcessImages has already stored, so a continuation or retry skips them
+CREATE TABLE IF NOT EXISTS image_checkpoints (
+    batch_id INTEGER REFERENCES batches(id) ON DELETE CASCADE,
+    image_index INTEGER NOT NULL,
+    s3_key VARCHAR(500) NOT NULL,
+    rekognition_labels JSONB,
+    bounding_boxes JSONB,
+    phash BIGINT,
+    width INTEGER,
+    height INTEGER,
+    mime_type VARCHAR(50),
+    byte_size INTEGER,
+    sha256 CHAR(64),
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (batch_id, image_index)
+);
+
+-- Append-only credit ledger; users.credits is the materialized sum of amount per user
+CREATE TABLE IF NOT EXISTS credit_transactions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    batch_id INTEGER REFERENCES batches(id) ON DELETE SET NULL,
+    kind VARCHAR(20) NOT NULL,  -- opening, reserve, refund, topup, adjustment
+    amount DECIMAL(10,2) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL UNIQUE,  -- e.g. reserve:batch:42, refund:batch:42, stripe:evt_...
+    reference VARCHAR(255),
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_user ON credit_transactions (user_id, created_at);
+
+-- Generation requests waiting for / holding an admission slot (admission_utils)
+CREATE TABLE IF NOT EXISTS generation_queue (
+    id BIGSERIAL PRIMARY KEY,
+    execution_id VARCHAR(255) NOT NULL UNIQUE,
+    cognito_user_id VARCHAR(255) NOT NULL,
+    workflow_input JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',  -- queued, running, finished, failed, cancelled
+    attempts INTEGER NOT NULL DEFAULT 0,
+    execution_arn VARCHAR(500),
+    created_at TIMESTAMP DEFAULT NOW(),
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_generation_queue_queued ON generation_queue (id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_generation_queue_running ON generation_queue (cognito_user_id) WHERE status = 'running';
+
+-- Idempotency keys for /generate, scoped per user (idempotency_utils)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    idempotency_key VARCHAR(255) PRIMARY KEY,  -- <cognito sub>:<client key> or <cognito sub>:auto:<request hash>
+    request_hash CHAR(64) NOT NULL,
+    execution_id VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    expires_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
+
 -- WebSocket connections table (if using PostgreSQL instead of DynamoDB)
 CREATE TABLE IF NOT EXISTS websocket_connections (
     connection_id VARCHAR(255) PRIMARY KEY,
@@ -80,5 +192,49 @@ CREATE INDEX idx_images_rejected ON images (dataset_id, rejected) WHERE rejected
 CREATE INDEX idx_batches_status ON batches(status);
 CREATE INDEX idx_batches_user_id_status ON batches(user_id, status);
 CREATE INDEX idx_batches_gemini_batch_id ON batches(gemini_batch_id);
+CREATE INDEX IF NOT EXISTS idx_batches_execution_id ON batches(execution_id);
 CREATE INDEX idx_websocket_execution_id ON websocket_connections(execution_id);
-CREATE INDEX idx_websocket_expires_at ON websocket_connections(expires_at);
\ No newline at end of file
+CREATE INDEX idx_websocket_expires_at ON websocket_connections(expires_at);
+CREATE INDEX IF NOT EXISTS idx_prompt_cache_last_used ON prompt_cache(last_used_at DESC);
+CREATE INDEX IF NOT EXISTS idx_stage_timings_batch ON batch_stage_timings(batch_id);
+-- Covering indexes so percentile queries over a time window are index-only scans
+CREATE INDEX IF NOT EXISTS idx_stage_timings_started ON batch_stage_timings(started_at)
+    INCLUDE (stage, image_count, duration_ms) WHERE succeeded = true;
+CREATE INDEX IF NOT EXISTS idx_stage_timings_stage_started ON batch_stage_timings(stage, started_at)
+    INCLUDE (image_count, duration_ms) WHERE succeeded = true;
+CREATE INDEX IF NOT EXISTS idx_gemini_job_requests_pending ON gemini_job_requests(id) WHERE gemini_batch_id IS NULL;
+CREATE INDEX IF NOT EXISTS idx_gemini_job_requests_submission ON gemini_job_requests(submission_name)
+    WHERE submission_name IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_gemini_job_requests_batch ON gemini_job_requests(batch_id);
+
+-- Migrations for existing databases
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS prompt_diversity DECIMAL(4,3);
+ALTER TABLE batch_stage_timings ADD COLUMN IF NOT EXISTS model VARCHAR(100);
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS estimated_completion_at TIMESTAMPTZ;
+ALTER TABLE gemini_job_requests ADD COLUMN IF NOT EXISTS task_token TEXT;
+ALTER TABLE gemini_job_requests ADD COLUMN IF NOT EXISTS resumed_at TIMESTAMP;
+ALTER TABLE gemini_job_requests ADD COLUMN IF NOT EXISTS prompt_indices JSONB;
+ALTER TABLE gemini_job_requests ADD COLUMN IF NOT EXISTS submission_name VARCHAR(255);
+ALTER TABLE gemini_job_requests ADD COLUMN IF NOT EXISTS submitting_at TIMESTAMP;
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS rekognition_labels JSONB;
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS bounding_boxes JSONB;
+ALTER TABLE batches ADD COLUMN IF NOT EXISTS execution_id VARCHAR(255);
+ALTER TABLE images ADD COLUMN IF NOT EXISTS phash BIGINT;
+ALTER TABLE images ADD COLUMN IF NOT EXISTS near_duplicate BOOLEAN DEFAULT false;
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS phash BIGINT;
+ALTER TABLE images ADD COLUMN IF NOT EXISTS width INTEGER;
+ALTER TABLE images ADD COLUMN IF NOT EXISTS height INTEGER;
+ALTER TABLE images ADD COLUMN IF NOT EXISTS mime_type VARCHAR(50);
+ALTER TABLE images ADD COLUMN IF NOT EXISTS byte_size INTEGER;
+ALTER TABLE images ADD COLUMN IF NOT EXISTS sha256 CHAR(64);
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS width INTEGER;
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS height INTEGER;
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS mime_type VARCHAR(50);
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS byte_size INTEGER;
+ALTER TABLE image_checkpoints ADD COLUMN IF NOT EXISTS sha256 CHAR(64);
+-- Opening ledger entry for balances that predate credit_transactions: only users with no ledger rows at all,
+-- since any later balance is already covered by their reserve/topup/refund rows
+INSERT INTO credit_transactions (user_id, kind, amount, idempotency_key)
+SELECT id, 'opening', credits, 'opening:user:' || id FROM users
+WHERE credits <> 0 AND NOT EXISTS (SELECT 1 FROM credit_transactions t WHERE t.user_id = users.id)
+ON CONFLICT (idempotency_key) DO NOTHING;
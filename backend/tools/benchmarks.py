@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Throughput and latency benchmarks for the hot handlers.
+
+Runs against the fakes in local_fakes.py and a local PostgreSQL loaded from
+schema.sql (same setup as pipeline_harness.py). Every case runs in a fresh
+interpreter so environment knobs and peak RSS are per case. Results are
+written as JSON and compared against a saved baseline; exits non-zero when a
+metric regresses past the tolerance.
+
+    python tools/benchmarks.py                          # run all, compare to baseline
+    python tools/benchmarks.py --only export --repeats 5
+    python tools/benchmarks.py --write-baseline         # record current results as the baseline
+    python tools/benchmarks.py --compare results.json   # compare a saved run without re-running
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_PATH = os.path.join(TOOLS_DIR, 'benchmark_results.json')
+BASELINE_PATH = os.path.join(TOOLS_DIR, 'benchmark_baseline.json')
+
+# Per-call delays for the fakes, so concurrency shows up the way it does against AWS
+BENCH_LATENCY_MS = {'s3': 15, 'rekognition': 40, 'apigateway': 5, 'gemini': 0, 'anthropic': 0}
+BENCH_IMAGE_SIZE = 256  # Noise PNGs of ~200 KB
+
+# Which direction is better for each metric name
+HIGHER_IS_BETTER = {'images_per_sec', 'rows_per_sec', 'mb_per_sec'}
+LOWER_IS_BETTER = {'p50_ms', 'p95_ms', 'peak_rss_mb'}
+
+# (benchmark, params, environment overrides)
+CASES = [
+    ('process_images', {'images': 20}, {}),
+    ('process_images', {'images': 100}, {}),
+    ('label_images', {'images': 50}, {}),
+    ('fused_labeling', {'images': 50, 'workers': 1}, {'FUSED_LABELING': 'true', 'PROCESS_PIPELINE_WORKERS': '1'}),
+    ('fused_labeling', {'images': 50, 'workers': 4}, {'FUSED_LABELING': 'true', 'PROCESS_PIPELINE_WORKERS': '4'}),
+    ('fused_labeling', {'images': 50, 'workers': 8}, {'FUSED_LABELING': 'true', 'PROCESS_PIPELINE_WORKERS': '8'}),
+    ('save_final_results', {'images': 100}, {}),
+    ('export', {'format': 'coco', 'images': 50}, {}),
+    ('export', {'format': 'yolo', 'images': 50}, {}),
+    ('get_datasets_with_batches', {'datasets': 5}, {}),
+    ('get_datasets_with_batches', {'datasets': 50}, {}),
+    ('send_progress_update', {'connections': 1}, {}),
+    ('send_progress_update', {'connections': 25}, {}),
+    ('send_progress_update', {'connections': 100}, {}),
+]
+
+def case_name(benchmark, params):
+    return f"{benchmark}[{','.join(f'{k}={v}' for k, v in params.items())}]"
+
+# --- Shared setup (runs inside the case interpreter) ---
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def create_batch(user_db_id, image_count, dataset_id=None):
+    from db_utils import get_db
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute('''INSERT INTO batches (user_id, dataset_id, context, exclude_tags, image_count, cost, status, current_step, progress)
+                   VALUES (%s, %s, %s, %s, %s, %s, 'processing', 'ValidateAndSetup', 10) RETURNING id''',
+                (user_db_id, dataset_id, 'benchmark scene', '', image_count, image_count * 0.05))
+    batch_id = cur.fetchone()[0]
+    conn.commit()
+    return batch_id
+
+def prompts(count):
+    return [f'benchmark scene {i}, wide angle' for i in range(count)]
+
+def lambda_context(module_name):
+    from pipeline_harness import LambdaContext, Template
+    template = Template()
+    return LambdaContext(module_name, template.function(template.function_by_handler(module_name))[2])
+
+def timed(fn, repeats):
+    """Run fn() repeats times; returns the durations in seconds"""
+    durations = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def latency_metrics(durations):
+    return {'p50_ms': round(statistics.median(durations) * 1000, 2),
+            'p95_ms': round(percentile(durations, 95) * 1000, 2)}
+
+def gemini_event(user, count):
+    """ProcessImages input for a fresh batch whose Gemini job has already succeeded"""
+    from coalesce_utils import enqueue_prompts, flush_pending, get_assignment
+    batch_id = create_batch(user['db_id'], count)
+    variations = prompts(count)
+    request_id = enqueue_prompts(batch_id, f'bench-{batch_id}', variations)
+    flush_pending(force=True)
+    gemini_batch_id, request_offset = get_assignment(request_id)
+    return {'batch_id': batch_id, 'variations': variations, 'cognito_user_id': user['cognito_id'],
+            'execution_id': f'bench-{batch_id}', 'image_count': count,
+            'gemini_job': {'gemini_batch_id': gemini_batch_id, 'request_offset': request_offset}}
+
+# --- Benchmarks: each returns a metrics dict ---
+
+def bench_process_images(user, fakes, params, repeats):
+    import process_images
+    count = params['images']
+    durations = []
+    for _ in range(repeats):
+        event = gemini_event(user, count)
+        durations += timed(lambda: process_images.handler(event, lambda_context('process_images')), 1)
+    return {'images_per_sec': round(count / statistics.median(durations), 2), 'peak_rss_mb': peak_rss_mb()}
+
+def bench_label_images(user, fakes, params, repeats):
+    import label_images
+    import process_images
+    count = params['images']
+    event = process_images.handler(gemini_event(user, count), lambda_context('process_images'))
+    durations = timed(lambda: label_images.handler(event, lambda_context('label_images')), repeats)
+    return {'images_per_sec': round(count / statistics.median(durations), 2), 'peak_rss_mb': peak_rss_mb()}
+
+def bench_fused_labeling(user, fakes, params, repeats):
+    """ProcessImages with FUSED_LABELING: upload and label on PROCESS_PIPELINE_WORKERS threads"""
+    return bench_process_images(user, fakes, params, repeats)
+
+def bench_save_final_results(user, fakes, params, repeats):
+    import save_final_results
+    count = params['images']
+    images = [{'prompt': p, 'url': f'https://bench.s3.local/{i}.png', 'tags': ['bench', 'scene'],
+               'rekognition_labels': ['Sky', 'Road'], 'bounding_boxes': []}
+              for i, p in enumerate(prompts(count))]
+    durations = []
+    for _ in range(repeats):
+        event = {'batch_id': create_batch(user['db_id'], count), 'images': images, 'execution_id': 'bench'}
+        durations += timed(lambda: save_final_results.handler(event, lambda_context('save_final_results')), 1)
+    return {'rows_per_sec': round(count / statistics.median(durations), 2)}
+
+def bench_export(user, fakes, params, repeats):
+    import export
+    from local_fakes import canned_png
+    export.requests = fakes['http']
+    s3 = fakes['s3']
+    bucket = os.environ['S3_BUCKET']
+    images = []
+    for i in range(params['images']):
+        key = f'bench/{i}.png'
+        s3.objects[(bucket, key)] = canned_png(i, BENCH_IMAGE_SIZE, noise=True)
+        url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key})
+        images.append({'id': i, 'prompt': f'scene {i}', 'url': url, 'tags': ['bench', f'tag{i % 7}']})
+
+    export_prefix = f"exports/{user['cognito_id']}/"
+    durations = timed(lambda: export.create_export_zip(images, params['format'], user['cognito_id']), repeats)
+    zip_bytes = statistics.median(len(data) for (b, key), data in s3.objects.items() if key.startswith(export_prefix))
+    return {'mb_per_sec': round(zip_bytes / 1e6 / statistics.median(durations), 2),
+            'peak_rss_mb': peak_rss_mb()}
+
+def bench_get_datasets_with_batches(user, fakes, params, repeats):
+    """GET /batches for a user with `datasets` datasets of 4 batches x 10 images"""
+    import batch
+    from db_utils import get_db
+    conn = get_db()
+    cur = conn.cursor()
+    for d in range(params['datasets']):
+        cur.execute('INSERT INTO datasets (user_id, name) VALUES (%s, %s) RETURNING id', (user['db_id'], f'bench {d}'))
+        dataset_id = cur.fetchone()[0]
+        conn.commit()
+        for _ in range(4):
+            batch_id = create_batch(user['db_id'], 10, dataset_id)
+            cur.executemany('INSERT INTO images (batch_id, dataset_id, prompt, url, tags) VALUES (%s, %s, %s, %s, %s)',
+                            [(batch_id, dataset_id, p, f'https://bench.s3.local/{i}.png', '[]')
+                             for i, p in enumerate(prompts(10))])
+        conn.commit()
+
+    batch.get_datasets_with_batches(user['cognito_id'])  # warm up
+    return latency_metrics(timed(lambda: batch.get_datasets_with_batches(user['cognito_id']), max(repeats, 5)))
+
+def bench_send_progress_update(user, fakes, params, repeats):
+    from websocket_simple import send_progress_update
+    execution_id = f'bench-{uuid.uuid4().hex[:8]}'
+    table = fakes['connections_table']
+    for i in range(params['connections']):
+        table.put_item(Item={'connectionId': f'conn-{i}', 'execution_id': execution_id})
+    update = {'step': 'ProcessImages', 'progress': 70, 'message': 'Processing images'}
+    return latency_metrics(timed(lambda: send_progress_update(execution_id, update), max(repeats, 5)))
+
+BENCHMARKS = {
+    'process_images': bench_process_images,
+    'label_images': bench_label_images,
+    'fused_labeling': bench_fused_labeling,
+    'save_final_results': bench_save_final_results,
+    'export': bench_export,
+    'get_datasets_with_batches': bench_get_datasets_with_batches,
+    'send_progress_update': bench_send_progress_update,
+}
+
+def run_case(benchmark, params, env, repeats, output_path):
+    """Case entry point in the child interpreter: set up fakes and database, write metrics JSON"""
+    sys.path.insert(0, TOOLS_DIR)
+    import pipeline_harness
+    pipeline_harness.configure_environment(pipeline_harness.Template(), env)
+    import local_fakes
+
+    fakes = local_fakes.install_fakes(gemini_polls=0, latency_ms=BENCH_LATENCY_MS,
+                                      image_size=BENCH_IMAGE_SIZE, image_noise=True)
+    from db_utils import get_user_db_id
+    from metrics_utils import set_metrics_sink
+    set_metrics_sink(lambda record: None)
+
+    cognito_id = f'bench-{benchmark}-{uuid.uuid4().hex[:8]}'
+    pipeline_harness.ensure_user(cognito_id, credits=0)
+    user = {'cognito_id': cognito_id, 'db_id': get_user_db_id(cognito_id)}
+
+    metrics = BENCHMARKS[benchmark](user, fakes, params, repeats)
+    with open(output_path, 'w') as f:
+        json.dump(metrics, f)
+
+# --- Driver ---
+
+def run_suite(only, repeats):
+    results = {}
+    for benchmark, params, env in CASES:
+        if only and benchmark not in only:
+            continue
+        name = case_name(benchmark, params)
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--case', benchmark, '--params', json.dumps(params),
+                 '--env', json.dumps(env), '--repeats', str(repeats), '--case-output', out.name],
+                capture_output=True, text=True
+            )
+            if proc.returncode != 0:
+                print(f'{name:<50} FAILED')
+                print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.stdout[-500:])
+                results[name] = {'error': (proc.stderr or proc.stdout).strip()[-2000:]}
+                continue
+            results[name] = json.load(open(out.name))
+        print(f"{name:<50} {'  '.join(f'{k}={v}' for k, v in results[name].items())}")
+    return results
+
+def compare(results, baseline, tolerance):
+    """Regression messages for metrics worse than baseline by more than tolerance"""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or 'error' in base:
+            continue
+        if 'error' in metrics:
+            regressions.append(f'{name}: failed to run')
+            continue
+        for metric, value in metrics.items():
+            if metric not in base or not base[metric]:
+                continue
+            change = (value - base[metric]) / base[metric]
+            worse = -change if metric in HIGHER_IS_BETTER else change if metric in LOWER_IS_BETTER else 0
+            marker = 'REGRESSION' if worse > tolerance else ''
+            print(f'  {name:<50} {metric:<15} {base[metric]:>10} -> {value:>10} ({change:+.1%}) {marker}')
+            if marker:
+                regressions.append(f'{name} {metric}: {base[metric]} -> {value} ({change:+.1%})')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot Lambda handlers against local fakes')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS), help='run just these benchmarks')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per case (median reported)')
+    parser.add_argument('--output', default=RESULTS_PATH, help='where to write this run')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (0.2 = 20%%)')
+    parser.add_argument('--write-baseline', action='store_true', help='save results as the new baseline')
+    parser.add_argument('--compare', metavar='RESULTS', help='compare a saved results file instead of running')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    parser.add_argument('--env', help=argparse.SUPPRESS)
+    parser.add_argument('--case-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, json.loads(args.params), json.loads(args.env), args.repeats, args.case_output)
+        return 0
+
+    if args.compare:
+        with open(args.compare) as f:
+            results = json.load(f)['results']
+    else:
+        results = run_suite(args.only, args.repeats)
+        with open(args.output, 'w') as f:
+            json.dump({'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'repeats': args.repeats, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'\nResults written to {args.output}')
+
+    if args.write_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({name: metrics for name, metrics in results.items() if 'error' not in metrics})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'Baseline updated: {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}; run with --write-baseline to create one')
+        return 0 if all('error' not in m for m in results.values()) else 1
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f'\nCompared to {args.baseline} (tolerance {args.tolerance:.0%}):')
+    regressions = compare(results, baseline, args.tolerance)
+    failed = [name for name, metrics in results.items() if 'error' in metrics]
+    if regressions or failed:
+        print(f'\n{len(regressions)} regression(s), {len(failed)} failed case(s)')
+        return 1
+    print('\nNo regressions')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Cold-start import benchmark for every Lambda handler in template.yaml.
+
+Each handler module is imported in a fresh interpreter (several times, median
+reported) and compared against import_budgets.json. Exits non-zero when a
+handler regresses past its budget or fails to import.
+
+    python tools/import_budget.py                 # check against budgets
+    python tools/import_budget.py --verbose       # also show heaviest imports
+    python tools/import_budget.py --write-budgets # record current costs + headroom
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS_DIR = os.path.join(BACKEND_DIR, 'lambdas')
+TEMPLATE_PATH = os.path.join(BACKEND_DIR, 'template.yaml')
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budgets.json')
+
+# Placeholder configuration so modules that read env vars at import can load
+DUMMY_ENV = {
+    'DB_HOST': 'localhost',
+    'DB_NAME': 'databanana',
+    'DB_USER': 'databanana',
+    'DB_PASSWORD': 'databanana',
+    'STRIPE_SECRET': 'sk_test_dummy',
+    'STRIPE_SECRET_TEST': 'sk_test_dummy',
+    'S3_BUCKET': 'databanana-images',
+    'ANTHROPIC_API_KEY': 'dummy',
+    'GEMINI_API_KEY': 'dummy',
+    'AWS_REGION': 'eu-west-1',
+    'AWS_DEFAULT_REGION': 'eu-west-1',
+}
+
+MEASURE_SNIPPET = '''
+import sys, time
+sys.path.insert(0, {lambdas_dir!r})
+start = time.perf_counter()
+import {module}
+print((time.perf_counter() - start) * 1000)
+'''
+
+def handler_modules():
+    """Unique handler modules referenced by template.yaml, in template order"""
+    with open(TEMPLATE_PATH) as f:
+        modules = re.findall(r'^\s*Handler:\s*([A-Za-z0-9_]+)\.', f.read(), re.MULTILINE)
+    return list(dict.fromkeys(modules))
+
+def measure(module, runs, env):
+    """Median import time in ms for module in a fresh interpreter"""
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', MEASURE_SNIPPET.format(lambdas_dir=LAMBDAS_DIR, module=module)],
+            capture_output=True, text=True, env=env
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+def heaviest_imports(module, env, limit=5):
+    """Direct imports of module ranked by cumulative time, from python -X importtime"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import sys; sys.path.insert(0, {LAMBDAS_DIR!r}); import {module}'],
+        capture_output=True, text=True, env=env
+    )
+    # Lines are printed as imports complete, so the module's own imports
+    # are the nested lines right before its top-level line
+    rows = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\| (\s*)(\S+)$', line)
+        if not match:
+            continue
+        cumulative_ms, depth, name = int(match.group(1)) / 1000, len(match.group(2)) // 2, match.group(3)
+        if depth == 0:
+            if name == module:
+                break
+            rows = []
+        elif depth == 1:
+            rows.append((cumulative_ms, name))
+    return sorted(rows, reverse=True)[:limit]
+
+def load_budgets():
+    if not os.path.exists(BUDGETS_PATH):
+        return {'default_ms': 150, 'handlers': {}}
+    with open(BUDGETS_PATH) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-handler cold-start import cost')
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters per handler')
+    parser.add_argument('--verbose', action='store_true', help='show heaviest top-level imports')
+    parser.add_argument('--write-budgets', action='store_true', help='save current costs with headroom as budgets')
+    parser.add_argument('--headroom', type=float, default=1.5, help='multiplier used with --write-budgets')
+    args = parser.parse_args()
+
+    env = {**DUMMY_ENV, **os.environ}
+    budgets = load_budgets()
+    measured = {}
+    failures = []
+
+    print(f'{"handler":<28}{"import ms":>12}{"budget ms":>12}  status')
+    for module in handler_modules():
+        budget = budgets['handlers'].get(module, budgets['default_ms'])
+        try:
+            cost = measure(module, args.runs, env)
+        except RuntimeError as e:
+            failures.append(module)
+            print(f'{module:<28}{"-":>12}{budget:>12.0f}  ERROR {e}')
+            continue
+
+        measured[module] = cost
+        status = 'ok' if cost <= budget else 'OVER BUDGET'
+        if cost > budget:
+            failures.append(module)
+        print(f'{module:<28}{cost:>12.1f}{budget:>12.0f}  {status}')
+
+        if args.verbose:
+            for ms, name in heaviest_imports(module, env):
+                print(f'    {ms:>8.1f} ms  {name}')
+
+    if args.write_budgets:
+        budgets['handlers'] = {
+            module: max(budgets['default_ms'], round(cost * args.headroom, -1))
+            for module, cost in measured.items()
+        }
+        with open(BUDGETS_PATH, 'w') as f:
+            json.dump(budgets, f, indent=2)
+            f.write('\n')
+        print(f'Budgets written to {BUDGETS_PATH}')
+        return 0
+
+    if failures:
+        print(f'\n{len(failures)} handler(s) failed: {", ".join(failures)}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
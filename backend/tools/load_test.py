@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Load generator for the REST handlers.
+
+Synthesizes API Gateway proxy events with Cognito claims for the generate,
+batch, image, user, export and upload endpoints and drives them through
+api_router with configurable concurrency. Each worker is a separate process
+with its own database connection, like a Lambda container. Uses the fakes in
+local_fakes.py and a local PostgreSQL loaded from schema.sql (see
+pipeline_harness.py for the database settings).
+
+    python tools/load_test.py                                  # 500 requests, 10 workers
+    python tools/load_test.py --requests 2000 --concurrency 32
+    python tools/load_test.py --mix "GET /batches=1" --mix "POST /export=0" --json
+
+Reports throughput, p50/p95/p99 latency, status codes and database queries
+per request for every endpoint.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Per-call delays for the fakes; the database is real
+LOAD_LATENCY_MS = {'s3': 15, 'apigateway': 5, 'stepfunctions': 30}
+SEED_BATCHES_PER_USER = 2
+SEED_IMAGES_PER_BATCH = 10
+SEED_SELECTED_PER_BATCH = 3
+
+# endpoint -> default share of requests
+DEFAULT_MIX = {
+    'GET /user': 15,
+    'GET /batches': 25,
+    'GET /images': 20,
+    'PUT /images/{id}': 15,
+    'POST /generate': 10,
+    'POST /upload': 10,
+    'POST /export': 5,
+}
+
+def build_event(endpoint, user, rng):
+    """API Gateway proxy event (REST API, Cognito authorizer) for one request by user"""
+    method, resource = endpoint.split(' ', 1)
+    path, query, path_params, body = resource, None, None, None
+    headers = {'Authorization': 'Bearer load-test', 'Content-Type': 'application/json',
+               'User-Agent': 'databanana-load-test'}
+
+    if endpoint == 'GET /images':
+        query = {'batch_id': str(rng.choice(user['batch_ids']))}
+    elif endpoint == 'PUT /images/{id}':
+        image_id = rng.choice(user['image_ids'])
+        path, path_params = f'/images/{image_id}', {'id': str(image_id)}
+        body = {'selected': rng.random() < 0.5}
+    elif endpoint == 'POST /generate':
+        body = {'context': 'load test street scene', 'image_count': rng.choice([10, 20, 50])}
+        # Distinct requests; without a key identical bodies within a minute count as retries
+        headers['Idempotency-Key'] = str(uuid.UUID(int=rng.getrandbits(128)))
+    elif endpoint == 'POST /upload':
+        body = {'filename': f'photo-{rng.randrange(10 ** 6)}.jpg', 'content_type': 'image/jpeg'}
+    elif endpoint == 'POST /export':
+        body = {'format': rng.choice(['coco', 'yolo'])}
+    elif endpoint == 'POST /batches':
+        body = {'context': 'load test', 'image_count': 10, 'cost': 0.5}
+
+    return {
+        'resource': resource,
+        'path': path,
+        'httpMethod': method,
+        'headers': headers,
+        'queryStringParameters': query,
+        'pathParameters': path_params,
+        'body': json.dumps(body) if body is not None else None,
+        'isBase64Encoded': False,
+        'requestContext': {
+            'requestId': str(uuid.uuid4()),
+            'stage': 'Prod',
+            'resourcePath': resource,
+            'httpMethod': method,
+            'identity': {'sourceIp': '127.0.0.1'},
+            'authorizer': {'claims': {'sub': user['cognito_id'], 'email': user['email'],
+                                      'cognito:username': user['cognito_id']}},
+        },
+    }
+
+# --- Worker process ---
+
+_worker = {}
+
+def worker_init(env, seeded_keys):
+    sys.path.insert(0, TOOLS_DIR)
+    import pipeline_harness
+    pipeline_harness.configure_environment(pipeline_harness.Template(), env)
+    import local_fakes
+    from local_fakes import canned_png
+    import psycopg2
+    import psycopg2.extensions
+    import api_router
+    import db_utils
+    import export
+    from metrics_utils import set_metrics_sink
+
+    fakes = local_fakes.install_fakes(latency_ms=LOAD_LATENCY_MS)
+    bucket = os.environ['S3_BUCKET']
+    for i, key in enumerate(seeded_keys):
+        fakes['s3'].objects[(bucket, key)] = canned_png(i)
+    export.requests = fakes['http']
+    set_metrics_sink(lambda record: None)
+
+    queries = [0]
+
+    class CountingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, params=None):
+            queries[0] += 1
+            return super().execute(query, params)
+
+        def executemany(self, query, params_list):
+            queries[0] += 1
+            return super().executemany(query, params_list)
+
+    # Same settings as db_utils.get_db, with query counting
+    db_utils._connection = psycopg2.connect(
+        host=os.environ['DB_HOST'], database=os.environ['DB_NAME'], user=os.environ['DB_USER'],
+        password=os.environ['DB_PASSWORD'], sslmode=os.environ.get('DB_SSLMODE', 'require'),
+        cursor_factory=CountingCursor
+    )
+    _worker.update(handler=api_router.handler, queries=queries, context=pipeline_harness.LambdaContext)
+
+def run_request(spec):
+    endpoint, event = spec
+    _worker['queries'][0] = 0
+    started = time.perf_counter()
+    try:
+        response = _worker['handler'](event, _worker['context']('ApiRouterFunction', 300))
+        status = response.get('statusCode', 500)
+    except Exception:
+        status = 'exception'
+    return endpoint, status, (time.perf_counter() - started) * 1000, _worker['queries'][0]
+
+# --- Driver ---
+
+def seed_users(count, bucket):
+    """Users with credits, batches and images; returns (users, S3 keys their image URLs point at)"""
+    from db_utils import get_db, get_user_db_id
+    conn = get_db()
+    cur = conn.cursor()
+    users, keys = [], []
+    for u in range(count):
+        cognito_id = f'load-test-user-{u}'
+        email = f'{cognito_id}@local.test'
+        user_db_id = get_user_db_id(cognito_id, email)
+        cur.execute('UPDATE users SET credits = 100000 WHERE id = %s', (user_db_id,))
+        cur.execute('INSERT INTO datasets (user_id, name) VALUES (%s, %s) RETURNING id', (user_db_id, 'load test'))
+        dataset_id = cur.fetchone()[0]
+        user = {'cognito_id': cognito_id, 'email': email, 'batch_ids': [], 'image_ids': []}
+        for b in range(SEED_BATCHES_PER_USER):
+            cur.execute('''INSERT INTO batches (dataset_id, user_id, context, exclude_tags, image_count, cost, status)
+                           VALUES (%s, %s, %s, %s, %s, %s, 'completed') RETURNING id''',
+                        (dataset_id, user_db_id, 'load test', '', SEED_IMAGES_PER_BATCH, SEED_IMAGES_PER_BATCH * 0.05))
+            batch_id = cur.fetchone()[0]
+            user['batch_ids'].append(batch_id)
+            for i in range(SEED_IMAGES_PER_BATCH):
+                key = f'loadtest/{cognito_id}/{b}_{i}.png'
+                keys.append(key)
+                cur.execute('''INSERT INTO images (batch_id, dataset_id, prompt, url, tags, validated)
+                               VALUES (%s, %s, %s, %s, %s, %s) RETURNING id''',
+                            (batch_id, dataset_id, f'load test scene {i}', f'https://{bucket}.s3.local/{key}',
+                             json.dumps(['load', f'tag{i % 4}']), i < SEED_SELECTED_PER_BATCH))
+                user['image_ids'].append(cur.fetchone()[0])
+        users.append(user)
+    conn.commit()
+    return users, keys
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def summarize(records, wall_seconds):
+    by_endpoint = {}
+    for endpoint, status, latency_ms, queries in records:
+        by_endpoint.setdefault(endpoint, []).append((status, latency_ms, queries))
+    report = {}
+    for endpoint, rows in sorted(by_endpoint.items()):
+        latencies = [latency for _, latency, _ in rows]
+        statuses = {}
+        for status, _, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        report[endpoint] = {
+            'requests': len(rows),
+            'throughput_rps': round(len(rows) / wall_seconds, 2),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(max(latencies), 2),
+            'queries_per_request': round(statistics.mean(q for _, _, q in rows), 2),
+            'errors': sum(1 for status, _, _ in rows if status == 'exception' or status >= 500),
+            'statuses': statuses,
+        }
+    return report
+
+def run_load(requests, concurrency, mix, users, seed, env_overrides):
+    sys.path.insert(0, TOOLS_DIR)
+    import pipeline_harness
+    pipeline_harness.configure_environment(pipeline_harness.Template(), env_overrides)
+    os.environ.setdefault('STATE_MACHINE_ARN', 'arn:aws:states:local:000000000000:stateMachine:ImageGenerationStateMachine')
+
+    seeded_users, seeded_keys = seed_users(users, os.environ['S3_BUCKET'])
+    rng = random.Random(seed)
+    endpoints = [e for e, weight in mix.items() if weight > 0]
+    weights = [mix[e] for e in endpoints]
+    specs = []
+    for _ in range(requests):
+        endpoint = rng.choices(endpoints, weights)[0]
+        specs.append((endpoint, build_event(endpoint, rng.choice(seeded_users), rng)))
+
+    env = {key: os.environ[key] for key in pipeline_harness.LOCAL_ENV}
+    env['STATE_MACHINE_ARN'] = os.environ['STATE_MACHINE_ARN']
+    env.update(env_overrides)
+    with multiprocessing.get_context('spawn').Pool(concurrency, worker_init, (env, seeded_keys)) as pool:
+        # Warm every worker (imports, connection) before the clock starts
+        pool.map(time.sleep, [0.2] * concurrency)
+        started = time.perf_counter()
+        records = list(pool.imap_unordered(run_request, specs))
+        wall_seconds = time.perf_counter() - started
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'wall_seconds': round(wall_seconds, 2),
+        'throughput_rps': round(requests / wall_seconds, 2),
+        'endpoints': summarize(records, wall_seconds),
+    }
+
+def print_report(report):
+    print(f"{report['requests']} requests, concurrency {report['concurrency']}: "
+          f"{report['wall_seconds']}s, {report['throughput_rps']} req/s\n")
+    print(f"{'endpoint':<20}{'reqs':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'errors':>8}  statuses")
+    for endpoint, row in report['endpoints'].items():
+        print(f"{endpoint:<20}{row['requests']:>6}{row['throughput_rps']:>9.1f}{row['p50_ms']:>9.1f}"
+              f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['queries_per_request']:>9.1f}{row['errors']:>8}  "
+              + ' '.join(f'{status}:{count}' for status, count in sorted(row['statuses'].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the REST handlers with synthetic API Gateway events')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=10, help='worker processes (concurrent containers)')
+    parser.add_argument('--users', type=int, default=20, help='seeded users requests are spread over')
+    parser.add_argument('--mix', action='append', default=[], metavar='"METHOD /resource=WEIGHT"',
+                        help=f"endpoint weight override; endpoints: {', '.join(DEFAULT_MIX)}, POST /batches")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='environment override')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    sys.path.insert(0, TOOLS_DIR)
+    from pipeline_harness import parse_pairs
+    mix = {**DEFAULT_MIX, **parse_pairs(args.mix, float)}
+    report = run_load(args.requests, args.concurrency, mix, args.users, args.seed, parse_pairs(args.set))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if any(row['errors'] for row in report['endpoints'].values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
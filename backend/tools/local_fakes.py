@@ -0,0 +1,335 @@
+"""
+In-memory stand-ins for the external services the generation pipeline calls.
+
+Used by pipeline_harness.py to run the Step Functions workflow on a laptop:
+Claude returns canned prompts, Gemini returns a small generated PNG per
+request, and S3, Rekognition, DynamoDB and Step Functions keep their state in
+memory. Each fake can add a fixed latency so throughput work sees realistic
+stage proportions.
+"""
+import io
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+SUBJECTS = ['cyclist', 'market stall', 'fox', 'street musician', 'lighthouse', 'tram', 'bakery window',
+            'fishing boat', 'greenhouse', 'skateboarder', 'library', 'vineyard', 'bus stop', 'kitchen',
+            'train platform', 'rooftop garden', 'harbour crane', 'workshop bench', 'ice rink', 'orchard']
+SETTINGS = ['at dawn', 'in heavy rain', 'under neon signs', 'in late autumn', 'at golden hour',
+            'in thick fog', 'after snowfall', 'at midday', 'by candlelight', 'during a storm']
+STYLES = ['wide angle', 'close-up', 'aerial view', 'eye level', 'low angle', 'telephoto',
+          'overhead shot', 'handheld snapshot']
+LABELS = ['Person', 'Vehicle', 'Building', 'Animal', 'Plant', 'Food', 'Furniture', 'Sky', 'Water', 'Road']
+
+def canned_png(seed=0, size=64, noise=False):
+    """
+    Valid RGB PNG with a seed-dependent colour, so uploads differ in content.
+    noise=True fills it with random pixels, giving realistic (incompressible) sizes.
+    """
+    rng = random.Random(seed)
+    if noise:
+        raw = b''.join(b'\x00' + rng.randbytes(size * 3) for _ in range(size))
+    else:
+        pixel = bytes(rng.randrange(256) for _ in range(3))
+        raw = b''.join(b'\x00' + pixel * size for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+def _sleep_ms(latency_ms):
+    if latency_ms:
+        time.sleep(latency_ms / 1000)
+
+def _image_response(seed, missing, size=64, noise=False):
+    """generate_content-shaped response; missing ones carry only a text part"""
+    if missing:
+        part = SimpleNamespace(inline_data=None, text='I cannot generate that image.')
+    else:
+        data = canned_png(seed, size, noise)
+        part = SimpleNamespace(inline_data=SimpleNamespace(data=data, mime_type='image/png'), text=None)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+class FakeGemini:
+    """google-genai client: batch jobs finish after a number of status polls"""
+
+    def __init__(self, polls_until_done=1, missing_rate=0.0, latency_ms=0, seed=0, image_size=64, image_noise=False):
+        self.polls_until_done = polls_until_done
+        self.missing_rate = missing_rate
+        self.latency_ms = latency_ms
+        self.image_size = image_size
+        self.image_noise = image_noise
+        self._rng = random.Random(seed)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.batches = SimpleNamespace(create=self._create_batch, get=self._get_batch, cancel=self._cancel_batch,
+                                       list=self._list_batches)
+        self.models = SimpleNamespace(generate_content=self._generate_content)
+        self.calls = {'batches.create': 0, 'batches.get': 0, 'batches.cancel': 0, 'models.generate_content': 0}
+
+    def _missing(self):
+        with self._lock:
+            return self._rng.random() < self.missing_rate
+
+    def _create_batch(self, model, src, config=None):
+        _sleep_ms(self.latency_ms)
+        with self._lock:
+            self.calls['batches.create'] += 1
+            name = f'batches/local-{len(self._jobs) + 1}'
+            self._jobs[name] = {'requests': list(src), 'polls': 0, 'dest': None,
+                                'display_name': (config or {}).get('display_name')}
+        return SimpleNamespace(name=name, state=SimpleNamespace(name='JOB_STATE_PENDING'))
+
+    def _list_batches(self, config=None):
+        with self._lock:
+            return [SimpleNamespace(name=name, display_name=job['display_name'])
+                    for name, job in reversed(list(self._jobs.items()))]
+
+    def _get_batch(self, name):
+        _sleep_ms(self.latency_ms)
+        with self._lock:
+            self.calls['batches.get'] += 1
+            job = self._jobs[name]
+            job['polls'] += 1
+            done = job['polls'] > self.polls_until_done
+        if job.get('cancelled'):
+            return SimpleNamespace(name=name, state=SimpleNamespace(name='JOB_STATE_CANCELLED'), dest=None)
+        if not done:
+            return SimpleNamespace(name=name, state=SimpleNamespace(name='JOB_STATE_RUNNING'), dest=None)
+        if job['dest'] is None:
+            job['dest'] = SimpleNamespace(inlined_responses=[
+                SimpleNamespace(response=_image_response(hash((name, i)), self._missing(),
+                                                         self.image_size, self.image_noise),
+                                metadata=request.get('metadata'))
+                for i, request in enumerate(job['requests'])
+            ])
+        return SimpleNamespace(name=name, state=SimpleNamespace(name='JOB_STATE_SUCCEEDED'), dest=job['dest'])
+
+    def _cancel_batch(self, name):
+        _sleep_ms(self.latency_ms)
+        with self._lock:
+            self.calls['batches.cancel'] += 1
+            self._jobs[name]['cancelled'] = True
+
+    def _generate_content(self, model, contents, config=None):
+        _sleep_ms(self.latency_ms)
+        with self._lock:
+            self.calls['models.generate_content'] += 1
+            seed = self.calls['models.generate_content']
+        return _image_response(seed, self._missing(), self.image_size, self.image_noise)
+
+class FakeAnthropic:
+    """Anthropic client answering the submit_prompts tool with distinct scene prompts"""
+
+    def __init__(self, latency_ms=0, seed=0):
+        self.latency_ms = latency_ms
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.messages = SimpleNamespace(create=self._create)
+        self.calls = 0
+
+    def _create(self, model, max_tokens, messages, tools=None, tool_choice=None, **kwargs):
+        _sleep_ms(self.latency_ms)
+        match = re.search(r'Generate exactly (\d+)', messages[-1]['content'])
+        count = int(match.group(1)) if match else 1
+        with self._lock:
+            self.calls += 1
+            prompts = [
+                f"{self._rng.choice(SUBJECTS)} {self._rng.choice(SETTINGS)}, {self._rng.choice(STYLES)}, "
+                f"scene {self._rng.randrange(10 ** 6)}"
+                for _ in range(count)
+            ]
+        block = SimpleNamespace(type='tool_use', name=tools[0]['name'] if tools else 'submit_prompts',
+                                input={'prompts': prompts})
+        return SimpleNamespace(content=[block], stop_reason='tool_use')
+
+class FakeS3:
+    """S3 client subset used by the lambdas, keyed by (bucket, key)"""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        _sleep_ms(self.latency_ms)
+        with self._lock:
+            self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        _sleep_ms(self.latency_ms)
+        data = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        with self._lock:
+            for obj in Delete.get('Objects', []):
+                self.objects.pop((Bucket, obj['Key']), None)
+        return {'Deleted': Delete.get('Objects', [])}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys],
+                'KeyCount': len(keys), 'IsTruncated': False}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return f"https://{Params['Bucket']}.s3.local/{Params['Key']}?expires={ExpiresIn}"
+
+class FakeRekognition:
+    """detect_labels with a few deterministic labels, one of them with a bounding box"""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.calls = {'Bytes': 0, 'S3Object': 0}
+
+    def detect_labels(self, Image, MaxLabels=20, MinConfidence=70, **kwargs):
+        _sleep_ms(self.latency_ms)
+        source = 'Bytes' if 'Bytes' in Image else 'S3Object'
+        self.calls[source] += 1
+        names = random.Random(str(Image)[:200]).sample(LABELS, 3)
+        labels = [{'Name': name, 'Confidence': 90.0 - i, 'Instances': []} for i, name in enumerate(names)]
+        labels[0]['Instances'] = [{'Confidence': 88.0,
+                                   'BoundingBox': {'Left': 0.1, 'Top': 0.2, 'Width': 0.5, 'Height': 0.4}}]
+        return {'Labels': labels[:MaxLabels]}
+
+class FakeConnectionsTable:
+    """DynamoDB WebSocket connections table; no clients are subscribed unless put_item is called"""
+
+    def __init__(self):
+        self.items = {}
+
+    def scan(self, FilterExpression=None, ExpressionAttributeValues=None, **kwargs):
+        execution_id = (ExpressionAttributeValues or {}).get(':eid')
+        items = [item for item in self.items.values()
+                 if execution_id is None or item.get('execution_id') == execution_id]
+        return {'Items': items}
+
+    def put_item(self, Item, **kwargs):
+        self.items[Item['connectionId']] = dict(Item)
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop(Key['connectionId'], None)
+
+    def update_item(self, Key, ExpressionAttributeValues=None, **kwargs):
+        item = self.items.setdefault(Key['connectionId'], {'connectionId': Key['connectionId']})
+        item['execution_id'] = (ExpressionAttributeValues or {}).get(':eid')
+
+class FakeManagementApi:
+    """API Gateway management API; post_to_connection records the messages it was given"""
+
+    class GoneException(Exception):
+        pass
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.exceptions = SimpleNamespace(GoneException=self.GoneException)
+        self.sent = 0
+
+    def post_to_connection(self, ConnectionId, Data):
+        _sleep_ms(self.latency_ms)
+        self.sent += 1
+        return {}
+
+class FakeHttp:
+    """requests-style get() that serves the presigned URLs issued by FakeS3"""
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def get(self, url, timeout=None, **kwargs):
+        match = re.match(r'https://([^.]+)\.s3\.local/([^?]+)', url)
+        data = self.s3.objects.get((match.group(1), match.group(2))) if match else None
+        if data is None:
+            return SimpleNamespace(status_code=404, headers={}, content=b'')
+        _sleep_ms(self.s3.latency_ms)
+        return SimpleNamespace(status_code=200, headers={'content-type': 'image/png'}, content=data)
+
+class FakeStepFunctions:
+    """
+    Step Functions client that records started executions and task-token callbacks.
+    Executions stay RUNNING for describe_execution until statuses says otherwise.
+    """
+
+    class ExecutionAlreadyExists(Exception):
+        pass
+
+    class TaskDoesNotExist(Exception):
+        pass
+
+    class TaskTimedOut(Exception):
+        pass
+
+    class InvalidToken(Exception):
+        pass
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.exceptions = SimpleNamespace(ExecutionAlreadyExists=self.ExecutionAlreadyExists,
+                                          TaskDoesNotExist=self.TaskDoesNotExist,
+                                          TaskTimedOut=self.TaskTimedOut, InvalidToken=self.InvalidToken)
+        self.callbacks = {}
+        self.executions = {}
+        self.statuses = {}
+
+    def start_execution(self, stateMachineArn, name, input):
+        _sleep_ms(self.latency_ms)
+        if name in self.executions:
+            raise self.ExecutionAlreadyExists(name)
+        self.executions[name] = json.loads(input)
+        return {'executionArn': f'{stateMachineArn.replace(":stateMachine:", ":execution:")}:{name}',
+                'startDate': time.time()}
+
+    def describe_execution(self, executionArn):
+        _sleep_ms(self.latency_ms)
+        name = executionArn.rsplit(':', 1)[-1]
+        return {'executionArn': executionArn, 'name': name, 'status': self.statuses.get(name, 'RUNNING')}
+
+    def send_task_success(self, taskToken, output):
+        self.callbacks[taskToken] = ('success', output)
+        return {}
+
+    def send_task_failure(self, taskToken, error=None, cause=None):
+        self.callbacks[taskToken] = ('failure', {'Error': error, 'Cause': cause})
+        return {}
+
+def install_fakes(gemini_polls=1, missing_rate=0.0, seed=0, latency_ms=None, image_size=64, image_noise=False):
+    """
+    Build a fake for every external client and register it with client_utils.
+    latency_ms maps service name (anthropic, gemini, s3, rekognition, apigateway, stepfunctions)
+    to a delay per call.
+    """
+    import client_utils
+    from websocket_simple import management_api_endpoint
+
+    latency_ms = latency_ms or {}
+    fakes = {
+        'anthropic': FakeAnthropic(latency_ms.get('anthropic', 0), seed),
+        'gemini': FakeGemini(gemini_polls, missing_rate, latency_ms.get('gemini', 0), seed, image_size, image_noise),
+        's3': FakeS3(latency_ms.get('s3', 0)),
+        'rekognition': FakeRekognition(latency_ms.get('rekognition', 0)),
+        'stepfunctions': FakeStepFunctions(latency_ms.get('stepfunctions', 0)),
+        'connections_table': FakeConnectionsTable(),
+    }
+    for name, client in fakes.items():
+        client_utils.set_client(name, client)
+    fakes['apigatewaymanagementapi'] = FakeManagementApi(latency_ms.get('apigateway', 0))
+    client_utils.set_client('apigatewaymanagementapi', fakes['apigatewaymanagementapi'],
+                            endpoint_url=management_api_endpoint())
+    fakes['http'] = FakeHttp(fakes['s3'])
+    return fakes
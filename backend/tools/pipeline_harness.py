@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+"""
+Offline runner for the image generation workflow.
+
+Interprets the ImageGenerationStateMachine definition in template.yaml
+(Task, Choice, Pass, Wait, Succeed, Fail with Retry, Catch and the path
+fields) and invokes the real Lambda handlers in-process. External services
+are replaced by the fakes in local_fakes.py; PostgreSQL is a local database
+loaded from schema.sql. Task-token waits are resumed by running the Gemini
+sweeper the way its schedule would. Prints per-state timings for the runs.
+
+    python tools/pipeline_harness.py --init-schema              # first run on an empty database
+    python tools/pipeline_harness.py --images 20 --runs 3       # 3 executions of 20 images
+    python tools/pipeline_harness.py --images 4 --missing-rate 0.25 --json
+    python tools/pipeline_harness.py --set FUSED_LABELING=true --latency gemini=200 --latency s3=30
+
+Database settings come from DB_HOST/DB_NAME/DB_USER/DB_PASSWORD (defaults:
+localhost, databanana, postgres, postgres) with DB_SSLMODE=disable.
+"""
+import argparse
+import copy
+import importlib
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import uuid
+
+import yaml
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS_DIR = os.path.join(BACKEND_DIR, 'lambdas')
+TEMPLATE_PATH = os.path.join(BACKEND_DIR, 'template.yaml')
+SCHEMA_PATH = os.path.join(BACKEND_DIR, 'schema.sql')
+STATE_MACHINE = 'ImageGenerationStateMachine'
+
+LOCAL_ENV = {
+    'DB_HOST': 'localhost',
+    'DB_NAME': 'databanana',
+    'DB_USER': 'postgres',
+    'DB_PASSWORD': 'postgres',
+    'DB_SSLMODE': 'disable',
+    'S3_BUCKET': 'databanana-local',
+    'ANTHROPIC_API_KEY': 'local',
+    'GEMINI_API_KEY': 'local',
+    'AWS_REGION': 'eu-west-1',
+    'AWS_DEFAULT_REGION': 'eu-west-1',
+    'LOG_LEVEL': 'WARNING',
+    # Canned images are flat colours that all hash alike; --set PHASH_DUPLICATE_DISTANCE=8 to exercise detection
+    'PHASH_DUPLICATE_DISTANCE': '0',
+}
+PAYLOAD_LIMIT_BYTES = 256 * 1024  # Step Functions state input/output limit
+MAX_STATE_TRANSITIONS = 500
+
+class CfnLoader(yaml.SafeLoader):
+    """SafeLoader that keeps CloudFormation short-form tags (!Ref, !GetAtt, ...) as Fn:: dicts"""
+
+def _cfn_tag(loader, tag_suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {'Ref' if tag_suffix == 'Ref' else f'Fn::{tag_suffix}': value}
+
+CfnLoader.add_multi_constructor('!', _cfn_tag)
+
+class StatesError(Exception):
+    """Workflow error with a Step Functions error name"""
+
+    def __init__(self, error, cause=''):
+        super().__init__(f'{error}: {cause}')
+        self.error = error
+        self.cause = cause
+
+class LambdaContext:
+    """Minimal Lambda context whose remaining time counts down from the function timeout"""
+
+    def __init__(self, function_name, timeout_seconds):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+class Template:
+    """Functions, environment and state machine definition from template.yaml"""
+
+    def __init__(self, path=TEMPLATE_PATH):
+        with open(path) as f:
+            doc = yaml.load(f, Loader=CfnLoader)
+        self.parameters = doc.get('Parameters', {})
+        self.resources = doc['Resources']
+        self.globals = doc.get('Globals', {}).get('Function', {})
+        self.definition = self.resources[STATE_MACHINE]['Properties']['Definition']
+
+    def resolve(self, value):
+        """Plain value of a template expression; None when it needs a deployed resource"""
+        if isinstance(value, dict) and 'Ref' in value:
+            return self.parameters.get(value['Ref'], {}).get('Default')
+        if isinstance(value, dict):
+            return None
+        return value
+
+    def function(self, resource):
+        """(logical id, handler module, timeout) of a Task Resource / FunctionName"""
+        if isinstance(resource, dict) and 'Fn::GetAtt' in resource:
+            target = resource['Fn::GetAtt']
+            logical_id = target[0] if isinstance(target, list) else target.split('.')[0]
+        else:
+            logical_id = str(resource)
+        props = self.resources[logical_id]['Properties']
+        module = props['Handler'].rsplit('.', 1)[0]
+        return logical_id, module, int(props.get('Timeout', self.globals.get('Timeout', 3)))
+
+    def function_by_handler(self, module):
+        for logical_id, resource in self.resources.items():
+            if resource.get('Properties', {}).get('Handler', '').rsplit('.', 1)[0] == module:
+                return logical_id
+        raise KeyError(module)
+
+    def workflow_environment(self):
+        """Global plus per-function variables of every function the workflow invokes"""
+        env = {}
+        for key, value in self.globals.get('Environment', {}).get('Variables', {}).items():
+            env[key] = self.resolve(value)
+        for state in self.definition['States'].values():
+            resource = state.get('Parameters', {}).get('FunctionName', state.get('Resource'))
+            if not isinstance(resource, dict):
+                continue
+            logical_id = self.function(resource)[0]
+            variables = self.resources[logical_id]['Properties'].get('Environment', {}).get('Variables', {})
+            for key, value in variables.items():
+                env[key] = self.resolve(value)
+        return {key: str(value) for key, value in env.items() if value is not None}
+
+# --- JSONPath subset used by the definition ---
+
+_PATH_PART = re.compile(r'([^.\[\]]+)|\[(\d+)\]')
+
+def _path_parts(path):
+    if path == '$':
+        return []
+    if not path.startswith('$.'):
+        raise StatesError('States.Runtime', f'Unsupported path {path}')
+    return [int(index) if index else name for name, index in _PATH_PART.findall(path[2:])]
+
+_MISSING = object()
+
+def get_path(data, path, context=None):
+    if path.startswith('$$'):
+        data, path = context, path[1:]
+    value = data
+    for part in _path_parts(path):
+        try:
+            value = value[part]
+        except (KeyError, IndexError, TypeError):
+            return _MISSING
+    return value
+
+def require_path(data, path, context=None):
+    value = get_path(data, path, context)
+    if value is _MISSING:
+        raise StatesError('States.Runtime', f'Invalid path {path}')
+    return value
+
+def set_path(data, path, value):
+    """Copy of data with value placed at ResultPath (null keeps the input, $ replaces it)"""
+    if path is None:
+        return data
+    parts = _path_parts(path)
+    if not parts:
+        return value
+    result = copy.deepcopy(data)
+    target = result
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    target[parts[-1]] = value
+    return result
+
+def build_parameters(template, data, context):
+    """Resolve a Parameters/Payload block: keys ending in .$ are paths into input or context"""
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                result[key[:-2]] = require_path(data, value, context)
+            else:
+                result[key] = build_parameters(value, data, context)
+        return result
+    if isinstance(template, list):
+        return [build_parameters(item, data, context) for item in template]
+    return template
+
+# --- Choice rules ---
+
+_COMPARATORS = {
+    'StringEquals': (str, lambda a, b: a == b),
+    'NumericEquals': ((int, float), lambda a, b: a == b),
+    'NumericGreaterThan': ((int, float), lambda a, b: a > b),
+    'NumericGreaterThanEquals': ((int, float), lambda a, b: a >= b),
+    'NumericLessThan': ((int, float), lambda a, b: a < b),
+    'NumericLessThanEquals': ((int, float), lambda a, b: a <= b),
+    'BooleanEquals': (bool, lambda a, b: a is b),
+}
+
+def evaluate_rule(rule, data):
+    if 'And' in rule:
+        return all(evaluate_rule(r, data) for r in rule['And'])
+    if 'Or' in rule:
+        return any(evaluate_rule(r, data) for r in rule['Or'])
+    if 'Not' in rule:
+        return not evaluate_rule(rule['Not'], data)
+
+    value = get_path(data, rule['Variable'])
+    if 'IsPresent' in rule:
+        return (value is not _MISSING) == rule['IsPresent']
+    if value is _MISSING:
+        raise StatesError('States.Runtime', f"Invalid path {rule['Variable']} in Choice rule")
+    if 'IsNull' in rule:
+        return (value is None) == rule['IsNull']
+    for name, (kind, compare) in _COMPARATORS.items():
+        if name in rule:
+            if kind is not bool and isinstance(value, bool):
+                return False
+            return isinstance(value, kind) and compare(value, rule[name])
+    raise StatesError('States.Runtime', f'Unsupported Choice rule {sorted(rule)}')
+
+def error_matches(error_equals, error):
+    if 'States.ALL' in error_equals or error in error_equals:
+        return True
+    return 'States.TaskFailed' in error_equals and error != 'States.Timeout' and not error.startswith('States.Runtime')
+
+# --- Interpreter ---
+
+class Execution:
+    """One run of the state machine; timings holds a record per state entered"""
+
+    def __init__(self, template, name, token_resolver, sleep_waits=False):
+        self.template = template
+        self.name = name
+        self.token_resolver = token_resolver
+        self.sleep_waits = sleep_waits
+        self.timings = []
+        self.warnings = []
+
+    def run(self, execution_input):
+        definition = self.template.definition
+        context = {
+            'Execution': {'Id': f'local:{self.name}', 'Name': self.name, 'Input': execution_input,
+                          'StartTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+            'StateMachine': {'Name': STATE_MACHINE},
+        }
+        data = json.loads(json.dumps(execution_input))
+        state_name = definition['StartAt']
+        for _ in range(MAX_STATE_TRANSITIONS):
+            state = definition['States'][state_name]
+            context['State'] = {'Name': state_name}
+            kind = state['Type']
+
+            if kind == 'Succeed':
+                self._record(state_name, kind, 0)
+                return 'SUCCEEDED', state_name, data
+            if kind == 'Fail':
+                self._record(state_name, kind, 0)
+                return 'FAILED', state_name, data
+            if kind == 'Choice':
+                next_state = next((rule['Next'] for rule in state['Choices'] if evaluate_rule(rule, data)),
+                                  state.get('Default'))
+                if next_state is None:
+                    raise StatesError('States.NoChoiceMatched', state_name)
+                self._record(state_name, kind, 0)
+                state_name = next_state
+                continue
+
+            if kind == 'Task':
+                data, next_state = self._run_task(state_name, state, data, context)
+                if next_state:
+                    state_name = next_state
+                    continue
+            elif kind == 'Pass':
+                result = state.get('Result', data)
+                if 'Parameters' in state:
+                    result = build_parameters(state['Parameters'], data, context)
+                data = set_path(data, state.get('ResultPath', '$'), result)
+                self._record(state_name, kind, 0)
+            elif kind == 'Wait':
+                seconds = state.get('Seconds') or require_path(data, state.get('SecondsPath', '$'))
+                if self.sleep_waits:
+                    time.sleep(seconds)
+                self._record(state_name, kind, seconds * 1000 if self.sleep_waits else 0)
+            else:
+                raise StatesError('States.Runtime', f'Unsupported state type {kind}')
+
+            if state.get('End'):
+                return 'SUCCEEDED', state_name, data
+            state_name = state['Next']
+        raise StatesError('States.Runtime', f'More than {MAX_STATE_TRANSITIONS} state transitions')
+
+    def _run_task(self, state_name, state, data, context):
+        """Run a Task with its Retry policy; returns (output, Catch target or None)"""
+        attempts = {}
+        while True:
+            started = time.perf_counter()
+            try:
+                task_input = get_path(data, state['InputPath']) if 'InputPath' in state else data
+                result = self._invoke(state, task_input, context)
+                self._record(state_name, 'Task', (time.perf_counter() - started) * 1000, sum(attempts.values()))
+                output = set_path(data, state.get('ResultPath', '$'), result)
+                return self._check_payload(state_name, output), None
+            except Exception as e:
+                error = e if isinstance(e, StatesError) else StatesError(type(e).__name__, str(e))
+                self._record(state_name, 'Task', (time.perf_counter() - started) * 1000, sum(attempts.values()), error.error)
+
+            retrier = next((r for r in state.get('Retry', []) if error_matches(r['ErrorEquals'], error.error)), None)
+            if retrier is not None:
+                key = id(retrier)
+                attempts[key] = attempts.get(key, 0) + 1
+                if attempts[key] <= retrier.get('MaxAttempts', 3):
+                    if self.sleep_waits:
+                        interval = retrier.get('IntervalSeconds', 1)
+                        time.sleep(interval * retrier.get('BackoffRate', 2.0) ** (attempts[key] - 1))
+                    continue
+
+            catcher = next((c for c in state.get('Catch', []) if error_matches(c['ErrorEquals'], error.error)), None)
+            if catcher is None:
+                raise error
+            output = set_path(data, catcher.get('ResultPath', '$'), {'Error': error.error, 'Cause': error.cause})
+            return output, catcher['Next']
+
+    def _invoke(self, state, task_input, context):
+        resource = state['Resource']
+        if resource == 'arn:aws:states:::lambda:invoke.waitForTaskToken':
+            token = f'{self.name}:{context["State"]["Name"]}:{uuid.uuid4().hex}'
+            context['Task'] = {'Token': token}
+            payload = build_parameters(state['Parameters']['Payload'], task_input, context)
+            self._call_lambda(state['Parameters']['FunctionName'], payload)
+            outcome, output = self.token_resolver(token)
+            if outcome == 'failure':
+                raise StatesError(output.get('Error') or 'States.TaskFailed', output.get('Cause') or '')
+            return json.loads(output)
+        if resource == 'arn:aws:states:::lambda:invoke':
+            payload = build_parameters(state['Parameters']['Payload'], task_input, context)
+            return {'Payload': self._call_lambda(state['Parameters']['FunctionName'], payload), 'StatusCode': 200}
+        if 'Parameters' in state:
+            task_input = build_parameters(state['Parameters'], task_input, context)
+        return self._call_lambda(resource, task_input)
+
+    def _call_lambda(self, resource, payload):
+        logical_id, module_name, timeout = self.template.function(resource)
+        handler = importlib.import_module(module_name).handler
+        started = time.monotonic()
+        result = handler(json.loads(json.dumps(payload)), LambdaContext(logical_id, timeout))
+        if time.monotonic() - started > timeout:
+            self.warnings.append(f'{logical_id} ran past its {timeout}s timeout')
+        # Step Functions only carries JSON; fail the same way on anything else
+        return json.loads(json.dumps(result))
+
+    def _check_payload(self, state_name, output):
+        size = len(json.dumps(output))
+        if size > PAYLOAD_LIMIT_BYTES:
+            raise StatesError('States.DataLimitExceeded', f'{state_name} output is {size} bytes')
+        self.timings[-1]['output_bytes'] = size
+        return output
+
+    def _record(self, state, kind, duration_ms, retry=0, error=None):
+        self.timings.append({'state': state, 'type': kind, 'duration_ms': round(duration_ms, 2),
+                             'retry': retry, 'error': error})
+
+# --- Harness setup ---
+
+def configure_environment(template, overrides):
+    """Workflow variables from the template, local defaults, then overrides and the caller's env"""
+    env = {**template.workflow_environment(), **LOCAL_ENV}
+    for key, value in env.items():
+        os.environ.setdefault(key, value)
+    os.environ.update(overrides)
+    if LAMBDAS_DIR not in sys.path:
+        sys.path.insert(0, LAMBDAS_DIR)
+
+def init_schema():
+    from db_utils import get_db
+    conn = get_db()
+    with open(SCHEMA_PATH) as f:
+        conn.cursor().execute(f.read())
+    conn.commit()
+
+def ensure_user(cognito_user_id, credits):
+    from db_utils import get_db, get_user_db_id
+    user_db_id = get_user_db_id(cognito_user_id, f'{cognito_user_id}@local.test')
+    conn = get_db()
+    conn.cursor().execute('UPDATE users SET credits = %s WHERE id = %s', (credits, user_db_id))
+    conn.commit()
+
+def sweeper_resolver(template, fakes, max_sweeps, sweep_interval):
+    """Resume a parked task by running gemini_sweeper until the token gets a callback"""
+    module = importlib.import_module('gemini_sweeper')
+    timeout = template.function(template.function_by_handler('gemini_sweeper'))[2]
+    callbacks = fakes['stepfunctions'].callbacks
+
+    def resolve(token):
+        for _ in range(max_sweeps):
+            module.handler({}, LambdaContext('GeminiSweeperFunction', timeout))
+            if token in callbacks:
+                return callbacks.pop(token)
+            time.sleep(sweep_interval)
+        raise StatesError('States.Timeout', f'No callback after {max_sweeps} sweeps')
+    return resolve
+
+def summarize(runs):
+    """Per-state count/mean/p50/max over every run, in first-seen order"""
+    durations = {}
+    for run in runs:
+        for timing in run['timings']:
+            if timing['type'] in ('Task', 'Wait'):
+                durations.setdefault(timing['state'], []).append(timing['duration_ms'])
+    return {
+        state: {
+            'count': len(values),
+            'total_ms': round(sum(values), 2),
+            'mean_ms': round(statistics.mean(values), 2),
+            'p50_ms': round(statistics.median(values), 2),
+            'max_ms': round(max(values), 2),
+        }
+        for state, values in durations.items()
+    }
+
+def run_harness(images=5, runs=1, context='a busy city street', cognito_user_id='local-harness-user',
+                gemini_polls=1, missing_rate=0.0, seed=0, latency_ms=None, env_overrides=None,
+                max_sweeps=50, sweep_interval=0.0, sleep_waits=False, init_db=False):
+    """Run the workflow `runs` times against the fakes; returns a JSON-serialisable report"""
+    template = Template()
+    configure_environment(template, env_overrides or {})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import local_fakes
+    from metrics_utils import set_metrics_sink
+
+    fakes = local_fakes.install_fakes(gemini_polls, missing_rate, seed, latency_ms)
+    metric_records = []
+    set_metrics_sink(metric_records.append)
+    try:
+        if init_db:
+            init_schema()
+        ensure_user(cognito_user_id, credits=images * runs * 10)
+        resolver = sweeper_resolver(template, fakes, max_sweeps, sweep_interval)
+
+        results = []
+        for i in range(runs):
+            name = f'image-generation-{cognito_user_id}-{int(time.time())}-{i}'
+            execution = Execution(template, name, resolver, sleep_waits)
+            execution_input = {'context': context, 'exclude_tags': [], 'image_count': images,
+                               'fresh_prompts': True, 'cognito_user_id': cognito_user_id, 'execution_id': name}
+            started = time.perf_counter()
+            try:
+                status, final_state, output = execution.run(execution_input)
+                error = None
+            except StatesError as e:
+                status, final_state, output, error = 'FAILED', None, {}, e.error
+            results.append({
+                'execution_id': name,
+                'status': status,
+                'final_state': final_state,
+                'error': error,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+                'images': len(output.get('images', [])),
+                'path': [t['state'] for t in execution.timings],
+                'timings': execution.timings,
+                'warnings': execution.warnings,
+            })
+    finally:
+        set_metrics_sink(None)
+
+    return {
+        'images_per_run': images,
+        'runs': results,
+        'states': summarize(results),
+        'service_calls': {
+            'anthropic': fakes['anthropic'].calls,
+            'gemini': fakes['gemini'].calls,
+            'rekognition': fakes['rekognition'].calls,
+            's3_objects': len(fakes['s3'].objects),
+        },
+        'metric_records': len(metric_records),
+    }
+
+def print_report(report):
+    for run in report['runs']:
+        print(f"{run['execution_id']}: {run['status']} at {run['final_state']} "
+              f"({run['images']}/{report['images_per_run']} images, {run['duration_ms'] / 1000:.2f}s)")
+        print('  ' + ' -> '.join(run['path']))
+        for warning in run['warnings']:
+            print(f'  warning: {warning}')
+        if run['error']:
+            print(f"  error: {run['error']}")
+    print()
+    print(f"{'state':<22}{'count':>7}{'mean ms':>11}{'p50 ms':>11}{'max ms':>11}{'total ms':>12}")
+    for state, row in report['states'].items():
+        print(f"{state:<22}{row['count']:>7}{row['mean_ms']:>11.1f}{row['p50_ms']:>11.1f}"
+              f"{row['max_ms']:>11.1f}{row['total_ms']:>12.1f}")
+    print()
+    print('service calls:', json.dumps(report['service_calls']))
+
+def parse_pairs(pairs, cast=str):
+    result = {}
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit(f'Expected KEY=VALUE, got {pair!r}')
+        result[key] = cast(value)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', type=int, default=5, help='image_count per execution')
+    parser.add_argument('--runs', type=int, default=1, help='executions to run back to back')
+    parser.add_argument('--context', default='a busy city street')
+    parser.add_argument('--gemini-polls', type=int, default=1, help='status polls before a fake Gemini job succeeds')
+    parser.add_argument('--missing-rate', type=float, default=0.0, help='fraction of fake Gemini responses without an image')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE=MS',
+                        help='per-call delay for anthropic, gemini, s3, rekognition or apigateway')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='environment override, e.g. FUSED_LABELING=true')
+    parser.add_argument('--max-sweeps', type=int, default=50, help='sweeper runs before a parked task times out')
+    parser.add_argument('--sweep-interval', type=float, default=0.0, help='seconds between sweeper runs')
+    parser.add_argument('--sleep-waits', action='store_true', help='honour Wait states and Retry intervals')
+    parser.add_argument('--init-schema', action='store_true', help='apply schema.sql before running')
+    parser.add_argument('--json', action='store_true', help='print the full report as JSON')
+    args = parser.parse_args()
+
+    report = run_harness(
+        images=args.images, runs=args.runs, context=args.context, gemini_polls=args.gemini_polls,
+        missing_rate=args.missing_rate, seed=args.seed, latency_ms=parse_pairs(args.latency, float),
+        env_overrides=parse_pairs(args.set), max_sweeps=args.max_sweeps, sweep_interval=args.sweep_interval,
+        sleep_waits=args.sleep_waits, init_db=args.init_schema
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0 if all(run['status'] == 'SUCCEEDED' for run in report['runs']) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
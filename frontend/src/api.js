@@ -40,14 +40,14 @@ export const apiClient = {
   },
 
   // Generation endpoint
-  generateBatch: async (context, excludeTags, imageCount = 10) => {
+  generateBatch: async (context, excludeTags, imageCount = 10, idempotencyKey = crypto.randomUUID()) => {
     try {
       const headers = await getAuthHeaders()
       const response = await post({
         apiName,
         path: '/generate',
         options: {
-          headers,
+          headers: { ...headers, 'Idempotency-Key': idempotencyKey },
           body: { context, exclude_tags: excludeTags, image_count: imageCount }
         }
       })
@@ -60,6 +60,26 @@ export const apiClient = {
     }
   },
 
+  // Cancel a queued or running generation; unused credits are refunded
+  cancelGeneration: async (executionId) => {
+    try {
+      const headers = await getAuthHeaders()
+      const response = await post({
+        apiName,
+        path: '/cancel',
+        options: {
+          headers,
+          body: { execution_id: executionId }
+        }
+      })
+      const data = await response.response
+      return await data.body.json()
+    } catch (error) {
+      console.error('Cancel API Error:', error)
+      throw error
+    }
+  },
+
   // Payment endpoint
   createPayment: async (amount) => {
     try {
@@ -4,12 +4,13 @@ import { useState } from 'react'
  * Progress indicator component for individual batches
  * Shows real-time progress during generation
  */
-function BatchProgressIndicator({ batchId, progress, onComplete, onError }) {
+function BatchProgressIndicator({ batchId, progress, onComplete, onError, onCancel, onCancelled }) {
   const [isExpanded, setIsExpanded] = useState(true)
+  const [cancelling, setCancelling] = useState(false)
   
   if (!progress) return null
 
-  const { status, progress: percentage, current_step, message, image_count } = progress
+  const { status, progress: percentage, current_step, message, image_count, eta_seconds, queue_position } = progress
 
   // Handle completion
   if (status === 'completed' && onComplete) {
@@ -21,6 +22,19 @@ function BatchProgressIndicator({ batchId, progress, onComplete, onError }) {
     onError(progress)
   }
 
+  if (status === 'cancelled' && onCancelled) {
+    onCancelled(progress)
+  }
+
+  const handleCancel = async () => {
+    setCancelling(true)
+    try {
+      await onCancel()
+    } finally {
+      setCancelling(false)
+    }
+  }
+
   const getStatusColor = () => {
     switch (status) {
       case 'completed': return 'text-primary'
@@ -49,16 +63,36 @@ function BatchProgressIndicator({ batchId, progress, onComplete, onError }) {
     { key: 'SaveFinalResults', label: 'Save', icon: '💾' }
   ]
 
-  const currentStepIndex = steps.findIndex(step => step.key === current_step)
+  // The small-request fast path replaces the Generate/Processing/Download steps with one;
+  // regenerating missing images is shown as part of Download
+  const stepAliases = { GenerateImagesSync: 'CheckImageStatus', RepairImages: 'ProcessImages' }
+  const stepKey = stepAliases[current_step] || current_step
+  const currentStepIndex = steps.findIndex(step => step.key === stepKey)
+
+  const statusLabel = () => {
+    switch (status) {
+      case 'completed': return 'Completed'
+      case 'failed': return 'Failed'
+      case 'queued': return queue_position ? `Queued (#${queue_position})` : 'Queued'
+      case 'cancelled': return 'Cancelled'
+      default: return 'Processing'
+    }
+  }
+
+  const formatEta = (seconds) => {
+    if (seconds < 60) return 'under a minute left'
+    const minutes = Math.round(seconds / 60)
+    return `~${minutes} min left`
+  }
 
   return (
     <div className="bg-muted/30 border border-muted rounded-lg p-4 mb-4">
       {/* Header */}
       <div className="flex items-center justify-between mb-3">
         <div className="flex items-center gap-2">
-          <div className={`w-2 h-2 rounded-full ${status === 'processing' ? 'bg-primary animate-pulse' : status === 'completed' ? 'bg-primary' : 'bg-destructive'}`}></div>
+          <div className={`w-2 h-2 rounded-full ${status === 'processing' ? 'bg-primary animate-pulse' : status === 'queued' ? 'bg-muted-foreground animate-pulse' : status === 'completed' ? 'bg-primary' : 'bg-destructive'}`}></div>
           <span className="font-medium text-sm">
-            Batch {batchId.slice(-8)} • {status === 'completed' ? 'Completed' : status === 'failed' ? 'Failed' : 'Processing'}
+            Batch {batchId.slice(-8)} • {statusLabel()}
           </span>
           {image_count && (
             <span className="text-xs text-muted-foreground bg-muted px-2 py-1 rounded">
@@ -66,12 +100,23 @@ function BatchProgressIndicator({ batchId, progress, onComplete, onError }) {
             </span>
           )}
         </div>
-        <button
-          onClick={() => setIsExpanded(!isExpanded)}
-          className="text-muted-foreground hover:text-foreground transition-colors"
-        >
-          {isExpanded ? '▼' : '▶'}
-        </button>
+        <div className="flex items-center gap-3">
+          {onCancel && (status === 'processing' || status === 'queued') && current_step !== 'SaveFinalResults' && (
+            <button
+              onClick={handleCancel}
+              disabled={cancelling}
+              className="text-xs text-muted-foreground hover:text-destructive transition-colors disabled:opacity-50"
+            >
+              {cancelling ? 'Cancelling...' : 'Cancel'}
+            </button>
+          )}
+          <button
+            onClick={() => setIsExpanded(!isExpanded)}
+            className="text-muted-foreground hover:text-foreground transition-colors"
+          >
+            {isExpanded ? '▼' : '▶'}
+          </button>
+        </div>
       </div>
 
       {isExpanded && (
@@ -80,7 +125,10 @@ function BatchProgressIndicator({ batchId, progress, onComplete, onError }) {
           <div className="mb-3">
             <div className="flex items-center justify-between text-xs text-muted-foreground mb-1">
               <span>{message || 'Processing...'}</span>
-              <span>{percentage || 0}%</span>
+              <span>
+                {status === 'processing' && eta_seconds != null && `${formatEta(eta_seconds)} • `}
+                {percentage || 0}%
+              </span>
             </div>
             <div className="w-full bg-muted rounded-full h-2">
               <div 
@@ -93,7 +141,7 @@ function BatchProgressIndicator({ batchId, progress, onComplete, onError }) {
           {/* Step Timeline */}
           <div className="flex items-center justify-between text-xs">
             {steps.map((step, index) => {
-              const isActive = step.key === current_step
+              const isActive = step.key === stepKey
               const isCompleted = index < currentStepIndex || status === 'completed'
               const isFailed = status === 'failed' && isActive
               
@@ -293,6 +293,8 @@ function ImageValidationGallery({
                                 <img 
                                   src={image.url} 
                                   alt={image.prompt}
+                                  width={image.width || undefined}
+                                  height={image.height || undefined}
                                   className="w-full h-32 object-cover"
                                 />
                                 
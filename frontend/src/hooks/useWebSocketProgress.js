@@ -92,7 +92,7 @@ export function useWebSocketProgress() {
     })
   }, [wsUrl])
 
-  const trackBatch = useCallback(async (executionId) => {
+  const trackBatch = useCallback(async (executionId, initialProgress = {}) => {
     if (!executionId) return
     
     console.log('Starting to track execution:', executionId)
@@ -115,6 +115,7 @@ export function useWebSocketProgress() {
             progress: 0,
             current_step: 'ValidateAndSetup',
             message: 'Initializing generation...',
+            ...initialProgress,
             lastUpdate: Date.now()
           })
           return newMap
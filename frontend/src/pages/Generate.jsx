@@ -28,6 +28,8 @@ function Generate() {
   const [generating, setGenerating] = useState(false)
   const [userCredits, setUserCredits] = useState(0)
   const [batches, setBatches] = useState([])
+  // Reused when the same request is retried after an error, so it can't start twice
+  const pendingRequestRef = useRef(null)
   
   // Modal state
   const [viewedImage, setViewedImage] = useState(null)
@@ -146,8 +148,14 @@ function Generate() {
     setGenerating(true)
 
     try {
+      const requestSignature = JSON.stringify([context, excludeTags, imageCount])
+      if (pendingRequestRef.current?.signature !== requestSignature) {
+        pendingRequestRef.current = { signature: requestSignature, key: crypto.randomUUID() }
+      }
+
       // Call the real API (now returns execution_id for Step Functions)
-      const response = await apiClient.generateBatch(context, excludeTags, imageCount)
+      const response = await apiClient.generateBatch(context, excludeTags, imageCount, pendingRequestRef.current.key)
+      pendingRequestRef.current = null
       
       // Create batch record with pending status
       const newBatch = {
@@ -162,12 +170,21 @@ function Generate() {
         status: 'processing' // Track status
       }
       
-      setBatches(prev => [newBatch, ...prev])
-      setUserCredits(prev => prev - (response.estimated_cost || parseFloat(calculateCost())))
+      // A duplicate returns the execution already listed and charged
+      setBatches(prev => prev.some(batch => batch.id === newBatch.id) ? prev : [newBatch, ...prev])
+      if (!response.duplicate) {
+        setUserCredits(prev => prev - (response.estimated_cost || parseFloat(calculateCost())))
+      }
       
       // Start tracking progress via WebSocket
       if (response.execution_id) {
-        trackBatch(response.execution_id)
+        // Requests over the concurrency limits wait in a queue before the workflow starts
+        trackBatch(response.execution_id, response.status === 'queued' ? {
+          status: 'queued',
+          current_step: 'Queued',
+          queue_position: response.queue_position,
+          message: response.message
+        } : {})
       }
     } catch (error) {
       console.error('Error generating batch:', error)
@@ -225,6 +242,30 @@ function Generate() {
     setGenerating(false)
   }
 
+  // Ask the backend to stop a queued or running generation; the final state arrives over the WebSocket
+  const handleCancelBatch = async (executionId) => {
+    try {
+      await apiClient.cancelGeneration(executionId)
+    } catch (error) {
+      console.error('Error cancelling batch:', error)
+      alert(`Could not cancel generation: ${error.message}`)
+    }
+  }
+
+  const handleBatchCancelled = (executionId, cancelData) => {
+    setBatches(prev => prev.map(batch => {
+      if (batch.executionId === executionId) {
+        return { ...batch, status: 'cancelled', completedAt: new Date() }
+      }
+      return batch
+    }))
+
+    // Queued requests were never charged, so reload the balance rather than adding up refunds
+    fetchUserData()
+    stopTracking(executionId)
+    console.log('Batch cancelled:', executionId, cancelData)
+  }
+
   const handleSaveDataset = (dataset) => {
     const totalImages = dataset.batches.reduce((total, batch) => total + batch.images.length, 0)
     const selectedCount = validationState.selectedImages.size
@@ -505,6 +546,8 @@ function Generate() {
             progress={progress}
             onComplete={(progressData) => handleBatchComplete(batchId, progressData)}
             onError={(errorData) => handleBatchError(batchId, errorData)}
+            onCancel={() => handleCancelBatch(batchId)}
+            onCancelled={(cancelData) => handleBatchCancelled(batchId, cancelData)}
           />
         ))}
 